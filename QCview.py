@@ -1,40 +1,203 @@
 ### QCview.py: iterates through the qcFigs/triggerFix directory and shows the user each figure one at at a time. The user can choose which figure,
 ### if any, looks like a correct split. The program then updates the triggerFix.csv file accordingly
+### Figures are shown in one window and decided with a single key: s (simpFix), a (autoFix), n (neither), b or backspace to go back to the
+### previous figure, q to stop. The next figures are read and scaled in a background thread while the current one is on screen.
+### Every decision is appended to triggerFix.csv.journal as soon as it is made, and the journal is merged into triggerFix.csv (atomically,
+### keeping edits made to it in the meantime) when the program stops; a journal left behind by a crash is merged when the program starts.
+### Figures of images that already have a simpFix or autoFix are skipped unless --all is given (images decided as neither are shown again).
 ### usage: python QCview.py path/to/qcFigs/triggerFix path/to/triggerFix.csv
 
 ### NOTE: in order for this code to work properly, a graphical interface must be enabled, such as X11 for Mac. For more information on installing,
-### visit https://docs.ycrc.yale.edu/clusters-at-yale/access/x11/
-import pandas as pd
+### visit https://docs.ycrc.yale.edu/clusters-at-yale/access/x11/. Without one, qcFigs/qcReport.html (see qcReport.py) shows all figures in a browser
 import os
+import sys
+import json
+import time
+import signal
 import argparse
+import natsort
+import numpy as np
 import PIL
 from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
+from controlSheet import ControlSheet
+
+# control sheet columns set by each decision; a fix clears the other one, so a changed decision never leaves both set. 'none' leaves the
+# sheet as it is
+DECISIONS = {'simpfix': {'simpFix': 1, 'autoFix': 0, 'writeImgs': 1}, 'autofix': {'autoFix': 1, 'simpFix': 0, 'writeImgs': 1}, 'none': {}}
+DECISION_KEYS = {'s': 'simpfix', 'a': 'autofix', 'n': 'none'}
+
+### journalPath: path of the decision journal of a control sheet
+def journalPath(sheetPath):
+	return sheetPath + '.journal'
+
+### appendJournal: append one decision to the journal and flush it to disk, so it survives a crash
+def appendJournal(journal, rowName, decision):
+	with open(journal, 'a') as f:
+		f.write(json.dumps({'Img': rowName, 'decision': decision, 'time': time.time()}) + '\n')
+		f.flush()
+		os.fsync(f.fileno())
+
+### readJournal: the last decision for each image in the journal, {} if there is none; a line cut off by a crash is ignored
+def readJournal(journal):
+	decisions = {}
+	if not os.path.isfile(journal):
+		return decisions
+	with open(journal) as f:
+		for line in f:
+			try:
+				entry = json.loads(line)
+			except ValueError:
+				continue
+			decisions[entry['Img']] = entry['decision']
+	return decisions
+
+### mergeJournal: write the decisions of the journal into the control sheet in one atomic save and remove the journal; returns the decisions
+def mergeJournal(sheetPath, journal):
+	decisions = readJournal(journal)
+	if len(decisions) > 0:
+		sheet = ControlSheet.load(sheetPath)
+		for rowName, decision in decisions.items():
+			if len(DECISIONS[decision]) > 0:
+				sheet.update(rowName, **DECISIONS[decision])
+		sheet.save()
+	if os.path.isfile(journal):
+		os.remove(journal)
+	return decisions
+
+### loadFigure: read a figure and scale it to fit within maxSize pixels, as an array ready to be shown
+def loadFigure(path, maxSize):
+	img = Image.open(path).convert('RGB')
+	img.thumbnail((maxSize, maxSize))
+	return np.asarray(img)
+
+class FigureReview:
+	'''
+	Window showing the figures one at a time; key presses record decisions in the journal and move on.
+	The next prefetch figures are read and scaled by a background thread while the current one is shown.
+	'''
+	def __init__(self, figPaths, rowNames, journal, prefetch = 8, maxSize = 1600):
+		from matplotlib import pyplot as plt
+		self.plt = plt
+		self.figPaths = figPaths
+		self.rowNames = rowNames
+		self.journal = journal
+		self.prefetch = prefetch
+		self.maxSize = maxSize
+		self.loader = ThreadPoolExecutor(max_workers = 1)
+		self.loaded = {}
+		self.decided = {}
+		self.current = 0
+
+		# the default matplotlib key bindings (s saves, q closes, ...) would get in the way of the decision keys
+		for key in plt.rcParams:
+			if key.startswith('keymap.'):
+				plt.rcParams[key] = []
+		self.fig, self.ax = plt.subplots(figsize = (16, 8))
+		self.fig.canvas.mpl_connect('key_press_event', self.onKey)
+		self.image = None
+
+	### figure: the figure at index i, waiting for the background thread if it is not read yet
+	def figure(self, i):
+		self.schedule(i)
+		return self.loaded[i].result()
+
+	### schedule: start reading the figures from i to i + prefetch, and forget those far behind
+	def schedule(self, i):
+		for j in range(i, min(i + self.prefetch + 1, len(self.figPaths))):
+			if j not in self.loaded:
+				self.loaded[j] = self.loader.submit(loadFigure, self.figPaths[j], self.maxSize)
+		for j in [j for j in self.loaded if j < i - 1]:
+			del self.loaded[j]
+
+	### show: put the current figure in the window
+	def show(self):
+		arr = self.figure(self.current)
+		if self.image is None or self.image.get_array().shape != arr.shape:
+			self.ax.clear()
+			self.ax.axis('off')
+			self.image = self.ax.imshow(arr)
+		else:
+			self.image.set_data(arr)
+		rowName = self.rowNames[self.current]
+		previous = self.decided.get(rowName)
+		self.ax.set_title('%d/%d  %s%s\ns = simpFix, a = autoFix, n = neither, b = back, q = quit' %
+		                  (self.current + 1, len(self.figPaths), rowName, '' if previous is None else '  (' + previous + ')'))
+		self.fig.canvas.draw_idle()
+
+	### onKey: record the decision of a key press in the journal and move to the next figure
+	def onKey(self, event):
+		if event.key in DECISION_KEYS:
+			rowName = self.rowNames[self.current]
+			self.decided[rowName] = DECISION_KEYS[event.key]
+			appendJournal(self.journal, rowName, DECISION_KEYS[event.key])
+			print(rowName, ':', DECISION_KEYS[event.key])
+			self.current = self.current + 1
+		elif event.key in ('b', 'backspace'):
+			self.current = max(self.current - 1, 0)
+		elif event.key == 'q':
+			self.plt.close(self.fig)
+			return
+		else:
+			return
+
+		if self.current >= len(self.figPaths):
+			print('All figures reviewed')
+			self.plt.close(self.fig)
+			return
+		self.show()
+
+	### run: show the figures until they are all decided or the window is closed
+	def run(self):
+		self.show()
+		self.plt.show()
+		self.loader.shutdown(wait = False, cancel_futures = True)
+		return self.decided
 
 if __name__ == '__main__':
 	parser = argparse.ArgumentParser(description='automate trigger fixes in spreadsheet for qcFig output')
 	parser.add_argument('qcDir', help='full path to directory containing qcFigs output from first run of genTrigsNii')
 	parser.add_argument('qcSheet', help='csv where autofix vs simpfix is specified')
+	parser.add_argument('--all', action = 'store_true', help='also show the figures of images that already have a simpFix or autoFix')
+	parser.add_argument('--prefetch', type = int, default = 8, help='number of figures read ahead in the background, default 8')
+	parser.add_argument('--maxSize', type = int, default = 1600, help='figures are scaled to fit within this many pixels, default 1600')
 
 	args=parser.parse_args()
-	
+
 	qcDir = args.qcDir
-	sheet = args.qcSheet
-	
-	qcDF = pd.read_csv(sheet, index_col = 'Img')
-	os.chdir(qcDir)
-	for file in os.scandir():
-		name, ext = os.path.splitext(file)
+	sheet = os.path.abspath(args.qcSheet)
+	journal = journalPath(sheet)
+
+	if os.name == 'posix' and sys.platform != 'darwin' and 'DISPLAY' not in os.environ:
+		print('No display found; open qcFigs/qcReport.html in a browser instead, or enable X11 forwarding')
+		sys.exit(1)
+
+	# decisions left in the journal by a run that did not finish
+	recovered = mergeJournal(sheet, journal)
+	if len(recovered) > 0:
+		print('Merged', len(recovered), 'decisions from an unfinished review into', sheet)
+
+	qcSheet = ControlSheet.load(sheet)
+	figPaths = []
+	rowNames = []
+	for file in natsort.natsorted(os.scandir(qcDir), key = lambda f: f.name):
+		name, ext = os.path.splitext(file.name)
 		if ext == '.png' and name.endswith('Auto'):
 			rowName = file.name.split('mean')[0]
-			print('opening qcFig for: ', rowName)
-			fig = Image.open(file.path)
-			fig.show()
-			method = input('Select simpfix, autofix, or none for this figure: ')
-			if method == 'simpfix':
-				qcDF.at[rowName, 'simpFix'] = 1
-				qcDF.at[rowName, 'writeImgs'] = 1
-			if method == 'autofix':
-				qcDF.at[rowName, 'autoFix'] = 1
-				qcDF.at[rowName, 'writeImgs'] = 1
-			closeWindow = input('Press enter to continue the program after closing the image window')
-	qcDF.to_csv(sheet)
+			if args.all or not (qcSheet.get(rowName, 'simpFix') == 1 or qcSheet.get(rowName, 'autoFix') == 1):
+				figPaths.append(file.path)
+				rowNames.append(rowName)
+
+	if len(figPaths) == 0:
+		print('No figures left to review in', qcDir)
+		sys.exit(0)
+	print('Reviewing', len(figPaths), 'figures')
+
+	# a kill also ends the review through the finally below
+	signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+	try:
+		FigureReview(figPaths, rowNames, journal, args.prefetch, args.maxSize).run()
+	finally:
+		# only the choices made here are written, edits made to the sheet while viewing are kept
+		decisions = mergeJournal(sheet, journal)
+		print('Merged', len(decisions), 'decisions into', sheet)
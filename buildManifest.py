@@ -0,0 +1,258 @@
+### buildManifest.py: make style bookkeeping of the outputs of the pipeline stages (triggers, split NIfTIs, QC figures, preprocessing)
+### Every output gets a manifest next to it (<output>.manifest.json), written only once the output is completely written. The manifest
+### records the step that built the output, the parameters it used and a digest of each of its inputs. An output is rebuilt when it is
+### missing, was changed after it was built, or when an input or a parameter changed since. Rebuilding an output changes its digest, so
+### the outputs built from it are rebuilt in turn. An output without a manifest (e.g. made before manifests existed) is adopted: if it is
+### complete, a manifest is written for it as it is; one left incomplete by an interrupted run is rebuilt. With
+### setBuildOptions(adopt = False) every output without a manifest is rebuilt.
+### Outputs built by another step are left alone, unless the step is declared to replace that step's outputs (e.g. the trigger files
+### fixed through the control sheet replace the ones decoded from the smr files, which then no longer touches them).
+### In a dry run nothing is built: the outputs that would be built are printed and remembered, so the steps downstream of them are
+### planned as well.
+### usage: from buildManifest import needsBuild, recordBuild
+###        if needsBuild('split', [signalPath, noisePath], [tifPath, trigPath], {'outDtype': outDtype}):
+###            splitTifNii(...); recordBuild('split', [signalPath, noisePath], [tifPath, trigPath], {'outDtype': outDtype})
+import os
+import sys
+import glob
+import json
+import math
+import fnmatch
+import hashlib
+import shlex
+import argparse
+import struct
+import numpy as np
+import nibabel as nb
+from tsCache import tifContentKey
+
+MANIFEST_SUFFIX = '.manifest.json'
+
+# inputs up to this size are hashed in full, larger ones (the tif movies) by their size, modification time and header (see tsCache)
+FULL_HASH_BYTES = 64*1024**2
+
+# digests computed in this process, keyed on (path, size, modification time)
+digestMemo = {}
+
+# outputs that a dry run would build, in this process
+plannedOutputs = set()
+
+### setBuildOptions: turn dry run mode and/or adoption of existing outputs on or off; stored in the environment so that worker processes inherit it
+###     with adopt (the default), an existing complete output without a manifest is taken as up to date and a manifest is written for it
+###     instead of rebuilding it
+def setBuildOptions(dryRun = None, adopt = None):
+    if dryRun is not None:
+        os.environ['CA2_BUILD_DRY_RUN'] = '1' if dryRun else '0'
+    if adopt is not None:
+        os.environ['CA2_BUILD_ADOPT'] = '1' if adopt else '0'
+
+### isDryRun: True if outputs are only planned, not built
+def isDryRun():
+    return os.environ.get('CA2_BUILD_DRY_RUN', '0') == '1'
+
+### isAdopting: True if existing outputs without a manifest are taken as up to date
+def isAdopting():
+    return os.environ.get('CA2_BUILD_ADOPT', '1') == '1'
+
+### outputComplete: True if an output without a manifest looks completely written: not empty, and for NIfTI files as long as their header
+###     says (for .nii.gz, the uncompressed size in the gzip trailer), so a file cut short by an interrupted write is not adopted
+def outputComplete(output):
+    try:
+        size = os.path.getsize(output)
+    except OSError:
+        return False
+    if size == 0:
+        return False
+    if not output.endswith(('.nii', '.nii.gz')):
+        return True
+
+    try:
+        proxy = nb.load(output).dataobj
+        expected = int(proxy.offset) + int(np.prod(proxy.shape))*proxy.dtype.itemsize
+        if not output.endswith('.gz'):
+            return size >= expected
+        with open(output, 'rb') as f:
+            f.seek(-4, os.SEEK_END)
+            return struct.unpack('<I', f.read(4))[0] == expected % 2**32
+    except (OSError, ValueError, struct.error, nb.filebasedimages.ImageFileError):
+        return False
+
+### manifestPath: path of the manifest of an output
+def manifestPath(output):
+    return output + MANIFEST_SUFFIX
+
+### fileDigest: digest of the content of a file, None if it does not exist
+def fileDigest(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+
+    memoKey = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    if memoKey not in digestMemo:
+        if st.st_size > FULL_HASH_BYTES:
+            digestMemo[memoKey] = 'key:' + tifContentKey(path)
+        else:
+            h = hashlib.sha1()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1024**2), b''):
+                    h.update(block)
+            digestMemo[memoKey] = 'sha1:' + h.hexdigest()
+    return digestMemo[memoKey]
+
+### outputStamp: [size, modification time] of an output, None if it does not exist
+def outputStamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+### jsonValue: a parameter value as plain JSON (numpy scalars as python numbers, NaN as None), so values read from the control sheet compare equal
+def jsonValue(value):
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    if isinstance(value, (list, tuple)):
+        return [jsonValue(v) for v in value]
+    if isinstance(value, dict):
+        return {str(k): jsonValue(v) for k, v in value.items()}
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return str(value)
+
+### readManifest: the manifest of an output as a dict, None if it is missing or unreadable
+def readManifest(output):
+    try:
+        with open(manifestPath(output)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+### staleReason: why the outputs of a step have to be (re)built, '' if they are up to date
+###     replaces lists the steps whose outputs this step takes over
+def staleReason(step, outputs, inputs, params = {}, replaces = ()):
+    params = jsonValue(params)
+    if ownedByOtherStep(step, outputs, replaces):
+        return ''
+    for output in outputs:
+        if not os.path.isfile(output):
+            return 'missing ' + output
+        manifest = readManifest(output)
+        if manifest is None:
+            if not isAdopting():
+                return 'no manifest for ' + output
+            if not outputComplete(output):
+                return output + ' has no manifest and is incomplete'
+            continue
+        if manifest.get('step') != step:
+            return output + ' was built by ' + str(manifest.get('step'))
+        if manifest.get('outputs', {}).get(os.path.abspath(output)) != outputStamp(output):
+            return output + ' changed since it was built'
+        recorded = manifest.get('inputs', {})
+        if sorted(recorded.keys()) != sorted([os.path.abspath(ip) for ip in inputs]):
+            return 'inputs differ from the last build'
+        for ip in inputs:
+            if os.path.abspath(ip) in plannedOutputs:
+                return ip + ' is rebuilt'
+            if recorded[os.path.abspath(ip)] != fileDigest(ip):
+                return ip + ' changed'
+        if manifest.get('params') != params:
+            changed = sorted(set(params.keys()) ^ set(manifest.get('params', {}).keys()) |
+                             set(k for k in params.keys() if manifest.get('params', {}).get(k) != params[k]))
+            return 'parameters changed: ' + ', '.join(changed)
+    return ''
+
+### ownedByOtherStep: True if one of the existing outputs was built by a step other than step (and the steps it replaces),
+###     which owns the outputs from then on
+def ownedByOtherStep(step, outputs, replaces = ()):
+    for output in outputs:
+        manifest = readManifest(output) if os.path.isfile(output) else None
+        if manifest is not None and manifest.get('step') != step and manifest.get('step') not in replaces:
+            return True
+    return False
+
+### recordBuild: write the manifests of the outputs of a step, once they have been completely written
+def recordBuild(step, outputs, inputs, params = {}):
+    manifest = {'step': step, 'params': jsonValue(params),
+                'inputs': {os.path.abspath(ip): fileDigest(ip) for ip in inputs},
+                'outputs': {os.path.abspath(op): outputStamp(op) for op in outputs}}
+    for output in outputs:
+        tmpPath = manifestPath(output) + '.tmp'
+        with open(tmpPath, 'w') as f:
+            json.dump(manifest, f, indent = 1, sort_keys = True)
+        os.replace(tmpPath, manifestPath(output))
+
+### needsBuild: True if the outputs of a step have to be built now, printing what is done and why
+###     in a dry run this is always False; the outputs that would be built are printed and remembered instead
+###     complete outputs without a manifest are adopted (a manifest is written for them) when adoption is on
+def needsBuild(step, outputs, inputs, params = {}, replaces = ()):
+    reason = staleReason(step, outputs, inputs, params, replaces)
+    if reason == '':
+        unrecorded = isAdopting() and not ownedByOtherStep(step, outputs, replaces) and any(readManifest(op) is None for op in outputs)
+        if unrecorded and isDryRun():
+            print('[dry run] would adopt existing', step, 'outputs:', ', '.join(outputs))
+        elif unrecorded:
+            print('Adopting existing', step, 'outputs:', ', '.join(outputs))
+            recordBuild(step, outputs, inputs, params)
+        else:
+            print(step, 'up to date:', ', '.join(outputs))
+        return False
+
+    if isDryRun():
+        print('[dry run] would build', step, ':', ', '.join(outputs), '(' + reason + ')')
+        plannedOutputs.update([os.path.abspath(op) for op in outputs])
+        return False
+
+    print('Building', step, ':', ', '.join(outputs), '(' + reason + ')')
+    return True
+
+### willExist: True if path exists, or would be built by the dry run
+def willExist(path):
+    return os.path.isfile(path) or os.path.abspath(path) in plannedOutputs
+
+### plannedGlob: glob.glob, including the outputs the dry run would build
+def plannedGlob(pattern):
+    planned = [op for op in plannedOutputs if fnmatch.fnmatch(op, os.path.abspath(pattern))]
+    return sorted(set(glob.glob(pattern)) | set(planned))
+
+### recordCommand: shell command that records the manifests of a step, for steps that run later as jobs (see runPreproc --hpc)
+###     the paths are made absolute, since the job may run from another directory
+def recordCommand(step, outputs, inputs, params = {}):
+    args = [sys.executable, os.path.abspath(__file__), 'record', '--step', step, '--params', json.dumps(jsonValue(params)),
+            '--outputs'] + [os.path.abspath(op) for op in outputs] + ['--inputs'] + [os.path.abspath(ip) for ip in inputs]
+    return ' '.join([shlex.quote(a) for a in args])
+
+
+if __name__ == '__main__':
+
+    parser=argparse.ArgumentParser(description='Record or check the manifests of pipeline outputs')
+    subparsers = parser.add_subparsers(dest = 'command', required = True)
+
+    recordParser = subparsers.add_parser('record', help = 'write the manifests of outputs that were just built')
+    recordParser.add_argument('--step',type = str, required = True, help='name of the step that built the outputs')
+    recordParser.add_argument('--params',type = str, help='parameters of the step as a JSON object', default = '{}')
+    recordParser.add_argument('--outputs',type = str, nargs = '+', required = True, help='paths of the outputs')
+    recordParser.add_argument('--inputs',type = str, nargs = '*', help='paths of the inputs', default = [])
+
+    checkParser = subparsers.add_parser('check', help = 'print the step that built each output and whether it is up to date')
+    checkParser.add_argument('outputs',type = str, nargs = '+', help='paths of the outputs')
+
+    args=parser.parse_args()
+
+    if args.command == 'record':
+        missing = [op for op in args.outputs if not os.path.isfile(op)]
+        if len(missing) > 0:
+            print('Not recording', args.step, ', outputs missing:', ', '.join(missing))
+            sys.exit(1)
+        recordBuild(args.step, args.outputs, args.inputs, json.loads(args.params))
+
+    else:
+        for output in args.outputs:
+            manifest = readManifest(output)
+            if manifest is None:
+                print(output, ': no manifest')
+                continue
+            reason = staleReason(manifest['step'], [output], list(manifest['inputs'].keys()), manifest['params'])
+            print(output, ':', manifest['step'], ',', 'up to date' if reason == '' else 'stale (' + reason + ')')
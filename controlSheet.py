@@ -0,0 +1,193 @@
+### controlSheet.py: the control sheet (triggerFix.csv) that drives the semi automatic trigger fixes of genTrigsNii (STEP 5), as a store of typed
+### rows keyed on the image name. Rows are read once into a dict, so looking up an image does not scan the sheet. Changes are kept in memory
+### and written in one go by save, which re-reads the sheet under a lock, applies only the cells that were changed and replaces the file
+### atomically; edits made to the sheet by someone else in the meantime (another run, QCview, a spreadsheet) are kept.
+### usage: from controlSheet import ControlSheet
+###        sheet = ControlSheet.load('triggerFix.csv')
+###        if sheet.get(imgName, 'autoFix') == 1: ...
+###        sheet.update(imgName, CrossedTrigs = 1); sheet.save()
+import os
+import csv
+import time
+import math
+import logging
+import contextlib
+
+CONTROL_COLUMNS = ['Img','CrossedTrigs','autoFix','simpFix','sdFlag','sdVal','writeImgs','manualOverwrite','splitMethod','dbscanEps']
+
+# type of each known column; empty cells are NaN in number columns and None in text columns, other columns are kept as text
+COLUMN_TYPES = {'Img': str, 'CrossedTrigs': float, 'autoFix': float, 'simpFix': float, 'sdFlag': float, 'sdVal': float,
+                'writeImgs': float, 'manualOverwrite': float, 'splitMethod': str, 'dbscanEps': float,
+                'suggestedFix': str, 'suggestedScore': float}
+
+### lockedFile: hold an exclusive lock on path (through a path.lock file) for the duration of a with block
+@contextlib.contextmanager
+def lockedFile(path, timeout = 600):
+    lockPath = path + '.lock'
+    start = time.time()
+    while True:
+        try:
+            fd = os.open(lockPath, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            if time.time() - start > timeout:
+                raise Exception('Timed out waiting for lock on '+path+', delete '+lockPath+' if no other run is using it')
+            time.sleep(0.5)
+    try:
+        os.write(fd, str(os.getpid()).encode())
+        os.close(fd)
+        yield path
+    finally:
+        os.remove(lockPath)
+
+### parseValue: typed value of a cell of the sheet as read from the csv
+def parseValue(path, img, col, raw):
+    colType = COLUMN_TYPES.get(col, str)
+    raw = '' if raw is None else raw.strip()
+    if colType is float:
+        if raw == '':
+            return math.nan
+        try:
+            return float(raw)
+        except ValueError:
+            raise ValueError('%s: %s of %s should be a number, not %r' % (path, col, img, raw))
+    return raw if raw != '' else None
+
+### formatValue: text of a cell as written to the csv (whole numbers without a decimal point, so flags stay 0/1)
+def formatValue(value):
+    if value is None:
+        return ''
+    if isinstance(value, float):
+        if math.isnan(value):
+            return ''
+        if value.is_integer():
+            return str(int(value))
+        return repr(value)
+    return str(value)
+
+### emptyValue: value of an empty cell of a column
+def emptyValue(col):
+    return math.nan if COLUMN_TYPES.get(col, str) is float else None
+
+### typedValue: value set through update, converted to the type of its column
+def typedValue(col, value):
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return emptyValue(col)
+    if COLUMN_TYPES.get(col, str) is float:
+        return float(value)
+    return str(value)
+
+class ControlSheet:
+    '''
+    Rows of the control sheet keyed on Img, in the order of the file.
+    get/row read from memory, update changes rows in memory (adding rows for new images) and save writes the changed cells to disk.
+    An image listed more than once is read from its first row, which is also the one update changes.
+    '''
+    def __init__(self, path, columns = None):
+        self.path = path
+        self.columns = list(CONTROL_COLUMNS if columns is None else columns)
+        self.rows = []
+        self.index = {}
+        # cells changed since the last load or save, as {img: {col: value}}
+        self.pending = {}
+
+    ### load: the sheet in path, or an empty sheet with the default columns if there is no file yet
+    @classmethod
+    def load(cls, path):
+        sheet = cls(path)
+        if os.path.isfile(path):
+            sheet.readRows()
+        return sheet
+
+    ### readRows: (re)read the rows from disk, replacing the ones in memory
+    def readRows(self):
+        with open(self.path, newline = '') as f:
+            reader = csv.DictReader(f)
+            if reader.fieldnames is None or 'Img' not in reader.fieldnames:
+                raise ValueError(self.path + ': control sheet has no Img column')
+            columns = list(reader.fieldnames)
+            rows = []
+            for raw in reader:
+                img = (raw.get('Img') or '').strip()
+                rows.append({col: parseValue(self.path, img, col, raw.get(col)) for col in columns})
+
+        self.columns = columns + [col for col in CONTROL_COLUMNS if col not in columns]
+        self.rows = []
+        self.index = {}
+        for row in rows:
+            self.appendRow(row)
+
+    ### appendRow: add a row at the end, filling in missing columns
+    def appendRow(self, row):
+        row = {col: row.get(col, emptyValue(col)) for col in self.columns}
+        self.rows.append(row)
+        if row['Img'] is None:
+            return row
+        if row['Img'] in self.index:
+            logging.warning('%s: %s is listed more than once, using its first row', self.path, row['Img'])
+        else:
+            self.index[row['Img']] = len(self.rows) - 1
+        return row
+
+    def __contains__(self, img):
+        return img in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    ### images: names of the images in the sheet, in the order of the file
+    def images(self):
+        return list(self.index.keys())
+
+    ### row: the values of all columns for an image, None if it is not in the sheet
+    def row(self, img):
+        if img not in self.index:
+            return None
+        return dict(self.rows[self.index[img]])
+
+    ### get: the value of one column for an image, the empty value of the column if the image is not in the sheet
+    def get(self, img, col):
+        if img not in self.index:
+            return emptyValue(col)
+        return self.rows[self.index[img]].get(col, emptyValue(col))
+
+    ### update: set columns of an image in memory, adding a row for it if needed; written to disk by save
+    def update(self, img, **values):
+        for col in values:
+            if col not in self.columns:
+                self.columns.append(col)
+                for row in self.rows:
+                    row[col] = emptyValue(col)
+        if img not in self.index:
+            self.appendRow({'Img': img})
+        row = self.rows[self.index[img]]
+        self.pending.setdefault(img, {})
+        for col, value in values.items():
+            row[col] = typedValue(col, value)
+            self.pending[img][col] = row[col]
+
+    ### save: write the sheet to disk; the file is re-read under a lock and only the cells changed through update are applied to it,
+    ###     so that changes made to it by others since it was loaded are kept. The file is replaced atomically
+    def save(self):
+        with lockedFile(self.path):
+            pending = self.pending
+            if os.path.isfile(self.path):
+                self.readRows()
+            for img, values in pending.items():
+                self.update(img, **values)
+            self.pending = {}
+
+            tmpPath = self.path + '.tmp'
+            with open(tmpPath, 'w', newline = '') as f:
+                writer = csv.writer(f)
+                writer.writerow(self.columns)
+                for row in self.rows:
+                    writer.writerow([formatValue(row.get(col)) for col in self.columns])
+            os.replace(tmpPath, self.path)
+
+### flagCrossedTrigs: set CrossedTrigs to 1 for the given images in the control sheet on disk, adding rows for images not in it yet
+def flagCrossedTrigs(sheetPath, imgNames):
+    sheet = ControlSheet.load(sheetPath)
+    for imgName in imgNames:
+        sheet.update(imgName, CrossedTrigs = 1)
+    sheet.save()
@@ -0,0 +1,484 @@
+### dataIndex.py: persistent SQLite index of the raw data (.tif, .smr) and derived outputs of the pipeline
+### The index records every file below the registered raw data and output directories (size and modification time), the frame
+### count of every tif (from its header, see tifIO.tifFrameCount), a header only channel summary of every smr file, the images
+### (tif parts) with the output directory the pipeline writes them to, and the control sheet. It is refreshed incrementally:
+### a directory whose modification time has not changed since the last refresh is not listed again, and a tif or smr file is only
+### read again if its size or modification time changed. The pipeline writes its outputs through a temporary file that is then
+### renamed into place, which updates the directory modification time; use --full to also pick up files rewritten in place.
+### The index defaults to dataIndex.sqlite in the cache directory (see tsCache.getCacheDir) and can be set with CA2_INDEX_DB or --db.
+### The pipeline scripts refresh the index when they start (see refreshPipelineIndex) and then take their file listings and tif frame
+### counts from it (indexedGlob, indexedWalk, indexedExists, frameCount). A directory is only answered from the index while its
+### modification time is the one indexed, and a tif only while its size and modification time are; anything else is read from the file
+### system, so the answers are those of glob, os.walk and the tif header either way.
+### usage: python dataIndex.py refresh rawOrganizedData/ --opDir preprocOutputDir/ --controlSheet triggerFix.csv
+###        python dataIndex.py missing rawsignl.nii.gz
+###        python dataIndex.py crossed
+import os
+import glob
+import fnmatch
+import sqlite3
+import time
+import logging
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+from smrIO import SON_KIND_NAMES, SON_WAVE_KINDS, openSmrReader
+from tifIO import tifFrameCount
+from tsCache import getCacheDir
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS roots (path TEXT PRIMARY KEY, role TEXT, mtimeNs INTEGER);
+CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, parent TEXT, mtimeNs INTEGER);
+CREATE INDEX IF NOT EXISTS dirsParent ON dirs (parent);
+CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, dir TEXT, name TEXT, kind TEXT, size INTEGER, mtimeNs INTEGER);
+CREATE INDEX IF NOT EXISTS filesDir ON files (dir);
+CREATE INDEX IF NOT EXISTS filesName ON files (name);
+CREATE TABLE IF NOT EXISTS tifs (path TEXT PRIMARY KEY, size INTEGER, mtimeNs INTEGER, nFrames INTEGER, error TEXT);
+CREATE TABLE IF NOT EXISTS smrs (path TEXT PRIMARY KEY, size INTEGER, mtimeNs INTEGER, nChannels INTEGER, duration REAL, error TEXT);
+CREATE TABLE IF NOT EXISTS smrChannels (path TEXT, chan INTEGER, name TEXT, kind TEXT, samplingRate REAL, units TEXT, duration REAL,
+                                        PRIMARY KEY (path, chan));
+CREATE TABLE IF NOT EXISTS images (image TEXT PRIMARY KEY, tifPath TEXT, dataset TEXT, animal TEXT, session TEXT, date TEXT, run TEXT,
+                                   task TEXT, part INTEGER, outDir TEXT);
+CREATE INDEX IF NOT EXISTS imagesOutDir ON images (outDir);
+'''
+
+# a directory modified this recently when it is listed may still change within the same modification time (whose resolution is
+# coarse on some file systems), so it is recorded as not up to date and listed again next time
+RACY_NS = 2*10**9
+
+# file kinds recorded in the files table, by file name ending
+FILE_KINDS = [('.tif', 'tif'), ('.tiff', 'tif'), ('.smr', 'smr'), ('.mat', 'mat'), ('.nii.gz', 'nii'), ('.nii', 'nii'), ('.csv', 'csv'),
+              ('.png', 'fig'), ('.jpg', 'fig')]
+
+# output files of each pipeline stage, in the part directories of the output directory
+STAGE_FILES = {'trigs': 'OpticalOrder.csv', 'signal': 'rawsignl.nii.gz', 'noise': 'rawnoise.nii.gz',
+               'signalOut': 'signl_out.nii.gz', 'noiseOut': 'noise_out.nii.gz'}
+
+# connection of this process to the index used by the pipeline, with the process id it was opened in (see pipelineIndex)
+pipelineConn = (None, None)
+
+### defaultIndexPath: path of the index database, CA2_INDEX_DB or dataIndex.sqlite in the cache directory
+def defaultIndexPath():
+    return os.environ.get('CA2_INDEX_DB', os.path.join(getCacheDir(), 'dataIndex.sqlite'))
+
+### setIndexOptions: turn the use of the index by the pipeline on or off and/or set its path; stored in the environment so that worker
+###     processes inherit it
+def setIndexOptions(enabled = None, dbPath = None):
+    if enabled is not None:
+        os.environ['CA2_USE_INDEX'] = '1' if enabled else '0'
+    if dbPath is not None:
+        os.environ['CA2_INDEX_DB'] = os.path.abspath(dbPath)
+
+### openIndex: open (and create if needed) the index database
+def openIndex(dbPath = None):
+    if dbPath is None:
+        dbPath = defaultIndexPath()
+    conn = sqlite3.connect(dbPath)
+    conn.executescript(SCHEMA)
+    return conn
+
+### fileKind: kind of a file from its name ('tif', 'smr', 'mat', 'nii', 'csv', 'fig' or 'other')
+def fileKind(name):
+    lower = name.lower()
+    for ending, kind in FILE_KINDS:
+        if lower.endswith(ending):
+            return kind
+    return 'other'
+
+### subtreeClause: SQL condition (and its parameters) selecting column values at or below directory path
+###     a range on the path is used instead of LIKE, since the underscores in the file names are LIKE wildcards
+def subtreeClause(column, path):
+    return '(%s = ? OR (%s >= ? AND %s < ?))' % (column, column, column), (path, path + os.sep, path + chr(ord(os.sep) + 1))
+
+### forgetDir: remove a directory and everything below it from the index
+def forgetDir(conn, path):
+    clause, params = subtreeClause('path', path)
+    conn.execute('DELETE FROM dirs WHERE ' + clause, params)
+    clause, params = subtreeClause('dir', path)
+    conn.execute('DELETE FROM files WHERE ' + clause, params)
+
+### refreshTree: bring the dirs and files tables up to date for the directory tree below root, returns the number of directories listed
+###     directories whose modification time is unchanged are not listed again unless full is set; symbolic links to files are followed
+###     (the organized raw data are links) but symbolic links to directories are not
+def refreshTree(conn, root, full = False):
+    nListed = 0
+    stack = [(root, None)]
+    while len(stack) > 0:
+        path, parent = stack.pop()
+        try:
+            mtimeNs = os.stat(path).st_mtime_ns
+        except OSError:
+            forgetDir(conn, path)
+            continue
+
+        known = conn.execute('SELECT mtimeNs FROM dirs WHERE path = ?', (path,)).fetchone()
+        knownSubdirs = [r[0] for r in conn.execute('SELECT path FROM dirs WHERE parent = ?', (path,))]
+        if not full and known is not None and known[0] == mtimeNs:
+            stack.extend([(d, path) for d in knownSubdirs])
+            continue
+
+        files, subdirs = [], []
+        for entry in os.scandir(path):
+            try:
+                if entry.is_dir(follow_symlinks = False):
+                    subdirs.append(entry.path)
+                elif entry.is_file():
+                    st = entry.stat()
+                    files.append((entry.path, path, entry.name, fileKind(entry.name), st.st_size, st.st_mtime_ns))
+            except OSError as e:
+                # broken links and files removed while listing
+                logging.warning('Skipping %s: %s', entry.path, e)
+
+        conn.execute('DELETE FROM files WHERE dir = ?', (path,))
+        conn.executemany('INSERT OR REPLACE INTO files VALUES (?,?,?,?,?,?)', files)
+        for gone in set(knownSubdirs) - set(subdirs):
+            forgetDir(conn, gone)
+        racy = time.time_ns() - mtimeNs < RACY_NS
+        conn.execute('INSERT OR REPLACE INTO dirs VALUES (?,?,?)', (path, parent, -1 if racy else mtimeNs))
+        stack.extend([(d, path) for d in subdirs])
+        nListed += 1
+
+    return nListed
+
+### tifSummary: worker process entry point, returns (tif path, number of frames or None, error message or '')
+def tifSummary(tifPath):
+    try:
+        return tifPath, tifFrameCount(tifPath), ''
+    except Exception as e:
+        return tifPath, None, '%s: %s' % (type(e).__name__, e)
+
+### smrSummary: worker process entry point, returns (smr path, channel rows, error message or '') from the smr headers only
+###     a channel row is (chan, name, kind, sampling rate or None, units or None, duration in s)
+def smrSummary(smrPath):
+    try:
+        reader = openSmrReader(smrPath)
+    except Exception as e:
+        return smrPath, [], '%s: %s' % (type(e).__name__, e)
+
+    try:
+        rows = []
+        for chan, info in reader.channels.items():
+            isWave = info['kind'] in SON_WAVE_KINDS
+            rows.append((chan, info['title'], SON_KIND_NAMES.get(info['kind'], str(info['kind'])), reader.sampleRate(chan) if isWave else None,
+                         info['units'] if isWave else None, info['maxChanTime']*reader.tickSeconds))
+        return smrPath, rows, ''
+    finally:
+        reader.close()
+
+### refreshSummaries: read the headers of the tif and smr files that are new or changed since they were last summarized
+###     returns the number of files read; the files are read jobs at a time in worker processes
+def refreshSummaries(conn, jobs = 1):
+    conn.execute('DELETE FROM tifs WHERE path NOT IN (SELECT path FROM files)')
+    conn.execute('DELETE FROM smrs WHERE path NOT IN (SELECT path FROM files)')
+    conn.execute('DELETE FROM smrChannels WHERE path NOT IN (SELECT path FROM smrs)')
+
+    stale = '''SELECT f.path, f.size, f.mtimeNs FROM files f LEFT JOIN %s s ON s.path = f.path
+               WHERE f.kind = ? AND (s.path IS NULL OR s.size != f.size OR s.mtimeNs != f.mtimeNs)'''
+    tifTodo = {r[0]: r[1:] for r in conn.execute(stale % 'tifs', ('tif',))}
+    smrTodo = {r[0]: r[1:] for r in conn.execute(stale % 'smrs', ('smr',))}
+    if len(tifTodo) + len(smrTodo) == 0:
+        return 0
+
+    with ProcessPoolExecutor(max_workers = max(jobs, 1)) as pool:
+        tifFutures = [pool.submit(tifSummary, p) for p in tifTodo]
+        smrFutures = [pool.submit(smrSummary, p) for p in smrTodo]
+
+        for future in tifFutures:
+            tifPath, nFrames, err = future.result()
+            conn.execute('INSERT OR REPLACE INTO tifs VALUES (?,?,?,?,?)', (tifPath,) + tuple(tifTodo[tifPath]) + (nFrames, err))
+
+        for future in smrFutures:
+            smrPath, rows, err = future.result()
+            duration = max([r[5] for r in rows]) if len(rows) > 0 else None
+            conn.execute('INSERT OR REPLACE INTO smrs VALUES (?,?,?,?,?,?)', (smrPath,) + tuple(smrTodo[smrPath]) + (len(rows), duration, err))
+            conn.execute('DELETE FROM smrChannels WHERE path = ?', (smrPath,))
+            conn.executemany('INSERT INTO smrChannels VALUES (?,?,?,?,?,?,?)', [(smrPath,) + r for r in rows])
+
+    return len(tifTodo) + len(smrTodo)
+
+### parseImageName: labels of an image from its file name {dataset}_{ID}_ses-{type}_{date}_{run}_{task}_part-{partNumber}, None if it does not match
+def parseImageName(image):
+    labels = image.split('_')
+    if len(labels) != 7 or not labels[6].startswith('part-'):
+        return None
+    dataset, animal, session, date, run, task, part = labels
+    try:
+        partNum = int(part.split('-')[-1])
+    except ValueError:
+        return None
+    return {'dataset': dataset, 'animal': animal, 'session': session, 'date': date, 'run': run, 'task': task, 'part': partNum}
+
+### imageOutDir: directory the pipeline writes the outputs of an image to (see genTrigsNii.processSession)
+def imageOutDir(opDir, image, labels):
+    return os.path.join(opDir, labels['dataset'], labels['session'], labels['animal'], 'ca2', image.split('_part')[0], 'part-'+str(labels['part']).zfill(2))
+
+### refreshImages: rebuild the images table from the tifs below the raw data directories
+def refreshImages(conn):
+    rawRoots = [r[0] for r in conn.execute("SELECT path FROM roots WHERE role = 'raw'")]
+    opRoots = [r[0] for r in conn.execute("SELECT path FROM roots WHERE role = 'output'")]
+    opDir = opRoots[0] if len(opRoots) > 0 else None
+
+    rows = []
+    for rawRoot in rawRoots:
+        clause, params = subtreeClause('dir', rawRoot)
+        for tifPath, name in conn.execute("SELECT path, name FROM files WHERE kind = 'tif' AND " + clause + ' ORDER BY path', params):
+            image = name.split('.')[0]
+            labels = parseImageName(image)
+            if labels is None:
+                rows.append((image, tifPath) + (None,)*8)
+            else:
+                outDir = imageOutDir(opDir, image, labels) if opDir is not None else None
+                rows.append((image, tifPath, labels['dataset'], labels['animal'], labels['session'], labels['date'], labels['run'],
+                             labels['task'], labels['part'], outDir))
+
+    conn.execute('DELETE FROM images')
+    conn.executemany('INSERT OR REPLACE INTO images VALUES (?,?,?,?,?,?,?,?,?,?)', rows)
+
+### refreshControlSheet: copy the control sheet into the controlSheet table if it changed since the last refresh
+def refreshControlSheet(conn):
+    row = conn.execute("SELECT path, mtimeNs FROM roots WHERE role = 'controlSheet'").fetchone()
+    if row is None:
+        return False
+    sheetPath, knownMtime = row
+    if not os.path.isfile(sheetPath):
+        conn.execute('DROP TABLE IF EXISTS controlSheet')
+        return False
+    mtimeNs = os.stat(sheetPath).st_mtime_ns
+    if mtimeNs == knownMtime:
+        return False
+
+    pd.read_csv(sheetPath).to_sql('controlSheet', conn, if_exists = 'replace', index = False)
+    conn.execute('UPDATE roots SET mtimeNs = ? WHERE path = ?', (mtimeNs, sheetPath))
+    return True
+
+### refreshIndex: register the given directories and control sheet, then bring the whole index up to date
+###     the raw data directory, output directory and control sheet are remembered, so later refreshes need no arguments
+def refreshIndex(conn, orgDir = None, opDir = None, controlSheet = None, full = False, jobs = 1):
+    with conn:
+        for path, role in [(orgDir, 'raw'), (opDir, 'output'), (controlSheet, 'controlSheet')]:
+            if path is not None:
+                path = os.path.abspath(path)
+                for old, in conn.execute('SELECT path FROM roots WHERE role = ? AND path != ?', (role, path)).fetchall():
+                    forgetDir(conn, old)
+                    conn.execute('DELETE FROM roots WHERE path = ?', (old,))
+                conn.execute('INSERT OR IGNORE INTO roots VALUES (?,?,NULL)', (path, role))
+
+    counts = {'dirsListed': 0}
+    for root, in conn.execute("SELECT path FROM roots WHERE role IN ('raw', 'output')").fetchall():
+        # commit after each tree, so an interrupted refresh keeps the trees that were done
+        with conn:
+            counts['dirsListed'] += refreshTree(conn, root, full)
+    with conn:
+        counts['headersRead'] = refreshSummaries(conn, jobs)
+        refreshImages(conn)
+        counts['controlSheetRead'] = refreshControlSheet(conn)
+    return counts
+
+### pipelineIndex: connection of this process to the index used by the pipeline, None if the pipeline does not use the index
+###     each process opens its own connection, since a connection cannot be shared with forked worker processes
+def pipelineIndex():
+    global pipelineConn
+    if os.environ.get('CA2_USE_INDEX', '0') != '1':
+        return None
+    if pipelineConn[1] != os.getpid():
+        pipelineConn = (openIndex(), os.getpid())
+    return pipelineConn[0]
+
+### refreshPipelineIndex: refresh the index used by the pipeline, registering orgDir, opDir and the control sheet unless the directories
+###     lie within ones registered before (so a run on part of the data does not replace the indexed trees); returns the refresh counts,
+###     None if the pipeline does not use the index
+def refreshPipelineIndex(orgDir = None, opDir = None, controlSheet = None, jobs = 1):
+    conn = pipelineIndex()
+    if conn is None:
+        return None
+
+    def newRoot(path, role):
+        if path is None:
+            return None
+        path = os.path.abspath(path)
+        for root, in conn.execute('SELECT path FROM roots WHERE role = ?', (role,)).fetchall():
+            if path == root or path.startswith(root + os.sep):
+                return None
+        return path
+
+    counts = refreshIndex(conn, newRoot(orgDir, 'raw'), newRoot(opDir, 'output'), controlSheet, jobs = jobs)
+    print('Index', defaultIndexPath(), 'refreshed: listed', counts['dirsListed'], 'changed directories, read', counts['headersRead'], 'tif/smr headers')
+    return counts
+
+### indexedListing: (subdirectory names, file names) of a directory from the index, None if it is not indexed or changed since it was listed
+def indexedListing(conn, path):
+    path = os.path.abspath(path)
+    row = conn.execute('SELECT mtimeNs FROM dirs WHERE path = ?', (path,)).fetchone()
+    try:
+        mtimeNs = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+    if row is None or row[0] != mtimeNs:
+        return None
+    dirs = [os.path.basename(r[0]) for r in conn.execute('SELECT path FROM dirs WHERE parent = ?', (path,))]
+    files = [r[0] for r in conn.execute('SELECT name FROM files WHERE dir = ?', (path,))]
+    return dirs, files
+
+### indexedGlob: glob.glob(pattern), with the directories it has to list taken from the index when they are up to date in it
+###     falls back to glob.glob as soon as one of them is not; '**' patterns and patterns without wildcards always use glob.glob
+def indexedGlob(pattern):
+    conn = pipelineIndex()
+    parts = pattern.rstrip(os.sep).split(os.sep)
+    magic = [i for i, part in enumerate(parts) if glob.has_magic(part)]
+    if conn is None or len(magic) == 0 or '**' in pattern:
+        return glob.glob(pattern)
+
+    # matches as (path as glob would return it, absolute path), one path component at a time from the last one without wildcards
+    base = os.sep.join(parts[:magic[0]]) or (os.sep if pattern.startswith(os.sep) else '')
+    matches = [(base, os.path.abspath(base or os.curdir))]
+    dirsOnly = pattern.endswith(os.sep)
+    for i in range(magic[0], len(parts)):
+        part, last = parts[i], i == len(parts) - 1
+        nextMatches = []
+        for shown, path in matches:
+            listing = indexedListing(conn, path)
+            if listing is None:
+                return glob.glob(pattern)
+            names = listing[0] if dirsOnly or not last else listing[0] + listing[1]
+            # like glob, wildcards do not match hidden names
+            names = [n for n in names if fnmatch.fnmatchcase(n, part) and (part.startswith('.') or not n.startswith('.'))]
+            nextMatches.extend([(os.path.join(shown, n), os.path.join(path, n)) for n in names])
+        matches = nextMatches
+    return [shown + os.sep if dirsOnly else shown for shown, _ in matches]
+
+### indexedWalk: os.walk(top), with the directories that are up to date in the index taken from it and the others listed from the
+###     file system; as in the index, links to directories are neither listed nor followed
+def indexedWalk(top):
+    conn = pipelineIndex()
+    if conn is None:
+        yield from os.walk(top)
+        return
+
+    stack = [top]
+    while len(stack) > 0:
+        path = stack.pop()
+        listing = indexedListing(conn, path)
+        if listing is None:
+            try:
+                entries = list(os.scandir(path))
+            except OSError:
+                continue
+            listing = ([e.name for e in entries if e.is_dir(follow_symlinks = False)],
+                       [e.name for e in entries if not e.is_dir(follow_symlinks = False) and e.is_file()])
+        dirs, files = listing
+        yield path, dirs, files
+        stack.extend([os.path.join(path, d) for d in reversed(dirs)])
+
+### indexedExists: for each path, True if it is a file, answered from the index for the directories that are up to date in it
+###     each directory is looked up once, however many of the paths are in it
+def indexedExists(paths):
+    conn = pipelineIndex()
+    if conn is None:
+        return [os.path.isfile(p) for p in paths]
+
+    listings = {}
+    exists = []
+    for p in paths:
+        parent, name = os.path.split(os.path.abspath(p))
+        if parent not in listings:
+            listing = indexedListing(conn, parent)
+            listings[parent] = None if listing is None else set(listing[1])
+        exists.append(os.path.isfile(p) if listings[parent] is None else name in listings[parent])
+    return exists
+
+### frameCount: number of frames of a tif, from the index used by the pipeline when it is up to date for the tif, otherwise from its header
+###     (tifIO.tifFrameCount, which raises TifHeaderError for a tif it cannot read)
+def frameCount(tifPath):
+    conn = pipelineIndex()
+    nFrames = indexedFrameCount(conn, tifPath) if conn is not None else None
+    return tifFrameCount(tifPath) if nFrames is None else nFrames
+
+### indexedFrameCount: number of frames of a tif from the index, None if it is not indexed or changed since it was indexed
+def indexedFrameCount(conn, tifPath):
+    tifPath = os.path.abspath(tifPath)
+    row = conn.execute('SELECT size, mtimeNs, nFrames FROM tifs WHERE path = ?', (tifPath,)).fetchone()
+    if row is None:
+        return None
+    st = os.stat(tifPath)
+    if row[0] != st.st_size or row[1] != st.st_mtime_ns:
+        return None
+    return row[2]
+
+### partStages: one row per image with a 0/1 column per pipeline stage (see STAGE_FILES), telling whether its output file exists
+def partStages(conn, match = ''):
+    cols = ', '.join(["EXISTS (SELECT 1 FROM files f WHERE f.dir = i.outDir AND f.name = '%s') AS %s" % (fName, stage)
+                      for stage, fName in STAGE_FILES.items()])
+    query = 'SELECT i.image, t.nFrames, %s FROM images i LEFT JOIN tifs t ON t.path = i.tifPath WHERE i.image LIKE ? ORDER BY i.image' % cols
+    return pd.read_sql_query(query, conn, params = ('%' + match + '%',))
+
+### missingOutputs: images (and their output directory) whose output directory lacks the file called fileName
+def missingOutputs(conn, fileName, match = ''):
+    query = '''SELECT i.image, i.outDir FROM images i WHERE i.image LIKE ?
+               AND NOT EXISTS (SELECT 1 FROM files f WHERE f.dir = i.outDir AND f.name = ?) ORDER BY i.image'''
+    return pd.read_sql_query(query, conn, params = ('%' + match + '%', fileName))
+
+### crossedImages: images flagged with CrossedTrigs in the control sheet, with the session (dataset, session, animal, date, run) they belong to
+def crossedImages(conn, match = ''):
+    if conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'controlSheet'").fetchone() is None:
+        raise Exception('No control sheet in the index, refresh it with --controlSheet')
+    query = '''SELECT c.Img AS image, i.dataset, i.session, i.animal, i.date, i.run FROM controlSheet c LEFT JOIN images i ON i.image = c.Img
+               WHERE c.CrossedTrigs = 1 AND c.Img LIKE ? ORDER BY c.Img'''
+    return pd.read_sql_query(query, conn, params = ('%' + match + '%',))
+
+### printTable: print a query result in full
+def printTable(df):
+    if df.shape[0] == 0:
+        print('(no rows)')
+    else:
+        print(df.to_string(index = False))
+
+
+if __name__ == '__main__':
+
+    parser=argparse.ArgumentParser(description='Build and query the index of raw data and pipeline outputs')
+    parser.add_argument('--db',type = str, help='path to the index database, default CA2_INDEX_DB or dataIndex.sqlite in the cache directory', default = None)
+    subparsers = parser.add_subparsers(dest = 'command', required = True)
+
+    refreshParser = subparsers.add_parser('refresh', help = 'update the index from the file system, only listing directories that changed')
+    refreshParser.add_argument('orgDir',type = str, nargs = '?', help="Path to organized raw data directory, default the one indexed before", default = None)
+    refreshParser.add_argument('--opDir',type = str, help='Path to output directory, often the preprocessing directory', default = None)
+    refreshParser.add_argument('--controlSheet',type = str, help='Path to the csv file which controls the semi automatic generation of trigger files', default = None)
+    refreshParser.add_argument('--full',action = 'store_true', help='list every directory, also those whose modification time did not change')
+    refreshParser.add_argument('--jobs',type = int, help='number of worker processes reading tif and smr headers, default all cores', default = os.cpu_count())
+
+    stagesParser = subparsers.add_parser('stages', help = 'list every image with its frame count and which stage outputs exist')
+    stagesParser.add_argument('--match',type = str, help='only images whose name contains this string', default = '')
+
+    missingParser = subparsers.add_parser('missing', help = 'list the images whose output directory lacks a file, e.g. rawsignl.nii.gz')
+    missingParser.add_argument('fileName',type = str, help='name of the output file')
+    missingParser.add_argument('--match',type = str, help='only images whose name contains this string', default = '')
+
+    crossedParser = subparsers.add_parser('crossed', help = 'list the images flagged with CrossedTrigs in the control sheet and their sessions')
+    crossedParser.add_argument('--match',type = str, help='only images whose name contains this string', default = '')
+
+    sqlParser = subparsers.add_parser('sql', help = 'run an SQL query on the index')
+    sqlParser.add_argument('query',type = str, help='SQL query, e.g. "SELECT * FROM tifs WHERE error != \'\'"')
+
+    args=parser.parse_args()
+    conn = openIndex(args.db)
+
+    if args.command == 'refresh':
+        if args.orgDir is None and conn.execute("SELECT path FROM roots WHERE role = 'raw'").fetchone() is None:
+            parser.error('the first refresh needs the organized raw data directory')
+        counts = refreshIndex(conn, args.orgDir, args.opDir, args.controlSheet, full = args.full, jobs = args.jobs)
+        print('Listed', counts['dirsListed'], 'changed directories, read', counts['headersRead'], 'tif/smr headers',
+              '(control sheet re-read)' if counts['controlSheetRead'] else '')
+
+    elif args.command == 'stages':
+        printTable(partStages(conn, args.match))
+
+    elif args.command == 'missing':
+        printTable(missingOutputs(conn, args.fileName, args.match))
+
+    elif args.command == 'crossed':
+        printTable(crossedImages(conn, args.match))
+
+    elif args.command == 'sql':
+        printTable(pd.read_sql_query(args.query, conn))
+
+    conn.close()
@@ -4,9 +4,12 @@ import re
 import logging
 import time
 import subprocess as subp
+from io import StringIO
+import contextlib
+import traceback
+from concurrent.futures import ProcessPoolExecutor
 from scipy import io,signal
 import numpy as np
-import glob
 import pdb
 import argparse 
 import natsort
@@ -17,269 +20,57 @@ from dateutil.relativedelta import relativedelta
 from skimage import filters
 from sklearn import cluster
 import nibabel as nb
-import matplotlib
-import neo
-
-# plotting quality control figures: choose where to output them based on display settings
-if (os.name == 'posix' and "DISPLAY" in os.environ) or (os.name == 'nt'):
-    from matplotlib import pyplot as plt
-    import seaborn as sns
-
-elif os.name == 'posix' and "DISPLAY" not in os.environ:
-    matplotlib.use('agg')
-    from matplotlib import pyplot as plt
-    import seaborn as sns
-
-### smrToTable: convert smr channel data to pandas dataframe format
+from functools import partial
+from smrTrigs import SmrDecoder
+from tifIO import TifHeaderError, openTifMovie, iterTifFrames
+from dataIndex import frameCount, indexedGlob, indexedWalk, refreshPipelineIndex, setIndexOptions
+from niiIO import NiftiGzWriter, OUTPUT_DTYPES, OutputDtypeError, applyOutputDtype, saveNii, setGzipOptions
+from tsCache import getMeanTS, getPreviewMeanTS, getPreviewStep, setCacheDir, setPreviewStep, setSummaryOptions
+from buildManifest import isDryRun, needsBuild, recordBuild, setBuildOptions, willExist
+from controlSheet import ControlSheet, flagCrossedTrigs
+# quality control figures are drawn headless on an Agg canvas, optionally by worker processes (see qcRender)
+from qcRender import TRIG_STYLES, fitLabels, renderTimeSeries, setQcOptions, waitQcRenders
+from qcReport import writeQcReport
+from trigSplit import splitTrace
+
+# with --preview, the first pass QC of an image uses its preview mean time series only when a gap split of it is at least this confident
+PREVIEW_MIN_CONFIDENCE = 0.8
+
+### smrToTable: convert smr channel data to pandas dataframe format, see smrTrigs.SmrDecoder
 def smrToTable(smrPath, trigName = 'Trigger', cyanName = 'LED1', uvName = 'LED2', ledStimName = 'stim_LED', pawStimName = 'stim_Paw'):
-    # read in smr file using the cedIO class and convert information to array/dataframe format
-    print('********************************************')
-    print('scanning smr file...')
-    print('********************************************')
-    readSmr = neo.io.CedIO(smrPath)
-    blockObj = readSmr.read(lazy=False)[0]
-    data = [np.array(asig.data).squeeze() for seg in blockObj.segments for asig in seg.analogsignals]
-    infoDf = pd.DataFrame(np.array([sc for sc in readSmr.header['signal_channels']]))
-    print('channel information for', smrPath)
-    print(infoDf)
-    err=''
-
-    if all([chanName in infoDf.name.values for chanName in [trigName,cyanName,uvName]]):
-
-        trigInd = int(infoDf[infoDf.name == trigName].stream_id.values[0])
-        led1Ind = int(infoDf[infoDf.name == cyanName].stream_id.values[0])
-        led2Ind = int(infoDf[infoDf.name == uvName].stream_id.values[0])
-
-        channelCheck = [data[ind].squeeze().max()> 4 for ind in [trigInd,led1Ind,led2Ind]]
-
-        if all(channelCheck):
-
-            chan1bin=data[trigInd].squeeze() > 4
-            findx=np.where(chan1bin)
-            findx=findx[0]
-            firstTrigStart=findx[0]
-            lastTrigStart=findx[-249]
-
-            if (lastTrigStart - firstTrigStart)/25000 > 550:
-                # channel 3 is cyan data, channel 4 is the uv data
-                chan3bin=np.squeeze(data[led1Ind] > 4)
-                chan3bin=chan3bin[firstTrigStart:lastTrigStart+24999]
-                chan3bin=chan3bin*2
-
-                chan4bin=np.squeeze(data[led2Ind] > 4)
-                chan4bin=chan4bin[firstTrigStart:lastTrigStart+24999]
-
-                if chan4bin.shape[0] > chan3bin.shape[0]:
-                    chan4bin = chan4bin[:chan3bin.shape[0]]
-                elif chan4bin.shape[0] < chan3bin.shape[0]:
-                    chan3bin = chan3bin[:chan4bin.shape[0]]
-
-                combineLED=chan3bin+chan4bin
-                combineLEDDiff = np.diff(combineLED)
-                combineLEDNonzeroDiff = np.where(combineLEDDiff)[0]
-
-                compressCombineLED = combineLED[combineLEDNonzeroDiff]
-
-                nonZeroTrigs = np.where(compressCombineLED)[0]
-
-                opticalOrder = compressCombineLED[nonZeroTrigs]                  
-
-                consecutiveTriggers=np.sum(np.diff(opticalOrder.squeeze()) == 0) 
-
-                opTableOptical=pd.DataFrame({'opticalOrder':opticalOrder})
-
-            else:
-                err = err+'#length of trig channel less than 550 sec#'
-                opTableOptical = False
-                consecutiveTriggers = 0
-        else:
-            err = err+'#trig/led1/led2 channel empty#'
-            opTableOptical = False
-            consecutiveTriggers = 0 
+    smrDecoder = SmrDecoder(smrPath, trigName, cyanName, uvName, ledStimName, pawStimName)
+    return smrDecoder.opTableOptical, smrDecoder.opTableStim, smrDecoder.consecutiveTriggers, smrDecoder.err
 
-    else:
-        err = err+'#trig/led1/led2 channel empty#'
-        opTableOptical = False
-        consecutiveTriggers = 0 
-
-    if ledStimName in infoDf.name.values:
-        
-        ledStimInd = int(infoDf[infoDf.name == ledStimName].stream_id.values[0])
-        ledStimFlag = data[ledStimInd].squeeze().max() > 4
-    else:
-        ledStimFlag = False
-
-    if pawStimName in infoDf.name.values: 
-        pawStimFlag = True
-
-        pawStimInd = int(infoDf[infoDf.name == pawStimName].stream_id.values[0])
-        pawStimFlag = data[pawStimInd].squeeze().max() > 4
-    else:
-        pawStimFlag = False
-
-    chan1=data[trigInd].squeeze()
-    chan1DS=signal.resample_poly(chan1,1,25000) 
-    chan1DSBin = chan1DS > 0.03
-
-    opTableStim=pd.DataFrame({})
-
-    if ledStimFlag and chan1DSBin.sum() > 200:
-        #print('Max val LED stim channel: ', dct['head12']['max'])
-        chan12=data[ledStimInd].squeeze()
-        chan12DS=signal.resample_poly(chan12,960,1000000)
-        chan12DSBin = chan12DS > 10000
-        chan12DSBin=chan12DSBin.astype(int)
-
-        chan12DSBin=chan12DSBin[:chan1DSBin.shape[0]]
-        chan12DSBin=chan12DSBin[chan1DSBin]
-        opTableStim['ledStim'] = chan12DSBin
-    else:
-        err = err+'#ledStim channel empty or fewer than 200 triggers#'
-        #print('Max val LED stim channel: ', dct['head12']['max'])
-        #print('Num trigs in downsampled channel 1: ', chan1DSBin.sum())
-         
-
-    if pawStimFlag and (chan1DSBin.sum() == 600):
-        print('entered this if statement')
-        chan13=data[pawStimInd].squeeze()
-        chan13DS=signal.resample_poly(chan13,960,1000000)
-        chan13DSBin = chan13DS > 10000
-        chan13DSBin=chan13DSBin.astype(int)
-        chan13DSBin=chan13DSBin[:chan1DSBin.shape[0]]
-        chan13DSBin=chan13DSBin[chan1DSBin]
-        opTableStim['pawStim'] = chan13DSBin
-    #else:
-    #    err = err+'#pawStim channel empty or not exactly 600 triggers#'
-
-    if len(opTableStim.columns) == 0:
-        opTableStim = False   
-
-    if err == '':
-        err = '#no error#'
-
-    return opTableOptical, opTableStim, consecutiveTriggers, err
-
-### smrToTable2: alternative function that attempts to generate table from smr file without using channel 1
+### smrToTable2: like smrToTable, but returns the consecutive trigger mask instead of the stim table and error flags
 def smrToTable2(smrPath, trigName = 'Trigger', cyanName = 'LED1', uvName = 'LED2', ledStimName = 'stim_LED', pawStimName = 'stim_Paw'):
-   
-    readSmr = neo.io.CedIO(smrPath)
-    blockObj = readSmr.read(lazy=False)[0]
-    data = [np.array(asig.data).squeeze() for seg in blockObj.segments for asig in seg.analogsignals]
-    infoDf = pd.DataFrame(np.array([sc for sc in readSmr.header['signal_channels']]))
-
-    err=''
-
-    if all([chanName in infoDf.name.values for chanName in [trigName,cyanName,uvName]]):
-
-        trigInd = int(infoDf[infoDf.name == trigName].stream_id.values[0])
-        led1Ind = int(infoDf[infoDf.name == cyanName].stream_id.values[0])
-        led2Ind = int(infoDf[infoDf.name == uvName].stream_id.values[0])
-
-        channelCheck = [data[ind].squeeze().max()> 4 for ind in [trigInd,led1Ind,led2Ind]]
-
-        if all(channelCheck):
-
-            chan1bin=data[trigInd].squeeze() > 4
-            findx=np.where(chan1bin)
-            findx=findx[0]
-            firstTrigStart=findx[0]
-            lastTrigStart=findx[-249]
-
-            if (lastTrigStart - firstTrigStart)/25000 > 550:
-
-                #chan1xbin=chan1bin(findx(1):findx(end)+24749);
-                #y=downsample(chan1xbin,250);
-
-                chan3bin=np.squeeze(data[led1Ind] > 4)
-                chan3bin=chan3bin[firstTrigStart:lastTrigStart+24999]
-                chan3bin=chan3bin*2
+    smrDecoder = SmrDecoder(smrPath, trigName, cyanName, uvName, ledStimName, pawStimName)
+    return smrDecoder.opTableOptical, False, smrDecoder.consecutiveTriggers, smrDecoder.consecMask
 
-                chan4bin=np.squeeze(data[led2Ind] > 4)
-                chan4bin=chan4bin[firstTrigStart:lastTrigStart+24999]
-
-                if chan4bin.shape[0] > chan3bin.shape[0]:
-                    chan4bin = chan4bin[:chan3bin.shape[0]]
-                elif chan4bin.shape[0] < chan3bin.shape[0]:
-                    chan3bin = chan3bin[:chan4bin.shape[0]]
-        
-                combineLED=chan3bin+chan4bin
-                combineLEDDiff = np.diff(combineLED)
-                combineLEDNonzeroDiff = np.where(combineLEDDiff)[0]
-
-                compressCombineLED = combineLED[combineLEDNonzeroDiff]
-
-                nonZeroTrigs = np.where(compressCombineLED)[0]
-
-                opticalOrder = compressCombineLED[nonZeroTrigs]
-                   
-                whereConsec = np.diff(opticalOrder.squeeze()) == 0
-                
-                sumConsecTrigs=np.sum(np.diff(opticalOrder.squeeze()) == 0) 
-                
-                whereConsec = np.insert(whereConsec,False,False,axis=0)
-
-                if len(whereConsec) != len(opticalOrder):
-                    raise Exception('Consecutive trigger mask different length to trigger array')
-
-                opTableOptical=pd.DataFrame({'opticalOrder':opticalOrder})
-
-            else:
-                opTableOptical = False
-                sumConsecTrigs = 0
-                whereConsec = None
-        else:
-            opTableOptical = False
-            sumConsecTrigs = 0
-            whereConsec = None
-
-    else:
-        opTableOptical = False
-        sumConsecTrigs = 0
-        whereConsec = None
-
-    return opTableOptical,False,sumConsecTrigs,whereConsec
-
-### getNframesTif: get the number of image frames in the TIF file specified by tifPath
+### getNframesTif: get the number of image frames in the TIF file specified by tifPath, from the data index when it is up to date for the
+###     file, otherwise from its header only (see dataIndex.frameCount); raises tifIO.TifHeaderError if the file is truncated or corrupt
 def getNframesTif(tifPath):
-    img = Image.open(tifPath)
-    
-    try:
-        nFrames = img.n_frames
-    except SyntaxError as e:
-        logging.exception(e)
-        nFrames = 'unknown'
- 
-    return nFrames
+    return frameCount(tifPath)
+
+### qcMeanTS: mean time series of a tif for the QC figures and trigger estimates; with preview set and previews on (--preview), the mean of a
+###     sparse grid of pixels of each frame, unless a gap split of it is not confident enough to tell the wavelengths apart (then the full mean)
+def qcMeanTS(tifPath, saveMean = True, preview = False):
+    if preview and getPreviewStep() > 0:
+        previewTS = getPreviewMeanTS(tifPath, store = saveMean)
+        confidence = splitTrace(previewTS)[1]
+        if confidence >= PREVIEW_MIN_CONFIDENCE:
+            return previewTS
+        print('Preview of', tifPath, 'has split confidence', round(confidence,3), ', reading the full frames')
+    return getMeanTS(tifPath, store = saveMean)
 
 ### produceEstimateTriggers: called by autoTrigs, assign frames to a wavelength based on mean intensity
-def produceEstimateTriggers(ipTiff, histSd = 8,histSd2 = 8,saveMean=True, splitMethod = 'filter', dbscanEps = 100):
-
-    opMeanPath = ipTiff.split('.')[0]+'MeanTS.npy'
-
-    if not os.path.isfile(opMeanPath):
-
-        img = Image.open(ipTiff)
-        imgl = []
+###     with preview set, the estimate may come from the preview mean time series (see qcMeanTS)
+def produceEstimateTriggers(ipTiff, histSd = 8,histSd2 = 8,saveMean=True, splitMethod = 'filter', dbscanEps = 100, preview = False):
 
-        try:
-            for page in ImageSequence.Iterator(img):
-                imgl.append(page.convert(mode='F'))
-        except TypeError as e:
-            logging.exception(e)
-            return False,False,False
-
-        movie = np.empty((imgl[0].size[1], imgl[0].size[0], len(imgl))) #np arrays have 1st index as rows
-        for i in range(len(imgl)):
-            movie[:,:,i] = np.array(imgl[i])
-
-        movieRes = movie.reshape([512*500,-1])
-        meanTS = movieRes.mean(axis = 0)
-
-        if saveMean:
-            np.save(opMeanPath,meanTS)
-
-    else:
-        meanTS = np.load(opMeanPath)
+    try:
+        meanTS = qcMeanTS(ipTiff, saveMean = saveMean, preview = preview)
+    except (TypeError,ValueError) as e:
+        logging.exception(e)
+        return False,False,False
 
     if splitMethod == 'filter':
         meanTsMean = meanTS.mean()
@@ -342,25 +133,25 @@ def produceEstimateTriggers(ipTiff, histSd = 8,histSd2 = 8,saveMean=True, splitM
             print('Clustering solution gave greater than or fewer than 3 clusters')
             return False,False,False
 
+    elif splitMethod == 'gap':
+        # no tuning needed; histSd sets how many robust standard deviations from its wavelength a frame has to be to count as dropped
+        colorAuto, confidence, threshold = splitTrace(meanTS, outlierSd = histSd)
+        print('Gap split of', ipTiff, 'at', round(threshold,2), 'with confidence', round(confidence,3))
+
     else:
-        raise Exception('splitMethod must be "filter" or "dbscan"')
+        raise Exception('splitMethod must be "filter", "dbscan" or "gap"')
 
     opCsv = pd.DataFrame({'opticalOrder':list(map(int,colorAuto))})
    
     return meanTS, colorAuto, opCsv
 
 ### makeWriteOpticalCsvs: generate trigger dataframes for each image
-def makeWriteOpticalCsvs(connDct,opOpticalTable,csvPaths):
+def makeWriteOpticalCsvs(connDct,opTableOptical,csvPaths,k):
     try:
         lengths = [getNframesTif(cD) for cD in sorted(connDct[k])]
-    except (AttributeError,TypeError) as e:
-        logging.exception(e)
-        lengths = ['unknown']
-    except PIL.UnidentifiedImageError as e:
-        logging.exception(e)
-        lengths = ['unknown']
-    if any(le == 'unknown' for le in lengths):
-        print('images attached to',k,'cannot be read')
+    except TifHeaderError as e:
+        print('images attached to',k,'cannot be read:',e.path,'is',e.reason,'(offset',str(e.offset)+')')
+        return False
 
     else:
         # TODO: make this more general in case of longer scanning session that has > 3 TIF files
@@ -383,9 +174,18 @@ def makeWriteOpticalCsvs(connDct,opOpticalTable,csvPaths):
             csvOpName = csvPaths[ind]
             subOpticalTable.to_csv(csvOpName)
             print('#### Wrote Optical Triggers to: ',csvOpName)
+        return True
+
+### autoTrigsFigure: side by side QC figure of the autoFix (left) and simpFix (right) labels of the frames
+def autoTrigsFigure(pltOpName, meanTS, colorAuto, colSimp, opname = None):
+    autoStyles = [(1, 'b', None), (2, 'y', None), (3, 'r', None)]
+    panels = [(colorAuto, autoStyles, '' if opname is None else 'autoFix '+opname),
+              (colSimp, autoStyles[:2], '' if opname is None else 'simpFix '+opname)]
+    renderTimeSeries(pltOpName, meanTS, panels, figsize = (20,10))
 
 ### autoTrigs: split out cyan and uv wavelength and generate QC figs for verification
-def autoTrigs(connDct, outputTrigs = False, trigOpDir = None, figDir = '', histSd = 8, writeFiles = [1,1,1], histSd2 = 8, splitMethod = 'filter', dbscanEps = 100):
+###     preview is only for figures: the triggers written with outputTrigs are always estimated from the full frames
+def autoTrigs(connDct, outputTrigs = False, trigOpDir = None, figDir = '', histSd = 8, writeFiles = [1,1,1], histSd2 = 8, splitMethod = 'filter', dbscanEps = 100, preview = False):
     if type(connDct) == dict:
         if (type(outputTrigs) == str) and (trigOpDir == None):
             raise Exception('If you want to output triggers please specify a directory')
@@ -398,7 +198,7 @@ def autoTrigs(connDct, outputTrigs = False, trigOpDir = None, figDir = '', histS
             pltOpName = os.path.join(figDir,opname+'meanTSAuto.png')
             if (not os.path.isfile(pltOpName)) or outputTrigs:
 
-                meanTS, colorAuto, opCsv = produceEstimateTriggers(imgPath, histSd = histSd,histSd2 = histSd2,splitMethod = splitMethod,dbscanEps = dbscanEps)
+                meanTS, colorAuto, opCsv = produceEstimateTriggers(imgPath, histSd = histSd,histSd2 = histSd2,splitMethod = splitMethod,dbscanEps = dbscanEps,preview = preview and not outputTrigs)
 
                 if type(meanTS) == bool:
                     return False
@@ -409,43 +209,13 @@ def autoTrigs(connDct, outputTrigs = False, trigOpDir = None, figDir = '', histS
                 val2 = meanTS[1]
 
                 if val1 < val2:
-                    colSimp = [1 if i % 2 else 2 for i in range(0,len(meanTS)) ]
+                    colSimp = np.array([1 if i % 2 else 2 for i in range(0,len(meanTS)) ])
                 else:
-                    colSimp = [2 if i % 2 else 1 for i in range(0,len(meanTS)) ]
+                    colSimp = np.array([2 if i % 2 else 1 for i in range(0,len(meanTS)) ])
 
 
                 if not os.path.isfile(pltOpName):
-
-                    plt.figure(figsize = [20,10])
-                    plt.subplot(1,2,1)
-
-                    for cA in np.unique(colorAuto):
-                        if cA == 1:
-                            col = 'b'
-                        elif cA == 2:
-                            col = 'y'
-                        elif cA == 3:
-                            col = 'r'
-
-                        newTS = meanTS[colorAuto == cA]
-                        xvalsSub = xvals[colorAuto == cA]
-
-                        plt.scatter(xvalsSub,newTS, marker = '.',c=col)
-
-                    plt.subplot(1,2,2)
-                    for cS in np.unique(colSimp):
-                        if cS == 1:
-                            col = 'b'
-                        elif cS == 2:
-                            col = 'y'
-
-                        newTS = meanTS[colSimp == cS]
-                        xvalsSub = xvals[colSimp == cS]
-                        plt.scatter(xvalsSub,newTS, marker = '.',c=col)
-
-                    plt.savefig(pltOpName)
-                    plt.close()
-                    plt.clf()
+                    autoTrigsFigure(pltOpName, meanTS, colorAuto, colSimp)
 
                 else:
                     print('File already exists: ',pltOpName)
@@ -481,7 +251,7 @@ def autoTrigs(connDct, outputTrigs = False, trigOpDir = None, figDir = '', histS
 
         if (not os.path.isfile(pltOpName)) or outputTrigs:
 
-            meanTS, colorAuto, opCsv = produceEstimateTriggers(imgPath, histSd = histSd,histSd2 = histSd2,splitMethod = splitMethod,dbscanEps = dbscanEps)
+            meanTS, colorAuto, opCsv = produceEstimateTriggers(imgPath, histSd = histSd,histSd2 = histSd2,splitMethod = splitMethod,dbscanEps = dbscanEps,preview = preview and not outputTrigs)
 
             if type(meanTS) == bool:
                 return False
@@ -492,44 +262,12 @@ def autoTrigs(connDct, outputTrigs = False, trigOpDir = None, figDir = '', histS
             val2 = meanTS[1]
 
             if val1 < val2:
-                colSimp = [1 if i % 2 else 2 for i in range(0,len(meanTS)) ]
+                colSimp = np.array([1 if i % 2 else 2 for i in range(0,len(meanTS)) ])
             else:
-                colSimp = [2 if i % 2 else 1 for i in range(0,len(meanTS)) ]
+                colSimp = np.array([2 if i % 2 else 1 for i in range(0,len(meanTS)) ])
 
             if not os.path.isfile(pltOpName):
-
-                plt.figure(figsize = [20,10])
-                plt.subplot(1,2,1)
-
-                for cA in np.unique(colorAuto):
-                    if cA == 1:
-                        col = 'b'
-                    elif cA == 2:
-                        col = 'y'
-                    elif cA == 3:
-                        col = 'r'
-
-                    newTS = meanTS[colorAuto == cA]
-                    xvalsSub = xvals[colorAuto == cA]
-
-                    plt.scatter(xvalsSub,newTS, marker = '.',c=col)
-                    plt.xlabel('autoFix '+ opname)
-
-                plt.subplot(1,2,2)
-                for cS in np.unique(colSimp):
-                    if cS == 1:
-                        col = 'b'
-                    elif cS == 2:
-                        col = 'y'
-
-                    newTS = meanTS[colSimp == cS]
-                    xvalsSub = xvals[colSimp == cS]
-                    plt.scatter(xvalsSub,newTS, marker = '.',c=col)
-                    plt.xlabel('simpFix ' + opname)
-
-                plt.savefig(pltOpName)
-                plt.close()
-                plt.clf()
+                autoTrigsFigure(pltOpName, meanTS, colorAuto, colSimp, opname)
 
             else:
                 print('File already exists: ',pltOpName)
@@ -556,30 +294,24 @@ def autoTrigs(connDct, outputTrigs = False, trigOpDir = None, figDir = '', histS
 
 ### splitTif: split out the cyan and UV wavelengths; cyan is every odd frame, uv is every even frame
 def splitTif(tifPath, trigFilePath, mcRef = False):
-    img = Image.open(tifPath)
-    imgl = []
-    for page in ImageSequence.Iterator(img):
-        imgl.append(page.convert(mode='F'))
-
-    movie = np.empty((imgl[0].size[1], imgl[0].size[0], len(imgl))) #np arrays have 1st index as rows
-    for i in range(len(imgl)):
-        movie[:,:,i] = np.array(imgl[i])
+    movie = openTifMovie(tifPath) # (frames, rows, cols), memory mapped when the tif is uncompressed
 
     inputTrigs=pd.read_csv(trigFilePath,index_col=0)
 
     opticalOrder=inputTrigs['opticalOrder'].values
 
-    opticalOrder = opticalOrder[:len(imgl)]
+    opticalOrder = opticalOrder[:movie.shape[0]]
 
-    if movie.shape[2] != len(opticalOrder):
+    if movie.shape[0] != len(opticalOrder):
         print('Triggers are not the same length as the movie, cannot split')
         if mcRef:
             return False,False,False,
         else:
             return False,False
     
-    blueMovie = movie[:,:,opticalOrder == 1]
-    uvMovie = movie[:,:,opticalOrder == 2]
+    # only the selected frames are read from disk; move time back to the last axis as the rest of the code expects
+    blueMovie = np.moveaxis(movie[opticalOrder == 1],0,-1)
+    uvMovie = np.moveaxis(movie[opticalOrder == 2],0,-1)
 
     blueMovieSize = blueMovie.shape
     uvMovieSize = uvMovie.shape
@@ -593,22 +325,63 @@ def splitTif(tifPath, trigFilePath, mcRef = False):
     else:
         return blueMovie,uvMovie
 
-### saveNiiLPS: save NIfTI file to the desired filepath
-def saveNiiLPS(arr,opname):
-    arr = arr.squeeze()
-    
-    imgShape = arr.shape
+### splitTifNii: stream the frames of a TIF straight into cyan (signal) and UV (noise) NIfTI files according to the trigger file
+###     frames are read in order and routed by their opticalOrder label, so only one frame is in memory at a time
+###     outDtype is the output dtype policy (see niiIO.OUTPUT_DTYPES); if the frames cannot be stored exactly, float64 is written instead
+def splitTifNii(tifPath, trigFilePath, opPathSignal, opPathNoise, outDtype = 'float64'):
+    inputTrigs=pd.read_csv(trigFilePath,index_col=0)
 
-    if len(imgShape) == 2:
-        arr = arr[:,:,np.newaxis,np.newaxis]
+    opticalOrder=inputTrigs['opticalOrder'].values
 
-    elif len(imgShape) == 3:
-        imgX,imgY,imgT = imgShape
-        arr = np.reshape(arr,[imgX,imgY,1,imgT])
+    nFrames = frameCount(tifPath)
 
-    elif len(imgShape) == 4:
-        pass
+    opticalOrder = opticalOrder[:nFrames]
+
+    if nFrames != len(opticalOrder):
+        print('Triggers are not the same length as the movie, cannot split')
+        return False
 
+    signalWriter = None
+    noiseWriter = None
+
+    try:
+        for frame, label in zip(iterTifFrames(tifPath), opticalOrder):
+            if signalWriter is None:
+                header = applyOutputDtype(lpsHeader(frame.shape + (1,), frame.dtype), outDtype, frame.dtype)
+                signalWriter = NiftiGzWriter(opPathSignal, header)
+                noiseWriter = NiftiGzWriter(opPathNoise, header)
+
+            if label == 1:
+                signalWriter.writeVolume(lpsVolume(frame))
+            elif label == 2:
+                noiseWriter.writeVolume(lpsVolume(frame))
+
+    except OutputDtypeError as e:
+        for w in [signalWriter, noiseWriter]:
+            if w is not None:
+                w.abort()
+        if outDtype == 'float64':
+            raise
+        print('Frames cannot be stored exactly as',outDtype,'(',e,'), writing float64 instead')
+        return splitTifNii(tifPath, trigFilePath, opPathSignal, opPathNoise, outDtype = 'float64')
+    except BaseException:
+        # anything else (e.g. a tif that is corrupt part way through) would fail the same way again, so it is not retried
+        for w in [signalWriter, noiseWriter]:
+            if w is not None:
+                w.abort()
+        raise
+
+    if signalWriter is None:
+        print('No frames could be read from', tifPath, ', cannot split')
+        return False
+
+    signalWriter.close()
+    noiseWriter.close()
+
+    return opPathSignal, opPathNoise
+
+### lpsHeader: NIfTI header of an LPS image with the given volume shape and dtype, as written by saveNiiLPS
+def lpsHeader(volShape, dtype):
     # Op nifti configs
     dimsOp = [0.025,0.025,0.025,1]
     aff = np.eye(4)
@@ -617,138 +390,92 @@ def saveNiiLPS(arr,opname):
     aff = aff * 0.025
     aff[3,3] = 1
 
-    out_image = nb.Nifti1Image(arr, aff)
+    # the header is built from a one volume image so that the flipped affine matches the one nibabel computes for the full image
+    out_image = nb.Nifti1Image(np.zeros(tuple(volShape) + (1,), dtype = dtype), aff)
     out_image.header.set_zooms(dimsOp)
-    
-    out_image = out_image.slicer[::-1,:,::-1,:]
-    
-    nb.save(out_image, opname)
-    
-    return opname
-
-### makeMontageCheckTrig: create final QC figure after NIfTI files have been generated from verified split wavelengths
-def makeMontageCheckTrig(imgFpath,opname,trigs,optimeseries = False,saveMean=True):
-    #inds=np.squeeze(inds)
-    pltOpName = opname+'TSWithTrigs.png'
 
-    if not os.path.isfile(pltOpName):
-
-        opMeanPath = imgFpath.split('.')[0]+'MeanTS.npy'
-
-        if not os.path.isfile(opMeanPath):
-
-            img = Image.open(imgFpath)
-            imgl = []
-
-            try:
-                for page in ImageSequence.Iterator(img):
-                    imgl.append(page.convert(mode='F'))
-            except TypeError as e:
-                logging.exception(e)
-                return False
-
-            if len(trigs) != len(imgl):
-                return False
-
-            movie = np.empty((imgl[0].size[1], imgl[0].size[0], len(imgl))) #np arrays have 1st index as rows
-            for i in range(len(imgl)):
-                movie[:,:,i] = np.array(imgl[i])
+    out_image = out_image.slicer[::-1,:,::-1,:]
 
-            movieRes = movie.reshape([512*500,-1])
-            meanTS = movieRes.mean(axis = 0)
+    return out_image.header
 
-            if saveMean:
-                np.save(opMeanPath,meanTS)
+### lpsVolume: flip a (x, y) frame or (x, y, z) volume the same way lpsHeader flips the affine
+def lpsVolume(vol):
+    if vol.ndim == 2:
+        return vol[::-1,:]
+    return vol[::-1,:,::-1]
 
-        else:
-            meanTS = np.load(opMeanPath)
+### saveNiiLPS: save NIfTI file to the desired filepath, with the dtype given by the outDtype policy (see niiIO.OUTPUT_DTYPES)
+def saveNiiLPS(arr,opname,outDtype = 'float64'):
+    arr = arr.squeeze()
+    
+    imgShape = arr.shape
 
-        maskLabel = np.squeeze(trigs.copy()).astype('int') 
+    if len(imgShape) == 2:
+        arr = arr[:,:,np.newaxis,np.newaxis]
 
-        lenTS = len(meanTS)
+    elif len(imgShape) == 3:
+        imgX,imgY,imgT = imgShape
+        arr = np.reshape(arr,[imgX,imgY,1,imgT])
 
-        timeVector = np.linspace(1,lenTS,lenTS)
+    elif len(imgShape) == 4:
+        pass
 
+    valueRange = None
+    if arr.dtype.kind not in 'ui' and arr.size > 0:
+        valueRange = (np.nanmin(arr), np.nanmax(arr))
 
-        if len(maskLabel) > lenTS:
-            maskLabel = maskLabel[:lenTS]
-        elif len(maskLabel) < lenTS:
-            while maskLabel.shape[0] < lenTS:
-                if maskLabel[-1] == 1:
-                    maskLabel = np.append(maskLabel,1)
-                else:
-                    maskLabel = np.append(maskLabel,2)
-            #raise Exception('Length of ts does not match trigs')
+    # write one volume at a time rather than building a flipped copy of the whole movie
+    try:
+        with NiftiGzWriter(opname, applyOutputDtype(lpsHeader(arr.shape[:3], arr.dtype), outDtype, arr.dtype, valueRange)) as writer:
+            for t in range(arr.shape[3]):
+                writer.writeVolume(lpsVolume(arr[:,:,:,t]))
+    except OutputDtypeError as e:
+        if outDtype == 'float64':
+            raise
+        print('Data cannot be stored exactly as',outDtype,'(',e,'), writing float64 instead')
+        return saveNiiLPS(arr,opname,outDtype = 'float64')
+    
+    return opname
 
+### makeMontageCheckTrig: create final QC figure after NIfTI files have been generated from verified split wavelengths
+###     an existing figure is only replaced if overwrite is set; preview allows the preview mean time series (see qcMeanTS)
+def makeMontageCheckTrig(imgFpath,opname,trigs,optimeseries = False,saveMean=True,overwrite = False,then = None,preview = False):
+    #inds=np.squeeze(inds)
+    pltOpName = opname+'TSWithTrigs.png'
 
-        fig, ax = plt.subplots()
+    if overwrite or not os.path.isfile(pltOpName):
 
-        breakDown = [[1, 'blue', 'Cyan'],[2, 'yellow', 'Ultraviolet'],[3, 'red', 'Dropped']]
+        try:
+            meanTS = qcMeanTS(imgFpath, saveMean = saveMean, preview = preview)
+        except (TypeError,ValueError) as e:
+            logging.exception(e)
+            return False
 
-        for bD in breakDown:
-            trigLabel, color, chanLabel = bD
-            timeVectorMask = timeVector[maskLabel == trigLabel]
-            meanTSMask = meanTS[maskLabel == trigLabel]
-            ax.scatter(timeVectorMask, meanTSMask, c=color, label=chanLabel, alpha=0.3, marker = '.')
+        maskLabel = fitLabels(trigs, len(meanTS))
 
-        ax.legend()
-        plt.savefig(pltOpName)
         if optimeseries:
             np.save(pltOpName.replace('.png','.npy'), meanTS)
-        plt.clf()
-        plt.close()
+        renderTimeSeries(pltOpName, meanTS, [(maskLabel, TRIG_STYLES, '')], legend = True, alpha = 0.3, then = then)
 
     else:
         print('File already exists: ',pltOpName)
 
 ### rawPlot: given original path to image, create a .npy for loading the file, create the raw plot but don't save it
-def rawPlot(imgFpath,opname,optimeseries = False,saveMean=True):
+def rawPlot(imgFpath,opname,optimeseries = False,saveMean=True,preview = False):
     #inds=np.squeeze(inds)
     pltOpName = opname+'TSOnly.png'
 
     if not os.path.isfile(pltOpName):
 
-        opMeanPath = imgFpath.split('.')[0]+'MeanTS.npy'
-
-        if not os.path.isfile(opMeanPath):
-
-            img = Image.open(imgFpath)
-            imgl = []
-
-            try:
-                for page in ImageSequence.Iterator(img):
-                    imgl.append(page.convert(mode='F'))
-            except TypeError as e:
-                logging.exception(e)
-                return False
-
-            movie = np.empty((imgl[0].size[1], imgl[0].size[0], len(imgl))) #np arrays have 1st index as rows
-            for i in range(len(imgl)):
-                movie[:,:,i] = np.array(imgl[i])
-
-            movieRes = movie.reshape([512*500,-1])
-            meanTS = movieRes.mean(axis = 0)
-
-            if saveMean:
-                np.save(opMeanPath,meanTS)
-
-        else:
-            meanTS = np.load(opMeanPath)
-
-        lenTS = len(meanTS)
-
-        timeVector = np.linspace(1,lenTS,lenTS)
-
-        fig, ax = plt.subplots()
-
-        ax.scatter(timeVector, meanTS, marker = '.')
+        try:
+            meanTS = qcMeanTS(imgFpath, saveMean = saveMean, preview = preview)
+        except (TypeError,ValueError) as e:
+            logging.exception(e)
+            return False
 
-        ax.legend()
-        plt.savefig(pltOpName)
         if optimeseries:
             np.save(pltOpName.replace('.png','.npy'), meanTS)
-        plt.clf()
-        plt.close()
+        renderTimeSeries(pltOpName, meanTS, [(None, [(None, 'C0', None)], '')])
 
     else:
         print('File already exists: ',pltOpName)
@@ -778,366 +505,303 @@ def relDelToSecs(relDelObj):
 
     return secCount
 
-### direct invocation of genTrigsNii.py
-###     Given an organized directory of raw data (.tif and .smr files) as the first argument, this program splits the TIF files into 2
-###     wavelengths and converts them to NIfTI file format. This data is output to the filepath specfied in the second argument. It also 
-###     outputs some QC figures to the path specifed by the third argument. Finally, a csv file is created for the user to verify the split was successful.
-### usage: python genTrigsNii.py rawOrganizedData/ preprocOutputDir/ qcFigs/ triggerFix.csv
-if __name__ == '__main__':
-    # ****************************************************************************************************************************
-    # STEP 1: define arguments, parse command line, and assign args to variables
-    # ****************************************************************************************************************************
-    parser=argparse.ArgumentParser(description='Run script to create trigger files and split wavelengths into seperate niftis')
-    parser.add_argument('orgDir',type = str, help="Path to organized raw data directory")
-    parser.add_argument('opDir',type=str,help="Path to output directory, often the preprocessing directory")
-    parser.add_argument('trigQcDir',type=str,help="Path to folder to put quality control figures")
-    parser.add_argument('trigReplaceDf',type=str,help='Path to csv file which controls the semi automatic generation of trigger files')
-    parser.add_argument('--matchTemplate',type=str,help='a string to feed to glob to match certain sessions/cell types for example: SLC/ses-*/animal*/ca2/ will do all SLC data',default='*/*/*/*/')
-    parser.add_argument('--refImage',type=str,help='1 to create ref images, 0 otherwise',default=0)
-    parser.add_argument('--refImage100',type=str,help='1 to create images of 100 frames centered around the ref images, 0 otherwise',default=0)
-
-    args=parser.parse_args()
-
-    orgDir=args.orgDir
-    print('********************************************')
-    print('taking raw data from', orgDir)
-    opDir=args.opDir
-    print('results of wavesplitting will be output to', opDir)
-
-    # create subdirs in trigQCDir for trigger fix and trigger replace figures
-    trigQcDir=args.trigQcDir
+### processSession: match the trigger (.smr) and image (.tif) files of one raw data session folder, write triggers and NIfTI files (STEPS 2-5)
+###     trigSheet is the control sheet (a ControlSheet) as read at the start of the run; returns the names of the images this session flagged with
+###     CrossedTrigs, so that the flags can be merged into the control sheet on disk once all sessions are done
+def processSession(sesh, trigSheet, opDir, trigQcDir, outDtype = 'float64'):
     trigFixQcDir=os.path.join(trigQcDir,'triggerFix')
-    trigRepQcDir=os.path.join(trigQcDir,'triggerReplace')
-    if not os.path.isdir(trigFixQcDir):
-        os.makedirs(trigFixQcDir)
-    if not os.path.isdir(trigRepQcDir):
-        os.makedirs(trigRepQcDir)
-    print('quality control figures will be output to', trigQcDir)
-    print('********************************************')
-    
-    # create a string specifying the format of filepaths containing raw data from each imaging session
-    # default: all paths matching .../orgDir/*/*/*/*
-    matchTemplate=args.matchTemplate
-    sesGlobStr = os.path.join(orgDir,matchTemplate)
-    # find and "naturally sort" all filepaths matching this template
-    sesGlob = natsort.natsorted(glob.glob(sesGlobStr))
-    print('raw data directories are', sesGlob)
-    
-    refImageFlag = int(args.refImage)
-    refImg100Flag = int(args.refImage100)
-
-    # create .csv file if it doesn't exist and convert to a pandas dataframe
-    trigReplaceDfPath=args.trigReplaceDf
-    if os.path.isfile(trigReplaceDfPath):
-        print('Reading existing csv:',trigReplaceDfPath)
-        trigReplaceDf = pd.read_csv(trigReplaceDfPath)
-    else:
-        print('No csv found, generating csv automatically:',trigReplaceDfPath)
-        cols = ['Img','CrossedTrigs','autoFix','simpFix','sdFlag','sdVal','writeImgs','manualOverwrite','splitMethod','dbscanEps']
-        trigReplaceDf = pd.DataFrame(columns = cols)
-        # name each row after the tif image name
-        tifFileNames = [f.split('/')[-1].split('.')[0] for f in natsort.natsorted(glob.glob(sesGlobStr+'/*.tif'))]
-        trigReplaceDf.Img = tifFileNames
-        trigReplaceDf.to_csv(trigReplaceDfPath,index=False)
 
     # This is the ideal template for what tiff files will exist in the organized directory
     # e.g. seven EPIs, with three parts each
     template = [['EPI'+str(eN)+'_','part-0'+str(pn)] for eN in range(1,20) for pn in range(0,4)]
 
+    crossedImgs = []
+
+
     # ****************************************************************************************************************************
     # STEP 2: iterate through raw data folders for each sesssion and match trigger (.smr) files to the corresponding images (.tif)
     # ****************************************************************************************************************************
-    for sesh in sesGlob:
-        # Grab the .smr trigger files and the corresponding .tif image files in the session folder
-        spikeMats = natsort.natsorted(glob.glob(sesh+'*.smr'))
-        tifFiles = natsort.natsorted(glob.glob(sesh+'*.tif'))
+    # Grab the .smr trigger files and the corresponding .tif image files in the session folder
+    spikeMats = natsort.natsorted(indexedGlob(sesh+'*.smr'))
+    tifFiles = natsort.natsorted(indexedGlob(sesh+'*.tif'))
 
-        print('********************************************')
-        print('Trying to automatically create triggers for session: ', sesh)
-        print('********************************************')
+    print('********************************************')
+    print('Trying to automatically create triggers for session: ', sesh)
+    print('********************************************')
 
-        newOrderTifs = tifFiles
-        # newOrderTifs = []
-        # for temp in template:
-        #     tfsTemp = [tF for tF in tifFiles if all(te in tF for te in temp)]
-        #     if len(tfsTemp) == 1:
-        #         newOrderTifs.append(tfsTemp[0])
-        #     else:
-        #         newOrderTifs.append('')
-
-        # Delete any empty entries in newOrderTifs from the back
-        # while newOrderTifs[-1] == '' and len(newOrderTifs) > 1:
-        #     del newOrderTifs[-1]
-        
-        # This dictionary will be used to match smr files to corresponding tif files; the key is the .smr file, and the values are tif files
-        connDct = {}
-
-        # Ideal scenario: each .smr (spikeMat) file corresponds to 3 .tif files
-        if len(spikeMats)*3 == len(newOrderTifs):
-            for count,filename in enumerate(spikeMats):
-                tifInd = count*3
-                connDct[filename] = newOrderTifs[tifInd:tifInd+3]
-
-        # Nonideal scenarios
-        elif len(spikeMats) == 6 and len(newOrderTifs) == 21:
-                dateTimes = [sM.split('/')[-1].split('_')[3] for sM in spikeMats]
-                dateTimes = [datetime.strptime(dT,'%Y-%m-%d-%H-%M-%S') for dT in dateTimes]
-                dTDiff = np.diff(dateTimes)
-                smrNumDiff = np.diff([int(sM.split('_')[-1].split('.')[0]) for sM in spikeMats])
-                dTMax = np.argmax(dTDiff)
-                smrMax = np.argmax(smrNumDiff)
-
-                if dTMax == smrMax:
-                    spikeMats.insert(dTMax+1,'')
-                    for i,sM in enumerate(spikeMats):
-                        startInd = i*3
-                        connDct[sM] = newOrderTifs[startInd:startInd+3]
-
-        elif len(spikeMats) == 8 and len(template) == 8:
-            for i,sM in enumerate(spikeMats):
-                startInd = i*3
-                connDct[sM] = newOrderTifs[startInd:startInd+3]
-
-        # If we dont have a full compliment of tifs, but the number of .mat files
-        # matches up then do it
-        elif (len(newOrderTifs) < 21) and len(spikeMats)*3 == len(newOrderTifs):
-
-            for i,sM in enumerate(spikeMats):
-                startInd = i*3
-                connDct[sM] = newOrderTifs[startInd:startInd+3]
-
-        # Abject failure to match
-        else:
+    newOrderTifs = tifFiles
+    # newOrderTifs = []
+    # for temp in template:
+    #     tfsTemp = [tF for tF in tifFiles if all(te in tF for te in temp)]
+    #     if len(tfsTemp) == 1:
+    #         newOrderTifs.append(tfsTemp[0])
+    #     else:
+    #         newOrderTifs.append('')
+
+    # Delete any empty entries in newOrderTifs from the back
+    # while newOrderTifs[-1] == '' and len(newOrderTifs) > 1:
+    #     del newOrderTifs[-1]
+    
+    # This dictionary will be used to match smr files to corresponding tif files; the key is the .smr file, and the values are tif files
+    connDct = {}
+
+    # Ideal scenario: each .smr (spikeMat) file corresponds to 3 .tif files
+    if len(spikeMats)*3 == len(newOrderTifs):
+        for count,filename in enumerate(spikeMats):
+            tifInd = count*3
+            connDct[filename] = newOrderTifs[tifInd:tifInd+3]
+
+    # Nonideal scenarios
+    elif len(spikeMats) == 6 and len(newOrderTifs) == 21:
+            dateTimes = [sM.split('/')[-1].split('_')[3] for sM in spikeMats]
+            dateTimes = [datetime.strptime(dT,'%Y-%m-%d-%H-%M-%S') for dT in dateTimes]
+            dTDiff = np.diff(dateTimes)
+            smrNumDiff = np.diff([int(sM.split('_')[-1].split('.')[0]) for sM in spikeMats])
+            dTMax = np.argmax(dTDiff)
+            smrMax = np.argmax(smrNumDiff)
+
+            if dTMax == smrMax:
+                spikeMats.insert(dTMax+1,'')
+                for i,sM in enumerate(spikeMats):
+                    startInd = i*3
+                    connDct[sM] = newOrderTifs[startInd:startInd+3]
+
+    elif len(spikeMats) == 8 and len(template) == 8:
+        for i,sM in enumerate(spikeMats):
+            startInd = i*3
+            connDct[sM] = newOrderTifs[startInd:startInd+3]
+
+    # If we dont have a full compliment of tifs, but the number of .mat files
+    # matches up then do it
+    elif (len(newOrderTifs) < 21) and len(spikeMats)*3 == len(newOrderTifs):
+
+        for i,sM in enumerate(spikeMats):
+            startInd = i*3
+            connDct[sM] = newOrderTifs[startInd:startInd+3]
+
+    # Abject failure to match
+    else:
+        try:
+            spikeMatTimes = [datetime.strptime(sM.split('_')[-2], '%Y-%m-%d-%H-%M-%S') for sM in spikeMats]
+            tiffTimes = [datetime.fromtimestamp(os.path.getmtime(tF)) for tF in tifFiles]
             try:
-                spikeMatTimes = [datetime.strptime(sM.split('_')[-2], '%Y-%m-%d-%H-%M-%S') for sM in spikeMats]
-                tiffTimes = [datetime.fromtimestamp(os.path.getmtime(tF)) for tF in tifFiles]
-                try:
-                    matchIndices = [np.argmin([abs(relDelToSecs(relativedelta(sMT,tT))) for tT in tiffTimes]) for sMT in spikeMatTimes]
-
-                    # Order the tiff files as per the ideal template
-                    newOrderTifs = []
-                    for temp in template:
-                        tfsTemp = [tF for tF in tifFiles if all(te in tF for te in temp)]
-                        if len(tfsTemp) == 1:
-                            newOrderTifs.append(tfsTemp[0])
-                        else:
-                            newOrderTifs.append('')
-                
-                    while newOrderTifs[-1] == '' and len(newOrderTifs) > 1:
-                        del newOrderTifs[-1]
-
-                    #pdb.set_trace()
+                matchIndices = [np.argmin([abs(relDelToSecs(relativedelta(sMT,tT))) for tT in tiffTimes]) for sMT in spikeMatTimes]
+
+                # Order the tiff files as per the ideal template
+                newOrderTifs = []
+                for temp in template:
+                    tfsTemp = [tF for tF in tifFiles if all(te in tF for te in temp)]
+                    if len(tfsTemp) == 1:
+                        newOrderTifs.append(tfsTemp[0])
+                    else:
+                        newOrderTifs.append('')
+            
+                while newOrderTifs[-1] == '' and len(newOrderTifs) > 1:
+                    del newOrderTifs[-1]
 
-                    newMatchIndices = [newOrderTifs.index(tifFiles[ind]) for ind in matchIndices]
+                #pdb.set_trace()
 
-                    # This dictionary will be used to match mat files to tif files
-                    connDct = {}
+                newMatchIndices = [newOrderTifs.index(tifFiles[ind]) for ind in matchIndices]
 
-                    for i,Num in enumerate(matchIndices):
-                        connDct[spikeMats[i]] = newOrderTifs[Num:Num+3]
-                except:
-                    print('Error: Could not create connDct')
-                    connDct = {}
+                # This dictionary will be used to match mat files to tif files
+                connDct = {}
 
-            except ValueError as e:
-                logging.exception(e)
+                for i,Num in enumerate(matchIndices):
+                    connDct[spikeMats[i]] = newOrderTifs[Num:Num+3]
+            except:
+                print('Error: Could not create connDct')
                 connDct = {}
 
-        # ****************************************************************************************************************************
-        # STEP 3: populate csv file with trigger details
-        # ****************************************************************************************************************************   
-        if len(connDct.keys()) > 0:
-            for k in connDct.keys():
-                # ****************************
-                # Ideal scenario: each .smr (spikeMat) file corresponds to 3 .tif files
-                # ****************************
-                if len(connDct[k]) == 3:
-                    # confirm all files exist, then proceed
-                    if os.path.isfile(k) and all([os.path.isfile(cN) for cN in connDct[k]]):
-                        print('Splitting out data for the following files: ')
-                        print(k)
-                        print(''.join([c+'\n' for c in connDct[k]]))
-                        # Generate dataframe from smr file
-                        print('attempting to generate dataframe from smr file, calling smrToTable')
-                        opTableOptical,opTableStim,consecTrigs,err = smrToTable(k)
-                        # If unsuccessful, try to do without channel 1 in smr file
-                        if type(opTableOptical) != pd.core.frame.DataFrame:
-                            opTableOptical,opTableStim,consecTrigs,consecTrigMask = smrToTable2(k)
-                        else:
-                            print('smrToTable was succesful')
-                        
-                        # Write stim file, if it was determined, to a .csv file. this will be unsuccesful if optablestim returns false
-                        firstImageName = connDct[k][0].split('/')[-1]
-                        cellType, animalNum, sesh, dte, epiNum, stim, partNum = firstImageName.split('.')[0].split('_')
-                        epiNum=int(epiNum.replace('EPI',''))
-                        partNum = int(partNum.split('-')[-1])+1
-        
-                        opStimDir = os.path.join(opDir,cellType,sesh,animalNum,'ca2/',firstImageName.split('.')[0].split('_part')[0])
-                        opPathStim = os.path.join(opStimDir,'Stim.csv')
+        except ValueError as e:
+            logging.exception(e)
+            connDct = {}
+
+    # ****************************************************************************************************************************
+    # STEP 3: populate csv file with trigger details
+    # ****************************************************************************************************************************   
+    if len(connDct.keys()) > 0:
+        for k in connDct.keys():
+            # ****************************
+            # Ideal scenario: each .smr (spikeMat) file corresponds to 3 .tif files
+            # ****************************
+            if len(connDct[k]) == 3:
+                # confirm all files exist, then proceed
+                if os.path.isfile(k) and all([os.path.isfile(cN) for cN in connDct[k]]):
+                    print('Splitting out data for the following files: ')
+                    print(k)
+                    print(''.join([c+'\n' for c in connDct[k]]))
+                    # Generate dataframe from smr file, the file is decoded once (see smrTrigs.SmrDecoder)
+                    print('********************************************')
+                    print('scanning smr file...')
+                    print('********************************************')
+                    smrDecoder = SmrDecoder(k)
+                    print('channel information for', k)
+                    print(smrDecoder.infoDf)
+                    opTableOptical = smrDecoder.opTableOptical
+                    opTableStim = smrDecoder.opTableStim
+                    stimEvents = smrDecoder.stimEvents
+                    consecTrigs = smrDecoder.consecutiveTriggers
+                    if type(opTableOptical) == pd.core.frame.DataFrame:
+                        print('smr file was decoded succesfully')
+                    else:
+                        print('could not generate dataframe from smr file: ', smrDecoder.err)
+                    
+                    # Write stim file (one row per frame) and the stim onsets/offsets, if they were determined, to .csv files. this will be unsuccesful if optablestim returns false
+                    firstImageName = connDct[k][0].split('/')[-1]
+                    cellType, animalNum, sesh, dte, epiNum, stim, partNum = firstImageName.split('.')[0].split('_')
+                    epiNum=int(epiNum.replace('EPI',''))
+                    partNum = int(partNum.split('-')[-1])+1
+    
+                    opStimDir = os.path.join(opDir,cellType,sesh,animalNum,'ca2/',firstImageName.split('.')[0].split('_part')[0])
+                    opPathStim = os.path.join(opStimDir,'Stim.csv')
+                    opPathStimEvents = os.path.join(opStimDir,'StimEvents.csv')
+                    
+                    if not os.path.isdir(opStimDir):
+                        os.makedirs(opStimDir)
                         
-                        if not os.path.isdir(opStimDir):
-                            os.makedirs(opStimDir)
-                            
-                        if type(opTableStim) == pd.core.frame.DataFrame and not os.path.isfile(opPathStim):
-                            opTableStim.to_csv(opPathStim)
+                    if type(opTableStim) == pd.core.frame.DataFrame and needsBuild('stim', [opPathStim, opPathStimEvents], [k]):
+                        opTableStim.to_csv(opPathStim)
+                        stimEvents.to_csv(opPathStimEvents, index = False)
+                        recordBuild('stim', [opPathStim, opPathStimEvents], [k])
 
+                    try:
                         tifLengths = [getNframesTif(cD) for cD in sorted(connDct[k])]
                         print('number of frames per TIF file in this session: ', tifLengths)
                         print('total number of frames: ', np.sum(tifLengths))
-                        print('length of trigger dataframe: ', opTableOptical['opticalOrder'].shape[0])                        
-                        
-                        # First attempt at at writing triggers to csv format
-                        # 2nd clause of if statement is commented out in order for code to run
-                        # future work TODO: diagnose why optableoptical does not return same number of rows are there are frames per scan
-                        if type(opTableOptical) == pd.core.frame.DataFrame: #and opTableOptical['opticalOrder'].shape[0] == np.sum(tifLengths):
-                            print('first pass at writing trigs')
-                            # If there are no consecutive triggers
-                            if consecTrigs == 0 and all([os.path.isfile(cN) for cN in connDct[k]]):
-                                #opCsvNames = [os.path.isfile(cN.replace('.tif','OpticalOrder.csv')) for cN in connDct[k]]
-                                opCsvNames = []
-
-                                # Generate output optical order csv names, and create output directory if it doesnt exist
-                                for cN in connDct[k]:
+                    except TifHeaderError as e:
+                        print('could not count the frames of',e.path,':',e.reason,'(offset',str(e.offset)+')')
+                    if type(opTableOptical) == pd.core.frame.DataFrame:
+                        print('length of trigger dataframe: ', opTableOptical['opticalOrder'].shape[0])
+                    
+                    # First attempt at at writing triggers to csv format
+                    # 2nd clause of if statement is commented out in order for code to run
+                    # future work TODO: diagnose why optableoptical does not return same number of rows are there are frames per scan
+                    if type(opTableOptical) == pd.core.frame.DataFrame: #and opTableOptical['opticalOrder'].shape[0] == np.sum(tifLengths):
+                        print('first pass at writing trigs')
+                        # If there are no consecutive triggers
+                        if consecTrigs == 0 and all([os.path.isfile(cN) for cN in connDct[k]]):
+                            #opCsvNames = [os.path.isfile(cN.replace('.tif','OpticalOrder.csv')) for cN in connDct[k]]
+                            opCsvNames = []
+
+                            # Generate output optical order csv names, and create output directory if it doesnt exist
+                            for cN in connDct[k]:
+                                firstImageName = cN.split('/')[-1]
+                                # For some reason extract these labels again from the filename
+                                cellType, animalNum, sesh, dte, epiNum, stim, partNum = firstImageName.split('.')[0].split('_')
+                                epiNum=int(epiNum.replace('EPI',''))
+                                partNum = int(partNum.split('-')[-1])+1
+                                
+                                opDirCsv = os.path.join(opDir,cellType,sesh,animalNum,'ca2/',firstImageName.split('.')[0].split('_part')[0],'part-'+str(partNum-1).zfill(2))
+                                if not os.path.isdir(opDirCsv):
+                                    os.makedirs(opDirCsv)
+
+                                opPathCsv = os.path.join(opDirCsv,'OpticalOrder.csv')
+                                opCsvNames.append(opPathCsv)
+
+                            # Generate dataframe for each image and write them, if the smr or tif files changed since they were last written
+                            # the frame counts of the tifs decide where the trigger table is cut, so they are inputs as well
+                            if needsBuild('trigs', opCsvNames, [k] + connDct[k]):
+                                print('Writing trigger csvs for ', k)
+                                if makeWriteOpticalCsvs(connDct,opTableOptical,opCsvNames,k):
+                                    recordBuild('trigs', opCsvNames, [k] + connDct[k])
+
+                            # ****************************************************************************************************************************
+                            # STEP 4: if step 3 was successful, split tif file into cyan (calcium signal) and uv (noise), output as NIfTI to preproc directory
+                            # ****************************************************************************************************************************   
+                            if all([willExist(oCN) for oCN in opCsvNames]):
+                                for i,cN in enumerate(connDct[k]):
+                                    
                                     firstImageName = cN.split('/')[-1]
                                     # For some reason extract these labels again from the filename
                                     cellType, animalNum, sesh, dte, epiNum, stim, partNum = firstImageName.split('.')[0].split('_')
                                     epiNum=int(epiNum.replace('EPI',''))
                                     partNum = int(partNum.split('-')[-1])+1
                                     
-                                    opDirCsv = os.path.join(opDir,cellType,sesh,animalNum,'ca2/',firstImageName.split('.')[0].split('_part')[0],'part-'+str(partNum-1).zfill(2))
-                                    if not os.path.isdir(opDirCsv):
-                                        os.makedirs(opDirCsv)
-
-                                    opPathCsv = os.path.join(opDirCsv,'OpticalOrder.csv')
-                                    opCsvNames.append(opPathCsv)
-
-                                # Generate dataframe for each image and write them
-                                if not all([os.path.isfile(oCN) for oCN in opCsvNames]):
-                                    print('Writing trigger csvs for ', k)
-                                    makeWriteOpticalCsvs(connDct,opTableOptical,opCsvNames)
-
-                                else:
-                                    print('Trigger csvs already created for ',k)
-
-                                # ****************************************************************************************************************************
-                                # STEP 4: if step 3 was successful, split tif file into cyan (calcium signal) and uv (noise), output as NIfTI to preproc directory
-                                # ****************************************************************************************************************************   
-                                if all([os.path.isfile(oCN) for oCN in opCsvNames]):
-                                    for i,cN in enumerate(connDct[k]):
-                                        
-                                        firstImageName = cN.split('/')[-1]
-                                        # For some reason extract these labels again from the filename
-                                        cellType, animalNum, sesh, dte, epiNum, stim, partNum = firstImageName.split('.')[0].split('_')
-                                        epiNum=int(epiNum.replace('EPI',''))
-                                        partNum = int(partNum.split('-')[-1])+1
-                                        
-                                        opDirImage = os.path.join(opDir,cellType,sesh,animalNum,'ca2/',firstImageName.split('.')[0].split('_part')[0],'part-'+str(partNum-1).zfill(2))
-
-                                        opPathSignal = os.path.join(opDirImage,'rawsignl.nii.gz')
-                                        opPathNoise = os.path.join(opDirImage,'rawnoise.nii.gz') 
-
-                                        # split TIF files into separate wavelengths and write to NiFTI
-                                        if not os.path.isfile(opPathSignal) or not os.path.isfile(opPathNoise):
-                                            print('********************************************')
-                                            print('Now splitting tif files')
-                                            print('Reading in tif and splitting: ', cN)
-                                            print('********************************************')
-                                            signalMovie, noiseMovie = splitTif(cN, opCsvNames[i], mcRef = False)
-                                            if type(signalMovie) == bool:
-                                                print('could not split data')
-
-                                            else:
-                                                print('##### Writing cyan (signal) data to: ', opPathSignal)
-                                                saveNiiLPS(signalMovie, opPathSignal)
-
-                                                print('##### Writing UV (noise) data to: ', opPathNoise)
-                                                saveNiiLPS(noiseMovie, opPathNoise)
-
+                                    opDirImage = os.path.join(opDir,cellType,sesh,animalNum,'ca2/',firstImageName.split('.')[0].split('_part')[0],'part-'+str(partNum-1).zfill(2))
+
+                                    opPathSignal = os.path.join(opDirImage,'rawsignl.nii.gz')
+                                    opPathNoise = os.path.join(opDirImage,'rawnoise.nii.gz') 
+
+                                    # split TIF files into separate wavelengths and write to NiFTI
+                                    if needsBuild('split', [opPathSignal, opPathNoise], [cN, opCsvNames[i]], {'outDtype': outDtype}):
+                                        print('********************************************')
+                                        print('Now splitting tif files')
+                                        print('Reading in tif and splitting: ', cN)
+                                        print('********************************************')
+                                        print('##### Writing cyan (signal) data to: ', opPathSignal)
+                                        print('##### Writing UV (noise) data to: ', opPathNoise)
+                                        if not splitTifNii(cN, opCsvNames[i], opPathSignal, opPathNoise, outDtype = outDtype):
+                                            print('could not split data')
                                         else:
-                                            print('Nii files already exist: ', opPathSignal, opPathNoise)
+                                            recordBuild('split', [opPathSignal, opPathNoise], [cN, opCsvNames[i]], {'outDtype': outDtype})
 
-                                        qcFigDir = os.path.join(trigQcDir,cellType)
-                                        qcFigPath = os.path.join(qcFigDir,firstImageName.split('.')[0])
-                                        if not os.path.isdir(qcFigDir):
-                                            os.makedirs(qcFigDir)
+                                    qcFigDir = os.path.join(trigQcDir,cellType)
+                                    qcFigPath = os.path.join(qcFigDir,firstImageName.split('.')[0])
+                                    if not os.path.isdir(qcFigDir):
+                                        os.makedirs(qcFigDir)
 
-                                        if not os.path.isfile(qcFigPath+'TSWithTrigs.png'):
-                                            print('##### Making QC Fig: ', qcFigPath)
-                                            trigs = pd.read_csv(opCsvNames[i])['opticalOrder'].values
-                                            makeMontageCheckTrig(cN,qcFigPath,trigs)
+                                    if needsBuild('qcFig', [qcFigPath+'TSWithTrigs.png'], [cN, opCsvNames[i]]):
+                                        print('##### Making QC Fig: ', qcFigPath)
+                                        trigs = pd.read_csv(opCsvNames[i])['opticalOrder'].values
+                                        makeMontageCheckTrig(cN,qcFigPath,trigs,overwrite = True,
+                                                             then = partial(recordBuild, 'qcFig', [qcFigPath+'TSWithTrigs.png'], [cN, opCsvNames[i]]))
 
-                    # in the case that not all files were found
-                    else:
-                        # Need semi auto script for these
-                        print(k,'Couldnt automatically split tif files')
-                        if type(opTableOptical) != pd.core.frame.DataFrame:
-                            print('Function smrToTable did not produce pandas dataframe')
-                        if opTableOptical['opticalOrder'].shape[0] != np.sum(tifLengths):
-                            print('Triggers were not the same length as the imaging data: trigger length is ',opTableOptical['opticalOrder'].shape[0],'number of optical frames is ',np.sum(tifLengths))
-
-                        for i,cN in enumerate(connDct[k]):
-                            firstImageName = cN.split('/')[-1].split('.')[0]
-                            if firstImageName not in trigReplaceDf.Img.values:
-                                 tempDf = pd.DataFrame(columns = trigReplaceDf.columns)
-                                 tempDf.Img = [firstImageName]
-                                 tempDf.CrossedTrigs = [1]
-                                 trigReplaceDf = trigReplaceDf.append(tempDf)
-
-                            elif firstImageName in trigReplaceDf.Img.values:
-                                # line below was originally fname, threw an error so changed to firstImageName
-                                processFlag = trigReplaceDf[trigReplaceDf.Img == firstImageName.replace('.tif','')].CrossedTrigs.values
-                                if len(processFlag) > 0:
-                                    processFlag = processFlag[0]
-                                else:
-                                    processFlag = 0
-
-                                if processFlag != 1:
-                                    row =  trigReplaceDf[trigReplaceDf.Img == firstImageName.replace('.tif','')].index[0]
-                                    trigReplaceDf.loc[row,'CrossedTrigs'] = 1
-
-                        print('Modifying trigger csv to produce suggested fixes in trigFix directory')                            
-
-        # ****************************************************************************************************************************
-        # STEP 5: if data was not automatically split, the code will check the quality control CSV for manually tagged files for splitting. see README for more info
-        # ****************************************************************************************************************************
-        print('If data was not split automatically, will try semi automatic triggers for the following files based on manual evaluation of QC figures.')
-
-        for imgPath in newOrderTifs:
-            fname = imgPath.split('/')[-1]
-            fnameNoSuff = fname.split('.')[0]
-
-            if fnameNoSuff in trigReplaceDf.Img.values:
-                cellType, animalNum, sesh, dte, epiNum, stim, partNum = fname.split('.')[0].split('_')
-                epiNum=int(epiNum.replace('EPI',''))
-                partNum = int(partNum.split('-')[-1])+1
-                
-                opDirCsv = os.path.join(opDir,cellType,sesh,animalNum,'ca2/',fname.split('.')[0].split('_part')[0],'part-'+str(partNum-1).zfill(2))
-
-                trigPath = os.path.join(opDirCsv,'OpticalOrder.csv')
-
-                processFlag = trigReplaceDf[trigReplaceDf.Img == fname.replace('.tif','')].CrossedTrigs.values
-
-                # check if autofix or simpfix method was selected
-                if len(processFlag) > 0:
-                    processFlag = processFlag[0]
-                    autoFlag = trigReplaceDf[trigReplaceDf.Img == fname.replace('.tif','')].autoFix.values[0]
-                    simpFlag = trigReplaceDf[trigReplaceDf.Img == fname.replace('.tif','')].simpFix.values[0]
-                    writeManual = trigReplaceDf[trigReplaceDf.Img == fname.replace('.tif','')].manualOverwrite.values[0]
-                    splitMethod = trigReplaceDf[trigReplaceDf.Img == fname.replace('.tif','')].splitMethod.values[0]
+                # in the case that not all files were found
+                else:
+                    # Need semi auto script for these
+                    # the smr file is not decoded here, so report the missing files rather than the (undefined) trigger table
+                    print(k,'Couldnt automatically split tif files')
+                    missingFiles = [f for f in [k] + connDct[k] if not os.path.isfile(f)]
+                    print('Files not found: ', missingFiles)
 
-                    if autoFlag == 1 and simpFlag == 1:
-                        raise Exception('Cant have both an auto and simple trig fix, they will overwrite')
+                    for i,cN in enumerate(connDct[k]):
+                        firstImageName = cN.split('/')[-1].split('.')[0]
+                        crossedImgs.append(firstImageName)
+                        # flag the image in this run's copy of the sheet, so STEP 5 below picks it up; main writes the flags to disk
+                        if trigSheet.get(firstImageName,'CrossedTrigs') != 1:
+                            trigSheet.update(firstImageName, CrossedTrigs = 1)
 
-                else:
-                    processFlag = 0
+                    print('Modifying trigger csv to produce suggested fixes in trigFix directory')                            
 
-                # split TIF files according to the method specified
-                writeFiles = [0,0,0]
-                if processFlag == 1:
-                    print('This image is tagged for semi auto processing: ', fname)
+    # ****************************************************************************************************************************
+    # STEP 5: if data was not automatically split, the code will check the quality control CSV for manually tagged files for splitting. see README for more info
+    # ****************************************************************************************************************************
+    print('If data was not split automatically, will try semi automatic triggers for the following files based on manual evaluation of QC figures.')
+
+    for imgPath in newOrderTifs:
+        fname = imgPath.split('/')[-1]
+        fnameNoSuff = fname.split('.')[0]
+
+        if fnameNoSuff in trigSheet:
+            cellType, animalNum, sesh, dte, epiNum, stim, partNum = fname.split('.')[0].split('_')
+            epiNum=int(epiNum.replace('EPI',''))
+            partNum = int(partNum.split('-')[-1])+1
+            
+            opDirCsv = os.path.join(opDir,cellType,sesh,animalNum,'ca2/',fname.split('.')[0].split('_part')[0],'part-'+str(partNum-1).zfill(2))
+
+            trigPath = os.path.join(opDirCsv,'OpticalOrder.csv')
+
+            # all the settings of the image, read once from the sheet
+            sheetRow = trigSheet.row(fnameNoSuff)
+            processFlag = sheetRow['CrossedTrigs']
+            autoFlag = sheetRow['autoFix']
+            simpFlag = sheetRow['simpFix']
+            writeManual = sheetRow['manualOverwrite']
+            splitMethod = sheetRow['splitMethod']
+
+            # check if autofix or simpfix method was selected
+            if autoFlag == 1 and simpFlag == 1:
+                raise Exception('Cant have both an auto and simple trig fix, they will overwrite')
+
+            # split TIF files according to the method specified
+            writeFiles = [0,0,0]
+            if processFlag == 1:
+                print('This image is tagged for semi auto processing: ', fname)
+                # the before figures read the whole movie, so they are not made in a dry run
+                if not isDryRun():
                     opname = imgPath.split('/')[-1].split('.')[0]
                     opname = os.path.join(trigFixQcDir,opname)
-                    rawPlot(imgPath,opname)
+                    rawPlot(imgPath,opname,preview = True)
 
                     if os.path.isfile(trigPath):
 
@@ -1145,117 +809,289 @@ if __name__ == '__main__':
                         if len(trigs.values) > 0:
                             opname = imgPath.split('/')[-1].split('.')[0]
                             opname = os.path.join(trigFixQcDir,opname+'Before')
-                            makeMontageCheckTrig(imgPath,opname,trigs.values)
-                            
-                    if autoFlag == 1 and ((type(splitMethod) != str) or (splitMethod == 'filter')):
-                        if not os.path.isdir(opDirCsv):
-                            os.makedirs(opDirCsv)
-
-                        sdFlag = trigReplaceDf[trigReplaceDf.Img == fname.replace('.tif','')].sdFlag.values[0]
-                        sdFlag2 = trigReplaceDf[trigReplaceDf.Img == fname.replace('.tif','')].sdFlag.values[0]
-
-                        if sdFlag == 1:
-                            sdVal = trigReplaceDf[trigReplaceDf.Img == fname.replace('.tif','')].sdVal.values[0]
-                        else:
-                            sdVal = 8
+                            makeMontageCheckTrig(imgPath,opname,trigs.values,preview = True)
+                        
+                # the fixed trigger file is rebuilt when the tif or the fix settings in the control sheet change
+                if autoFlag == 1 and ((type(splitMethod) != str) or (splitMethod == 'filter')):
+                    if not os.path.isdir(opDirCsv):
+                        os.makedirs(opDirCsv)
 
-                        if sdFlag2 == 1:
-                            sdVal2 = trigReplaceDf[trigReplaceDf.Img == fname.replace('.tif','')].sdVal.values[0]
-                        else:
-                            sdVal2 = 3
-                            
-                        autoTrigs(imgPath,outputTrigs = 'hist', figDir = trigFixQcDir,histSd = sdVal,histSd2 = sdVal2,trigOpDir = opDirCsv)
+                    sdFlag = sheetRow['sdFlag']
+                    sdFlag2 = sheetRow['sdFlag']
 
-                    elif simpFlag == 1:
-                        if not os.path.isdir(opDirCsv):
-                            os.makedirs(opDirCsv)
-                        autoTrigs(imgPath,outputTrigs = 'simp', figDir = trigFixQcDir,writeFiles = writeFiles,trigOpDir = opDirCsv)
+                    if sdFlag == 1:
+                        sdVal = sheetRow['sdVal']
+                    else:
+                        sdVal = 8
 
-                    elif writeManual == 1:
+                    if sdFlag2 == 1:
+                        sdVal2 = sheetRow['sdVal']
+                    else:
+                        sdVal2 = 3
+
+                    fixParams = {'outputTrigs': 'hist', 'splitMethod': 'filter', 'histSd': sdVal, 'histSd2': sdVal2}
+                    if needsBuild('trigsFix', [trigPath], [imgPath], fixParams, replaces = ('trigs',)):
+                        if autoTrigs(imgPath,outputTrigs = 'hist', figDir = trigFixQcDir,histSd = sdVal,histSd2 = sdVal2,trigOpDir = opDirCsv) is not False:
+                            recordBuild('trigsFix', [trigPath], [imgPath], fixParams)
+
+                elif simpFlag == 1:
+                    if not os.path.isdir(opDirCsv):
+                        os.makedirs(opDirCsv)
+                    fixParams = {'outputTrigs': 'simp'}
+                    if needsBuild('trigsFix', [trigPath], [imgPath], fixParams, replaces = ('trigs',)):
+                        if autoTrigs(imgPath,outputTrigs = 'simp', figDir = trigFixQcDir,writeFiles = writeFiles,trigOpDir = opDirCsv) is not False:
+                            recordBuild('trigsFix', [trigPath], [imgPath], fixParams)
+
+                elif writeManual == 1:
+                    manualPath = os.path.join(trigQcDir,'triggerReplace', cellType, sesh, animalNum, 'ca2/', fname.split('.')[0].split('_part')[0],'part-'+str(partNum-1).zfill(2), 'OpticalOrder.csv')
+                    if needsBuild('trigsFix', [trigPath], [manualPath], {'outputTrigs': 'manual'}, replaces = ('trigs',)):
                         print('Copy manually edited csv into place')
-                        manualPath = os.path.join(trigQcDir,'triggerReplace', cellType, sesh, animalNum, 'ca2/', fname.split('.')[0].split('_part')[0],'part-'+str(partNum-1).zfill(2), 'OpticalOrder.csv')
                         shutil.copy(manualPath,trigPath)
+                        recordBuild('trigsFix', [trigPath], [manualPath], {'outputTrigs': 'manual'})
+
+                elif splitMethod == 'gap':
+                    if not os.path.isdir(opDirCsv):
+                        os.makedirs(opDirCsv)
+
+                    sdVal = sheetRow['sdVal'] if sheetRow['sdFlag'] == 1 else 8
 
-                    elif splitMethod == 'dbscan':
-                        if not os.path.isdir(opDirCsv):
-                            os.makedirs(opDirCsv)
+                    fixParams = {'outputTrigs': 'hist', 'splitMethod': 'gap', 'histSd': sdVal}
+                    if needsBuild('trigsFix', [trigPath], [imgPath], fixParams, replaces = ('trigs',)):
+                        if autoTrigs(imgPath,outputTrigs = 'hist', figDir = trigFixQcDir,histSd = sdVal,trigOpDir = opDirCsv,splitMethod = 'gap') is not False:
+                            recordBuild('trigsFix', [trigPath], [imgPath], fixParams)
 
-                        dbscanEps = trigReplaceDf[trigReplaceDf.Img == fname.replace('.tif','')].dbscanEps.values[0]
+                elif splitMethod == 'dbscan':
+                    if not os.path.isdir(opDirCsv):
+                        os.makedirs(opDirCsv)
 
+                    dbscanEps = sheetRow['dbscanEps']
+
+                    fixParams = {'outputTrigs': 'hist', 'splitMethod': 'dbscan', 'dbscanEps': dbscanEps}
+                    if needsBuild('trigsFix', [trigPath], [imgPath], fixParams, replaces = ('trigs',)):
                         if not np.isnan(dbscanEps):
-                            autoTrigs(imgPath,outputTrigs = 'hist', figDir = trigFixQcDir,trigOpDir = opDirCsv,splitMethod = 'dbscan',dbscanEps = dbscanEps)
+                            fixed = autoTrigs(imgPath,outputTrigs = 'hist', figDir = trigFixQcDir,trigOpDir = opDirCsv,splitMethod = 'dbscan',dbscanEps = dbscanEps)
                         else:
-                            autoTrigs(imgPath,outputTrigs = 'hist', figDir = trigFixQcDir,trigOpDir = opDirCsv,splitMethod = 'dbscan')                        
-
+                            fixed = autoTrigs(imgPath,outputTrigs = 'hist', figDir = trigFixQcDir,trigOpDir = opDirCsv,splitMethod = 'dbscan')
+                        if fixed is not False:
+                            recordBuild('trigsFix', [trigPath], [imgPath], fixParams)
+
+                elif not isDryRun():
+                    sdFlag = sheetRow['sdFlag']
+                    if sdFlag == 1:
+                        sdVal = sheetRow['sdVal']
+                        autoTrigs(imgPath,outputTrigs = False, figDir = trigFixQcDir,histSd = sdVal,preview = True)
                     else:
-                        sdFlag = trigReplaceDf[trigReplaceDf.Img == fname.replace('.tif','')].sdFlag.values[0]
-                        if sdFlag == 1:
-                            sdVal = trigReplaceDf[trigReplaceDf.Img == fname.replace('.tif','')].sdVal.values[0]
-                            autoTrigs(imgPath,outputTrigs = False, figDir = trigFixQcDir,histSd = sdVal)
-                        else:
-                            autoTrigs(imgPath,outputTrigs = False, figDir = trigFixQcDir)
-        
-                    # split wavelengths, same code as in automatic split case
-                    if os.path.isfile(trigPath) and ((autoFlag == 1) or (simpFlag == 1) or (writeManual == 1) or (splitMethod == 'dbscan')):
+                        autoTrigs(imgPath,outputTrigs = False, figDir = trigFixQcDir,preview = True)
+    
+                # split wavelengths, same code as in automatic split case
+                if willExist(trigPath) and ((autoFlag == 1) or (simpFlag == 1) or (writeManual == 1) or (splitMethod in ('dbscan','gap'))):
+                    opname = imgPath.split('/')[-1].split('.')[0]
+                    opname = os.path.join(trigFixQcDir,opname+'After')
+                    if needsBuild('qcFigFix', [opname+'TSWithTrigs.png', opname+'TSWithTrigs.npy'], [imgPath, trigPath]):
                         trigs = pd.read_csv(trigPath)['opticalOrder']
-                        opname = imgPath.split('/')[-1].split('.')[0]
-                        opname = os.path.join(trigFixQcDir,opname+'After')
-                        makeMontageCheckTrig(imgPath,opname,trigs.values,optimeseries = True)
+                        makeMontageCheckTrig(imgPath,opname,trigs.values,optimeseries = True,overwrite = True,
+                                             then = partial(recordBuild, 'qcFigFix', [opname+'TSWithTrigs.png', opname+'TSWithTrigs.npy'], [imgPath, trigPath]))
 
-                        writeImgs = trigReplaceDf[trigReplaceDf.Img == fname.replace('.tif','')].writeImgs.values[0]
-                            
-                        firstImageName = imgPath.split('/')[-1]
-                        if writeImgs == 1:                           
-                            # For some reason extract these labels again from the filename
-                            cellType, animalNum, sesh, dte, epiNum, stim, partNum = firstImageName.split('.')[0].split('_')
-                            epiNum=int(epiNum.replace('EPI',''))
-                            partNum = int(partNum.split('-')[-1])+1
-                            
-                            opDirImage = os.path.join(opDir,cellType,sesh,animalNum,'ca2/',firstImageName.split('.')[0].split('_part')[0],'part-'+str(partNum-1).zfill(2))
+                    writeImgs = sheetRow['writeImgs']
+                        
+                    firstImageName = imgPath.split('/')[-1]
+                    if writeImgs == 1:                           
+                        # For some reason extract these labels again from the filename
+                        cellType, animalNum, sesh, dte, epiNum, stim, partNum = firstImageName.split('.')[0].split('_')
+                        epiNum=int(epiNum.replace('EPI',''))
+                        partNum = int(partNum.split('-')[-1])+1
+                        
+                        opDirImage = os.path.join(opDir,cellType,sesh,animalNum,'ca2/',firstImageName.split('.')[0].split('_part')[0],'part-'+str(partNum-1).zfill(2))
 
 
-                            opPathSignal = os.path.join(opDirImage,'rawsignl.nii.gz')
-                            opPathNoise = os.path.join(opDirImage,'rawnoise.nii.gz') 
+                        opPathSignal = os.path.join(opDirImage,'rawsignl.nii.gz')
+                        opPathNoise = os.path.join(opDirImage,'rawnoise.nii.gz') 
 
-                            #if not os.path.isfile(opPathSignal) or not os.path.isfile(opPathNoise):
+                        if needsBuild('split', [opPathSignal, opPathNoise], [imgPath, trigPath], {'outDtype': outDtype}):
                             print('##### Reading in tif and splitting: ', imgPath)
-                            signalMovie, noiseMovie = splitTif(imgPath, trigPath, mcRef = False)
-
-                            if type(signalMovie) == bool:
+                            print('##### Writing data to: ', opPathSignal)
+                            print('##### Writing data to: ', opPathNoise)
+                            if not splitTifNii(imgPath, trigPath, opPathSignal, opPathNoise, outDtype = outDtype):
                                 print('could not split data')
-
                             else:
-                                print('##### Writing data to: ', opPathSignal)
-                                saveNiiLPS(signalMovie, opPathSignal)
+                                recordBuild('split', [opPathSignal, opPathNoise], [imgPath, trigPath], {'outDtype': outDtype})
+
+                    qcFigDir = os.path.join(trigQcDir,cellType)
+                    qcFigPath = os.path.join(qcFigDir,firstImageName.split('.')[0])
+                    if not os.path.isdir(qcFigDir):
+                        os.makedirs(qcFigDir)
+
+                    if needsBuild('qcFig', [qcFigPath+'TSWithTrigs.png'], [imgPath, trigPath]):
+                        print('##### Making QC Fig: ', qcFigPath)
+                        trigs = pd.read_csv(trigPath)['opticalOrder'].values
+                        makeMontageCheckTrig(imgPath,qcFigPath,trigs,overwrite = True,
+                                             then = partial(recordBuild, 'qcFig', [qcFigPath+'TSWithTrigs.png'], [imgPath, trigPath]))
+
+    return crossedImgs
+
+### runSessionJob: run processSession in a worker process, collecting everything it prints so each session's output stays in one piece
+def runSessionJob(sesh, trigSheet, opDir, trigQcDir, outDtype = 'float64'):
+    log = StringIO()
+    crossedImgs = []
+    with contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        print('********************************************')
+        print('Output for session: ', sesh)
+        try:
+            crossedImgs = processSession(sesh, trigSheet, opDir, trigQcDir, outDtype)
+        except Exception:
+            print('Session failed: ', sesh)
+            traceback.print_exc()
+        # finish the QC figures of the session (and record their manifests) before handing its output back
+        waitQcRenders()
+    return crossedImgs, log.getvalue()
 
-                                print('##### Writing data to: ', opPathNoise)
-                                saveNiiLPS(noiseMovie, opPathNoise)
+### direct invocation of genTrigsNii.py
+###     Given an organized directory of raw data (.tif and .smr files) as the first argument, this program splits the TIF files into 2
+###     wavelengths and converts them to NIfTI file format. This data is output to the filepath specfied in the second argument. It also 
+###     outputs some QC figures to the path specifed by the third argument. Finally, a csv file is created for the user to verify the split was successful.
+### usage: python genTrigsNii.py rawOrganizedData/ preprocOutputDir/ qcFigs/ triggerFix.csv
+if __name__ == '__main__':
+    # ****************************************************************************************************************************
+    # STEP 1: define arguments, parse command line, and assign args to variables
+    # ****************************************************************************************************************************
+    parser=argparse.ArgumentParser(description='Run script to create trigger files and split wavelengths into seperate niftis')
+    parser.add_argument('orgDir',type = str, help="Path to organized raw data directory")
+    parser.add_argument('opDir',type=str,help="Path to output directory, often the preprocessing directory")
+    parser.add_argument('trigQcDir',type=str,help="Path to folder to put quality control figures")
+    parser.add_argument('trigReplaceDf',type=str,help='Path to csv file which controls the semi automatic generation of trigger files')
+    parser.add_argument('--matchTemplate',type=str,help='a string to feed to glob to match certain sessions/cell types for example: SLC/ses-*/animal*/ca2/ will do all SLC data',default='*/*/*/*/')
+    parser.add_argument('--refImage',type=str,help='1 to create ref images, 0 otherwise',default=0)
+    parser.add_argument('--refImage100',type=str,help='1 to create images of 100 frames centered around the ref images, 0 otherwise',default=0)
+    parser.add_argument('--outDtype',type=str,choices=OUTPUT_DTYPES,help='data type of the output NIfTI files, default float64 (the legacy output); uint16 is recommended for new data, it keeps the camera values exactly in a quarter of the space',default='float64')
+    parser.add_argument('--gzipThreads',type=int,help='number of threads used to compress the .nii.gz outputs, default all cores',default=None)
+    parser.add_argument('--gzipLevel',type=int,help='gzip compression level (1-9) of the .nii.gz outputs, default 1',default=None)
+    parser.add_argument('--jobs',type=int,help='number of sessions to process in parallel worker processes, default 1',default=1)
+    parser.add_argument('--qcJobs',type=int,help='number of worker processes drawing the QC figures of each session worker, 0 to draw them in the session worker itself, default all cores shared between the session workers',default=None)
+    parser.add_argument('--cacheDir',type=str,help='directory for the cache of per-frame mean time series, default ~/.cache/ca2dataScripts',default=None)
+    parser.add_argument('--preview',type=int,nargs='?',const=8,help='draw the first pass trigger QC figures of CrossedTrigs images from every PREVIEW-th row and column of the frames (default 8), falling back to the full frames when the wavelengths are not clearly apart; trigger files are always made from the full frames',default=0)
+    parser.add_argument('--cacheSummary',action='store_true',help='cache the median, 1st and 99th percentile and saturated pixel count of every frame along with the mean whenever a tif is read (slower first read)')
+    parser.add_argument('--humanMadeMasks',type=str,help='Path to where we keep the manually made masks; implies --cacheSummary, and the statistics are also computed within the RotOptical_maskRPI mask of the session of each tif',default=None)
+    parser.add_argument('--cacheMaxMB',type=float,help='size limit of the mean time series cache in MB, default 2048',default=None)
+    parser.add_argument('--dry-run','--dryRun',dest='dryRun',action='store_true',help='print which outputs would be built and why, without reading image data or writing anything')
+    parser.add_argument('--rebuildUnrecorded',action='store_true',help='rebuild existing outputs that have no build manifest yet, instead of taking the complete ones as up to date and writing their manifests')
+    parser.add_argument('--adoptOutputs',action='store_true',help=argparse.SUPPRESS)
+    parser.add_argument('--indexPath',type=str,help='path to the index of the raw data and outputs (see dataIndex.py), default dataIndex.sqlite in the cache directory',default=None)
+    parser.add_argument('--noIndex',action='store_true',help='list the raw data and read the tif headers from the file system instead of the index')
 
-                                #else:
-                                #    print('Files already exist: ', opPathSignal, opPathNoise)
+    args=parser.parse_args()
 
-                        qcFigDir = os.path.join(trigQcDir,cellType)
-                        qcFigPath = os.path.join(qcFigDir,firstImageName.split('.')[0])
-                        if not os.path.isdir(qcFigDir):
-                            os.makedirs(qcFigDir)
+    orgDir=args.orgDir
+    print('********************************************')
+    print('taking raw data from', orgDir)
+    opDir=args.opDir
+    print('results of wavesplitting will be output to', opDir)
+
+    # create subdirs in trigQCDir for trigger fix and trigger replace figures
+    trigQcDir=args.trigQcDir
+    trigFixQcDir=os.path.join(trigQcDir,'triggerFix')
+    trigRepQcDir=os.path.join(trigQcDir,'triggerReplace')
+    if not os.path.isdir(trigFixQcDir):
+        os.makedirs(trigFixQcDir)
+    if not os.path.isdir(trigRepQcDir):
+        os.makedirs(trigRepQcDir)
+    print('quality control figures will be output to', trigQcDir)
+    print('********************************************')
+    
+    # create a string specifying the format of filepaths containing raw data from each imaging session
+    # default: all paths matching .../orgDir/*/*/*/*
+    matchTemplate=args.matchTemplate
+    sesGlobStr = os.path.join(orgDir,matchTemplate)
+
+    # cached mean time series are shared between runs, so QC reruns do not decode the tifs again
+    setCacheDir(args.cacheDir, args.cacheMaxMB)
+    setPreviewStep(args.preview)
+    setSummaryOptions(args.cacheSummary or None, args.humanMadeMasks)
 
-                        if not os.path.isfile(qcFigPath+'TSWithTrigs.png'):
-                            print('##### Making QC Fig: ', qcFigPath)
-                            trigs = pd.read_csv(trigPath)['opticalOrder'].values
-                            makeMontageCheckTrig(imgPath,qcFigPath,trigs)
+    # outputs are only rebuilt when their inputs or parameters changed (see buildManifest.py)
+    setBuildOptions(dryRun = args.dryRun, adopt = not args.rebuildUnrecorded)
+
+    outDtype = args.outDtype
+    jobs = args.jobs
+
+    # the session folders, their files and the tif frame counts come from the index, which only lists directories that changed since the
+    # last run (see dataIndex.py); a dry run writes nothing, so it uses the index as it is, which falls back to the file system where stale
+    setIndexOptions(not args.noIndex, args.indexPath)
+    if not isDryRun():
+        refreshPipelineIndex(orgDir, opDir, args.trigReplaceDf if os.path.isfile(args.trigReplaceDf) else None, jobs = os.cpu_count() or 1)
+
+    # find and "naturally sort" all filepaths matching this template
+    sesGlob = natsort.natsorted(indexedGlob(sesGlobStr))
+    print('raw data directories are', sesGlob)
+    gzipThreads = args.gzipThreads
+    # share the cores between the session workers unless told otherwise
+    if gzipThreads is None and jobs > 1:
+        gzipThreads = max(1,(os.cpu_count() or 1)//jobs)
+    setGzipOptions(gzipThreads, args.gzipLevel)
+    qcJobs = args.qcJobs
+    if qcJobs is None:
+        qcJobs = max(1,(os.cpu_count() or 1)//jobs)
+    setQcOptions(qcJobs)
+    refImageFlag = int(args.refImage)
+    refImg100Flag = int(args.refImage100)
+
+    # create .csv file if it doesn't exist and read it into a ControlSheet
+    trigReplaceDfPath=args.trigReplaceDf
+    if os.path.isfile(trigReplaceDfPath):
+        print('Reading existing csv:',trigReplaceDfPath)
+        trigSheet = ControlSheet.load(trigReplaceDfPath)
+    else:
+        print('No csv found, generating csv automatically:',trigReplaceDfPath)
+        trigSheet = ControlSheet(trigReplaceDfPath)
+        # name each row after the tif image name
+        for f in natsort.natsorted(indexedGlob(sesGlobStr+'/*.tif')):
+            trigSheet.update(f.split('/')[-1].split('.')[0])
+        if not isDryRun():
+            trigSheet.save()
+
+    # ****************************************************************************************************************************
+    # STEPS 2-5: process each session, in parallel worker processes if --jobs is more than 1
+    # ****************************************************************************************************************************
+    crossedImgs = []
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers = jobs) as pool:
+            futures = [pool.submit(runSessionJob, sesh, trigSheet, opDir, trigQcDir, outDtype) for sesh in sesGlob]
+            # collect results in session order, so the console output and the control sheet updates do not depend on timing
+            for sesh,future in zip(sesGlob,futures):
+                sessionCrossed, sessionLog = future.result()
+                print(sessionLog, end = '')
+                crossedImgs = crossedImgs + sessionCrossed
+    else:
+        for sesh in sesGlob:
+            crossedImgs = crossedImgs + processSession(sesh, trigSheet, opDir, trigQcDir, outDtype)
+        waitQcRenders()
+
+    if len(crossedImgs) > 0 and isDryRun():
+        print('[dry run] would flag CrossedTrigs in', trigReplaceDfPath, 'for:', crossedImgs)
+    elif len(crossedImgs) > 0:
+        print('Flagging CrossedTrigs in', trigReplaceDfPath, 'for:', crossedImgs)
+        flagCrossedTrigs(trigReplaceDfPath, crossedImgs)
+
+    # one page with the time series and triggers of every image of the run, drawn from the cached mean time series
+    if not isDryRun():
+        reportPath = os.path.join(trigQcDir,'qcReport.html')
+        nImages = writeQcReport(orgDir, opDir, trigReplaceDfPath, reportPath, matchTemplate, cachedOnly = True)
+        print('Wrote QC report of', nImages, 'images to:', reportPath)
 
     # To Delete Preprocessing in bash:
     #for line in `cat qcFigs/preprocCheck/pvTriggerIssues.csv | tail -n +2`;do sesh=`echo $line | awk -F, '{print $1}'`; newTrigs=`echo $line | awk -F, '{print $2}'`; if [[ $newTrigs == 1 ]];then ls PreprocessedData/*/*/*/*/$sesh/*;fi;done
 
-    if refImageFlag == 1:
+    if refImageFlag == 1 and isDryRun():
+        print('[dry run] reference images are not planned')
+
+    elif refImageFlag == 1:
 
         print('Creating reference images')
 
         sesGlobStr = os.path.join(opDir,matchTemplate)
-        sesGlob = natsort.natsorted(glob.glob(sesGlobStr))
+        sesGlob = natsort.natsorted(indexedGlob(sesGlobStr))
 
         for sG in sesGlob:
-            for root,dirs,fs in natsort.natsorted(os.walk(sG)):
+            for root,dirs,fs in natsort.natsorted(indexedWalk(sG)):
                 for f in fs:
                     if f == 'rawsignl.nii.gz' and all([x in root for x in ['EPI1_','part-00']]):
 
@@ -1266,26 +1102,30 @@ if __name__ == '__main__':
 
                             ippath = os.path.join(root,f)
                             imgObj = nb.Nifti1Image.load(ippath)
-                            imgData = imgObj.get_fdata().squeeze()
-
-                            midFrame = round(imgData.shape[2]/2)
-
-                            mcRefArr = np.expand_dims(imgData[:,:,midFrame],axis=2)
+                            # only the frames saved are read from the file (the 100 around the middle frame, or the middle frame alone)
+                            nFrames = imgObj.shape[-1]
+                            frameShape = imgObj.shape[:2]
+                            midFrame = round(nFrames/2)
+                            firstFrame = max(midFrame-50,0) if refImg100Flag == 1 else midFrame
+                            lastFrame = min(midFrame+50,nFrames) if refImg100Flag == 1 else midFrame+1
+                            imgData = np.asanyarray(imgObj.dataobj[...,firstFrame:lastFrame]).reshape(frameShape + (-1,))
+
+                            mcRefArr = imgData[:,:,midFrame-firstFrame:midFrame-firstFrame+1]
                             opImg = nb.Nifti1Image(mcRefArr, imgObj.affine, header = imgObj.header)
 
                             print('Saving moco ref image as LPS:', opname)
-                            nb.save(opImg, opname)
+                            saveNii(opImg, opname, outDtype)
 
                             print( 'Saving moco ref image as RPI:', opname.replace('.nii.gz','RPI.nii.gz') )
-                            nb.save(opImg.slicer[::-1,:,::-1], opname.replace('.nii.gz','RPI.nii.gz'))
+                            saveNii(opImg.slicer[::-1,:,::-1], opname.replace('.nii.gz','RPI.nii.gz'), outDtype)
 
                             if refImg100Flag == 1:
-                                mcRefArr100 = imgData[:,:,midFrame-50:midFrame+50]
+                                mcRefArr100 = imgData
                                 opImg100 = nb.Nifti1Image(mcRefArr100, imgObj.affine, header = imgObj.header)
 
 
                                 print('Saving moco ref 100 frames image:', opname100)
-                                nb.save(opImg100, opname100)
+                                saveNii(opImg100, opname100, outDtype)
 
                         else:
                             print('File already exits:', opname)
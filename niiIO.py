@@ -0,0 +1,440 @@
+### niiIO.py: incremental writing of gzipped NIfTI-1 (.nii.gz) files
+### NiftiGzWriter streams volumes into a .nii.gz one at a time, so a movie never has to be held in memory to be saved. The NIfTI header is
+### stored uncompressed in the first deflate block of the gzip stream, which lets the writer fix it up (number of volumes, scaling) once
+### all data has been written; the gzip CRC is then patched with crc32Combine. The result is a single member, standard gzip file that
+### nibabel, bisweb and gunzip read like any other .nii.gz. Data is written to a temporary file that only replaces opname on close.
+### Compression runs in parallel like pigz: the data is cut into blocks that a pool of threads deflates independently (each primed with
+### the last 32 KiB of the block before it) and that are joined, in order, into one deflate stream. The thread count and compression
+### level default to the number of cores and 1 (nibabel's default), and can be set with setGzipOptions or the CA2_GZIP_THREADS and
+### CA2_GZIP_LEVEL environment variables.
+### The dtype written is set by an output dtype policy (OUTPUT_DTYPES): integer outputs store the data with a scl_inter offset when needed,
+### and every volume is checked to decode back to exactly the values it was given.
+### concatNii streams several NIfTI files into one along the time axis, copying the stored data as it is when no conversion is needed.
+### frameMask reads a mask NIfTI (e.g. a humanMadeMasks RPI mask) into the orientation of the raw tif frames.
+### usage: with NiftiGzWriter('rawsignl.nii.gz', header) as w: w.writeVolume(vol)
+import os
+import struct
+import zlib
+import logging
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import nibabel as nb
+
+# NIfTI-1 single file layout: 348 byte header, 4 byte extension flag, data
+NII_HEADER_BYTES = 352
+
+# size of the blocks compressed in parallel, and of the dictionary each block is primed with
+GZIP_BLOCK_BYTES = 1024*1024
+GZIP_DICT_BYTES = 32768
+
+# output dtype policies; float64 reproduces the legacy output written from float64 movies
+OUTPUT_DTYPES = ('uint16', 'int16', 'float32', 'float64')
+
+### OutputDtypeError: data that cannot be stored exactly under an output dtype policy
+class OutputDtypeError(ValueError):
+    '''
+    Raised when values cannot be stored exactly in the dtype and scaling of an output, so that callers can retry with a wider
+    dtype without also retrying on unrelated errors (e.g. a corrupt input) that happen to be ValueErrors.
+    '''
+
+### outputScaling: storage dtype, scl_slope and scl_inter used to write data of srcDtype, with values in valueRange, under the outDtype policy
+###     valueRange is (min, max) of the data and is only needed for non integer data written to an integer dtype
+def outputScaling(outDtype, srcDtype, valueRange = None):
+    if outDtype not in OUTPUT_DTYPES:
+        raise ValueError('outDtype must be one of ' + str(OUTPUT_DTYPES))
+
+    dtype = np.dtype(outDtype)
+    if dtype.kind == 'f':
+        return dtype, 1.0, 0.0
+
+    srcDtype = np.dtype(srcDtype)
+    if valueRange is None:
+        if srcDtype.kind not in 'ui':
+            raise OutputDtypeError('the value range of %s data is needed to store it as %s' % (srcDtype, dtype))
+        valueRange = (np.iinfo(srcDtype).min, np.iinfo(srcDtype).max)
+
+    # integer outputs keep a slope of 1, so integer values round trip exactly; shift by an offset if the range does not fit as is
+    info = np.iinfo(dtype)
+    lo, hi = valueRange
+    if lo >= info.min and hi <= info.max:
+        inter = 0.0
+    else:
+        inter = float(np.floor(lo) - info.min)
+
+    return dtype, 1.0, inter
+
+### applyOutputDtype: copy of a NIfTI header set up to store data of srcDtype under the outDtype policy
+def applyOutputDtype(header, outDtype, srcDtype, valueRange = None):
+    dtype, slope, inter = outputScaling(outDtype, srcDtype, valueRange)
+    header = header.copy()
+    header.set_data_dtype(dtype)
+    header.set_slope_inter(slope, inter)
+    return header
+
+### encodeVolume: the values stored on disk for vol with the given dtype, slope and inter
+###     raises OutputDtypeError unless the stored values decode (stored*slope + inter) to exactly the values of vol
+def encodeVolume(vol, dtype, slope = 1.0, inter = 0.0):
+    vol = np.asarray(vol)
+    dtype = np.dtype(dtype)
+
+    if vol.dtype.kind in 'ui' and dtype.kind in 'ui' and slope == 1 and inter == int(inter):
+        # integer to integer with an integer offset is exact as long as the shifted values fit
+        if vol.size > 0:
+            info = np.iinfo(dtype)
+            if int(vol.min()) - int(inter) < info.min or int(vol.max()) - int(inter) > info.max:
+                raise OutputDtypeError('values from %d to %d do not fit in %s with scl_inter %g' % (vol.min(), vol.max(), dtype, inter))
+        if inter == 0:
+            return vol.astype(dtype, copy = False)
+        return (vol.astype(np.int64) - int(inter)).astype(dtype)
+
+    if dtype.kind in 'ui':
+        stored = np.rint((vol.astype(np.float64) - inter)/slope)
+        info = np.iinfo(dtype)
+        if stored.size > 0 and (np.nanmin(stored) < info.min or np.nanmax(stored) > info.max or np.isnan(stored).any()):
+            raise OutputDtypeError('values do not fit in %s with scl_slope %g and scl_inter %g' % (dtype, slope, inter))
+        stored = stored.astype(dtype)
+    elif slope == 1 and inter == 0:
+        stored = vol.astype(dtype, copy = False)
+    else:
+        stored = ((vol - inter)/slope).astype(dtype)
+
+    decoded = stored.astype(np.float64)*slope + inter
+    if not np.array_equal(decoded, vol, equal_nan = vol.dtype.kind in 'fc'):
+        raise OutputDtypeError('values do not round trip exactly when stored as %s with scl_slope %g and scl_inter %g' % (dtype, slope, inter))
+
+    return stored
+
+### setGzipOptions: change the number of compression threads and/or the compression level used for all .nii.gz writes
+###     stored in the environment so that worker processes inherit them
+def setGzipOptions(threads = None, level = None):
+    if threads is not None:
+        os.environ['CA2_GZIP_THREADS'] = str(int(threads))
+    if level is not None:
+        os.environ['CA2_GZIP_LEVEL'] = str(int(level))
+
+### getGzipOptions: current (threads, level)
+def getGzipOptions():
+    threads = int(os.environ.get('CA2_GZIP_THREADS', os.cpu_count() or 1))
+    level = int(os.environ.get('CA2_GZIP_LEVEL', 1))
+    return max(threads, 1), level
+
+### deflateBlock: raw deflate one block, primed with zdict; the last block of the stream is finished, the others end on a byte boundary
+def deflateBlock(data, level, zdict, last):
+    if len(zdict) > 0:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zdict = zdict)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+### gf2MatrixTimes, gf2MatrixSquare, crc32Combine: combine the CRC32 of two blocks of data, as in zlib's crc32_combine
+def gf2MatrixTimes(mat, vec):
+    s = 0
+    i = 0
+    while vec:
+        if vec & 1:
+            s ^= mat[i]
+        vec >>= 1
+        i += 1
+    return s
+
+def gf2MatrixSquare(mat):
+    return [gf2MatrixTimes(mat, mat[n]) for n in range(32)]
+
+def crc32Combine(crc1, crc2, len2):
+    if len2 <= 0:
+        return crc1
+
+    # operator for one zero bit in odd, then two and four zero bits
+    odd = [0xedb88320] + [1 << n for n in range(31)]
+    even = gf2MatrixSquare(odd)
+    odd = gf2MatrixSquare(even)
+
+    # apply len2 zero bytes to crc1
+    while True:
+        even = gf2MatrixSquare(odd)
+        if len2 & 1:
+            crc1 = gf2MatrixTimes(even, crc1)
+        len2 >>= 1
+        if len2 == 0:
+            break
+        odd = gf2MatrixSquare(even)
+        if len2 & 1:
+            crc1 = gf2MatrixTimes(odd, crc1)
+        len2 >>= 1
+        if len2 == 0:
+            break
+
+    return crc1 ^ crc2
+
+class NiftiGzWriter:
+    '''
+    Write a .nii.gz one volume at a time.
+    header is a nibabel Nifti1Header describing the spatial dimensions, dtype, scaling and affine of the output (see applyOutputDtype);
+    its time dimension is set from the number of volumes written when the writer is closed.
+    threads and compresslevel default to getGzipOptions().
+    '''
+
+    def __init__(self, opname, header, compresslevel = None, threads = None):
+        self.opname = opname
+        self.header = header.copy()
+        self.header.set_data_offset(NII_HEADER_BYTES)
+        self.dtype = self.header.get_data_dtype()
+        self.volShape = tuple(self.header.get_data_shape()[:3])
+        self.is4D = len(self.header.get_data_shape()) > 3
+        slope, inter = self.header.get_slope_inter()
+        self.slope = 1.0 if slope is None else slope
+        self.inter = 0.0 if inter is None else inter
+        self.nVolumes = 0
+
+        self.tmpPath = opname + '.part'
+        self.f = open(self.tmpPath, 'wb')
+        # gzip member header: deflate, no flags, no mtime, unknown OS
+        self.f.write(b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff')
+        # first deflate block: NIfTI header stored uncompressed (BFINAL=0, BTYPE=00), rewritten on close
+        self.f.write(struct.pack('<BHH', 0, NII_HEADER_BYTES, NII_HEADER_BYTES ^ 0xffff))
+        self.headerPos = self.f.tell()
+        self.f.write(self.headerBytes())
+
+        defaultThreads, defaultLevel = getGzipOptions()
+        self.level = defaultLevel if compresslevel is None else compresslevel
+        self.threads = defaultThreads if threads is None else max(int(threads), 1)
+        self.bodyCrc = 0
+        self.bodyLen = 0
+
+        if self.threads == 1:
+            self.compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        else:
+            self.pool = ThreadPoolExecutor(max_workers = self.threads)
+            self.pending = collections.deque()
+            self.buffer = bytearray()
+            self.zdict = b''
+
+    def headerBytes(self):
+        return self.header.binaryblock + b'\x00'*(NII_HEADER_BYTES - len(self.header.binaryblock))
+
+    ### write: append raw voxel bytes (already in the output dtype and in Fortran order)
+    def write(self, data):
+        self.bodyCrc = zlib.crc32(data, self.bodyCrc)
+        self.bodyLen += len(data)
+
+        if self.threads == 1:
+            self.f.write(self.compressor.compress(data))
+            return
+
+        self.buffer += data
+        # keep one block back, so that there is always a block left to finish the stream with on close
+        while len(self.buffer) > GZIP_BLOCK_BYTES:
+            block = bytes(self.buffer[:GZIP_BLOCK_BYTES])
+            del self.buffer[:GZIP_BLOCK_BYTES]
+            self.submitBlock(block, last = False)
+
+    ### submitBlock: queue a block for compression, writing out finished blocks in order so that at most 2*threads are in flight
+    def submitBlock(self, block, last):
+        self.pending.append(self.pool.submit(deflateBlock, block, self.level, self.zdict, last))
+        self.zdict = block[-GZIP_DICT_BYTES:]
+        while len(self.pending) > 2*self.threads or (last and len(self.pending) > 0):
+            self.f.write(self.pending.popleft().result())
+
+    ### writeVolume: append one volume (a 2D frame is treated as a single slice), encoded in the output dtype and scaling
+    ###     raises OutputDtypeError if the volume cannot be stored exactly
+    def writeVolume(self, vol):
+        vol = np.asarray(vol)
+        if vol.ndim == 2:
+            vol = vol[:,:,np.newaxis]
+        if vol.shape != self.volShape:
+            raise Exception('Volume of shape %s does not match the output shape %s' % (vol.shape, self.volShape))
+        self.write(encodeVolume(vol, self.dtype, self.slope, self.inter).tobytes(order = 'F'))
+        self.nVolumes += 1
+
+    ### writeRaw: append nVolumes volumes of voxel bytes that are already stored in the output dtype and scaling (e.g. copied from a NIfTI
+    ###     file with the same header settings)
+    def writeRaw(self, data, nVolumes):
+        self.write(data)
+        self.nVolumes += nVolumes
+
+    ### close: finish the gzip stream, fix up the header with the number of volumes written and move the file into place
+    def close(self):
+        if self.threads == 1:
+            self.f.write(self.compressor.flush())
+        else:
+            self.submitBlock(bytes(self.buffer), last = True)
+            self.pool.shutdown()
+
+        if self.is4D or self.nVolumes != 1:
+            shape = self.volShape + (self.nVolumes,)
+        else:
+            shape = self.volShape
+        self.header.set_data_shape(shape)
+        head = self.headerBytes()
+
+        crc = crc32Combine(zlib.crc32(head), self.bodyCrc, self.bodyLen)
+        self.f.write(struct.pack('<II', crc, (NII_HEADER_BYTES + self.bodyLen) & 0xffffffff))
+        self.f.seek(self.headerPos)
+        self.f.write(head)
+        self.f.close()
+
+        os.replace(self.tmpPath, self.opname)
+        return self.opname
+
+    ### abort: discard a partially written file
+    def abort(self):
+        if self.threads > 1:
+            self.pool.shutdown(cancel_futures = True)
+        self.f.close()
+        if os.path.exists(self.tmpPath):
+            os.remove(self.tmpPath)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excVal, tb):
+        if excType is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+### saveNii: save a nibabel image as .nii.gz under the outDtype policy, one volume at a time
+###     if the data cannot be stored exactly as outDtype, falls back to float32 and then float64 with a warning
+def saveNii(img, opname, outDtype = 'float32'):
+    shape = img.shape
+    nVolumes = shape[3] if len(shape) > 3 else 1
+
+    def volume(t):
+        if len(shape) > 3:
+            return np.asanyarray(img.dataobj[:,:,:,t])
+        return np.asanyarray(img.dataobj).reshape(shape[:3])
+
+    # the value range is only needed to store non integer data as an integer dtype
+    first = volume(0)
+    srcDtype = first.dtype
+    valueRange = None
+    if srcDtype.kind not in 'ui' and np.dtype(outDtype).kind in 'ui':
+        ranges = [(np.nanmin(v), np.nanmax(v)) for v in (volume(t) for t in range(nVolumes)) if v.size > 0]
+        valueRange = (min(r[0] for r in ranges), max(r[1] for r in ranges)) if len(ranges) > 0 else (0, 0)
+
+    header = img.header.copy()
+    header.set_data_shape(shape)
+
+    for tryDtype in [outDtype] + [d for d in ['float32', 'float64'] if d != outDtype]:
+        try:
+            opHeader = applyOutputDtype(header, tryDtype, srcDtype, valueRange)
+            with NiftiGzWriter(opname, opHeader) as writer:
+                for t in range(nVolumes):
+                    writer.writeVolume(first if t == 0 else volume(t))
+            return opname
+        except OutputDtypeError as e:
+            logging.warning('Could not store %s exactly as %s (%s), trying the next dtype', opname, tryDtype, e)
+
+    raise OutputDtypeError('Could not store %s exactly in any output dtype' % opname)
+
+# size of the blocks of voxel data concatNii reads from its inputs at a time
+CONCAT_BLOCK_BYTES = 64*1024*1024
+
+### niiVoxelBlocks: yield the raw voxel data of a NIfTI file as it is stored on disk, in blocks of whole volumes of about blockBytes each,
+###     as (bytes, number of volumes); only one block is in memory at a time
+def niiVoxelBlocks(path, blockBytes = CONCAT_BLOCK_BYTES):
+    proxy = nb.load(path).dataobj
+    volBytes = int(np.prod(proxy.shape[:3]))*proxy.dtype.itemsize
+    nVolumes = proxy.shape[3] if len(proxy.shape) > 3 else 1
+    perBlock = max(blockBytes//max(volBytes, 1), 1)
+
+    with nb.openers.Opener(path) as f:
+        f.seek(int(proxy.offset))
+        for start in range(0, nVolumes, perBlock):
+            n = min(perBlock, nVolumes - start)
+            data = f.read(n*volBytes)
+            if len(data) < n*volBytes:
+                raise EOFError('%s ends before its %d volumes of voxel data' % (path, nVolumes))
+            yield data, n
+
+### decodeBlock: the values of a block of raw voxel data of the image with array proxy proxy (see niiVoxelBlocks), as an array of shape
+###     volume shape + (nVolumes,)
+def decodeBlock(data, nVolumes, proxy):
+    vols = np.frombuffer(data, dtype = proxy.dtype).reshape(tuple(proxy.shape[:3]) + (nVolumes,), order = 'F')
+    if proxy.slope == 1 and proxy.inter == 0:
+        return vols
+    return vols*np.float64(proxy.slope) + np.float64(proxy.inter)
+
+### concatNii: concatenate NIfTI files along the time axis into one .nii.gz, streaming the voxel data
+###     the inputs are checked from their headers alone to have the same volume shape and affine (ValueError otherwise). With outDtype None
+###     the output keeps the stored dtype and scaling the inputs have in common, or the dtype of their decoded values if they differ;
+###     otherwise it is written under the outDtype policy (see OUTPUT_DTYPES). Inputs stored in the output dtype and scaling are copied
+###     block by block as they are; others are decoded and encoded a block at a time, falling back to float32 and then float64 like saveNii
+###     if the values cannot be stored exactly. Memory use does not grow with the inputs
+def concatNii(ippaths, opname, outDtype = None):
+    images = [nb.load(ip) for ip in ippaths]
+    proxies = [img.dataobj for img in images]
+    volShape = tuple(proxies[0].shape[:3])
+    affine = images[0].affine
+    for ip, img in zip(ippaths, images):
+        if len(img.shape) > 4 or tuple(img.shape[:3]) != volShape:
+            raise ValueError('%s has shape %s, which cannot be concatenated with volumes of shape %s' % (ip, img.shape, volShape))
+        if not np.allclose(img.affine, affine):
+            raise ValueError('the affine of %s differs from that of %s' % (ip, ippaths[0]))
+
+    # the values stored are the decoded values of the inputs, which the legacy version concatenated as get_fdata() arrays
+    storage = [(p.dtype.newbyteorder('='), float(p.slope), float(p.inter)) for p in proxies]
+    unscaled = all(slope == 1 and inter == 0 for _, slope, inter in storage)
+    srcDtype = np.result_type(*[dtype for dtype, _, _ in storage]) if unscaled else np.dtype(np.float64)
+    nVolumes = sum(img.shape[3] if len(img.shape) > 3 else 1 for img in images)
+
+    # the header is built from a one volume image, as the legacy version built it from the concatenated array and the first affine
+    header = nb.Nifti1Image(np.zeros(volShape + (1,), dtype = np.float64), affine).header
+    header.set_data_shape(volShape + (nVolumes,))
+
+    # inputs sharing their storage are written the same way, so all of them are copied as they are
+    if outDtype is None and len(set(storage)) == 1:
+        tryDtypes = [storage[0]]
+    elif outDtype is None:
+        tryDtypes = [srcDtype.name if srcDtype.name in OUTPUT_DTYPES else 'float64']
+    else:
+        tryDtypes = [outDtype]
+    tryDtypes += [d for d in ['float32', 'float64'] if d not in tryDtypes]
+
+    valueRange = None
+    if srcDtype.kind not in 'ui' and isinstance(tryDtypes[0], str) and np.dtype(tryDtypes[0]).kind in 'ui':
+        ranges = [(np.nanmin(v), np.nanmax(v)) for ip, p in zip(ippaths, proxies) for v in
+                  (decodeBlock(data, n, p) for data, n in niiVoxelBlocks(ip)) if v.size > 0]
+        valueRange = (min(r[0] for r in ranges), max(r[1] for r in ranges)) if len(ranges) > 0 else (0, 0)
+
+    for tryDtype in tryDtypes:
+        try:
+            if isinstance(tryDtype, tuple):
+                opHeader = header.copy()
+                opHeader.set_data_dtype(tryDtype[0])
+                opHeader.set_slope_inter(tryDtype[1], tryDtype[2])
+            else:
+                opHeader = applyOutputDtype(header, tryDtype, srcDtype, valueRange)
+            with NiftiGzWriter(opname, opHeader) as writer:
+                for ip, p in zip(ippaths, proxies):
+                    rawCopy = p.dtype == writer.dtype and p.slope == writer.slope and p.inter == writer.inter
+                    for data, n in niiVoxelBlocks(ip):
+                        if rawCopy:
+                            writer.writeRaw(data, n)
+                        else:
+                            vols = decodeBlock(data, n, p)
+                            for t in range(n):
+                                writer.writeVolume(vols[:,:,:,t])
+            return opname
+        except OutputDtypeError as e:
+            logging.warning('Could not store %s exactly as %s (%s), trying the next dtype', opname, tryDtype, e)
+
+    raise OutputDtypeError('Could not store %s exactly in any output dtype' % opname)
+
+# orientation of the raw image NIfTI files written by genTrigsNii.py (see genTrigsNii.lpsHeader); their first axis is the tif rows, flipped
+RAW_AXCODES = ('L', 'P', 'S')
+
+### frameMask: boolean (rows, cols) mask in the orientation of the tif frames from a single slice mask NIfTI such as the
+###     humanMadeMasks/*_RotOptical_maskRPI.nii.gz files; the mask is reoriented from its own affine to that of the raw image files and the
+###     flip of genTrigsNii.lpsVolume is undone. Raises ValueError if it does not have the shape of the frames
+def frameMask(maskPath, frameShape):
+    img = nb.load(maskPath)
+    transform = nb.orientations.ornt_transform(nb.orientations.io_orientation(img.affine), nb.orientations.axcodes2ornt(RAW_AXCODES))
+    mask = nb.orientations.apply_orientation(np.asanyarray(img.dataobj), transform)
+    mask = mask.reshape(mask.shape[:2] + (-1,))[:,:,0] if mask.ndim > 2 else mask
+
+    if mask.shape != tuple(frameShape):
+        raise ValueError('mask %s of shape %s does not fit frames of shape %s' % (maskPath, mask.shape, tuple(frameShape)))
+    return mask[::-1,:] > 0
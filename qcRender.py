@@ -0,0 +1,121 @@
+### qcRender.py: headless rendering of the QC time series figures (mean intensity per frame, coloured by trigger label)
+### Figures are drawn on an Agg canvas that is kept and reused for every figure of the same size, with the points of each label drawn as
+### the markers of one line rather than a scatter collection, and written atomically. With setQcOptions(jobs = N) the figures are drawn
+### by a pool of N worker processes while the pipeline goes on; waitQcRenders waits for them and then runs what was waiting on each figure
+### (e.g. recording its manifest).
+### usage: from qcRender import TRIG_STYLES, renderTimeSeries, waitQcRenders
+###        renderTimeSeries('figTSWithTrigs.png', meanTS, [(trigs, TRIG_STYLES, '')], legend = True)
+###        waitQcRenders()
+import os
+import logging
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+# (label, color, legend entry) of each trigger label in the QC figures
+TRIG_STYLES = [(1, 'blue', 'Cyan'), (2, 'yellow', 'Ultraviolet'), (3, 'red', 'Dropped')]
+
+DEFAULT_FIGSIZE = (6.4, 4.8)
+
+# figure and canvas of each figure size drawn in this process
+canvases = {}
+
+# worker pool of this process and the figures submitted to it that were not waited for yet, as {pngPath: (future, then)} in submission order
+renderPool = None
+pendingRenders = {}
+
+### setQcOptions: change the number of worker processes drawing the QC figures, 0 to draw them in the calling process
+###     stored in the environment so that worker processes inherit it
+def setQcOptions(jobs = None):
+    if jobs is not None:
+        os.environ['CA2_QC_JOBS'] = str(int(jobs))
+
+### getQcJobs: current number of QC drawing worker processes
+def getQcJobs():
+    return max(int(os.environ.get('CA2_QC_JOBS', 0)), 0)
+
+### fitLabels: trigger labels cut or padded to nFrames; frames past the end of the labels keep the last label if it is cyan (1), otherwise
+###     they are taken as UV (2)
+def fitLabels(labels, nFrames):
+    labels = np.squeeze(np.asarray(labels)).astype('int')
+    if len(labels) >= nFrames:
+        return labels[:nFrames]
+    padLabel = 1 if len(labels) > 0 and labels[-1] == 1 else 2
+    return np.concatenate([labels, np.full(nFrames - len(labels), padLabel)])
+
+### figureCanvas: the figure and Agg canvas of the given size in this process, cleared
+def figureCanvas(figsize):
+    key = tuple(figsize)
+    if key not in canvases:
+        fig = Figure(figsize = key)
+        canvases[key] = (fig, FigureCanvasAgg(fig))
+    fig, canvas = canvases[key]
+    fig.clear()
+    return fig, canvas
+
+### drawTimeSeries: draw meanTS in one panel per (labels, styles, xlabel) entry of panels and write it to pngPath
+###     the points whose label equals the first entry of a style are drawn in its color; labels None draws all points in the first style
+def drawTimeSeries(pngPath, meanTS, panels, figsize = DEFAULT_FIGSIZE, legend = False, alpha = 1):
+    fig, canvas = figureCanvas(figsize)
+    meanTS = np.asarray(meanTS)
+    timeVector = np.arange(1, len(meanTS) + 1)
+
+    for i, (labels, styles, xlabel) in enumerate(panels):
+        ax = fig.add_subplot(1, len(panels), i + 1)
+        if labels is None:
+            label, color, name = styles[0]
+            ax.plot(timeVector, meanTS, linestyle = 'none', marker = '.', color = color, label = name, alpha = alpha)
+        else:
+            labels = np.asarray(labels)
+            for label, color, name in styles:
+                mask = labels == label
+                ax.plot(timeVector[mask], meanTS[mask], linestyle = 'none', marker = '.', color = color, label = name, alpha = alpha)
+        if xlabel:
+            ax.set_xlabel(xlabel)
+        if legend:
+            ax.legend()
+
+    tmpPath = pngPath + '.%d.part' % os.getpid()
+    with open(tmpPath, 'wb') as f:
+        canvas.print_png(f)
+    os.replace(tmpPath, pngPath)
+    return pngPath
+
+### renderTimeSeries: draw a QC time series figure (see drawTimeSeries), in the worker pool if there is one
+###     then is called without arguments in this process once the figure is written: right away without a pool, in waitQcRenders with one
+def renderTimeSeries(pngPath, meanTS, panels, figsize = DEFAULT_FIGSIZE, legend = False, alpha = 1, then = None):
+    global renderPool
+    jobs = getQcJobs()
+    if jobs == 0:
+        drawTimeSeries(pngPath, meanTS, panels, figsize, legend, alpha)
+        if then is not None:
+            then()
+        return
+
+    # a figure that is drawn again (e.g. after its triggers were fixed) waits for the earlier drawing, so the last one submitted is kept
+    if pngPath in pendingRenders:
+        waitQcRenders(pngPath)
+
+    if renderPool is None:
+        renderPool = ProcessPoolExecutor(max_workers = jobs)
+    future = renderPool.submit(drawTimeSeries, pngPath, meanTS, panels, figsize, legend, alpha)
+    pendingRenders[pngPath] = (future, then)
+
+### waitQcRenders: wait for the figures submitted to the worker pool (or only those written to onlyPath) and run their then callbacks
+###     returns the number of figures that failed
+def waitQcRenders(onlyPath = None):
+    failed = 0
+    waiting = list(pendingRenders.keys()) if onlyPath is None else [onlyPath]
+    for pngPath in waiting:
+        future, then = pendingRenders.pop(pngPath)
+        try:
+            future.result()
+        except Exception as e:
+            logging.exception(e)
+            print('Could not draw QC figure: ', pngPath)
+            failed = failed + 1
+            continue
+        if then is not None:
+            then()
+    return failed
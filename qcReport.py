@@ -0,0 +1,301 @@
+### qcReport.py: one self contained HTML page for reviewing the trigger splits of all images of a run, instead of opening the QC figures one by one
+### The mean time series of each image (from the cache, see tsCache) is reduced to the lowest and highest value of each trigger label in each
+### of a fixed number of frame buckets, so dropped frames stay visible. The traces of all images are stored as one deflate compressed blob of
+### 16 bit values in the page and drawn by the browser when they are scrolled into view; the page can be filtered on CrossedTrigs, the number
+### of dropped frames and the method that produced the triggers.
+### usage: python qcReport.py rawOrganizedData/ preprocOutputDir/ triggerFix.csv qcFigs/qcReport.html
+import os
+import glob
+import json
+import math
+import zlib
+import base64
+import argparse
+import natsort
+import numpy as np
+import pandas as pd
+from tsCache import getMeanTS, getPreviewStep, loadCached, setCacheDir, statKind
+from buildManifest import readManifest
+from controlSheet import ControlSheet
+from dataIndex import imageOutDir, parseImageName
+from qcRender import fitLabels
+
+# trigger labels drawn in the report: 0 marks frames of an image without a trigger file
+REPORT_LABELS = (0, 1, 2, 3)
+
+# value marking a bucket without frames of a label
+EMPTY_BUCKET = 65535
+
+DEFAULT_BUCKETS = 1000
+
+### downsampleTrace: lowest and highest value of meanTS over the frames of each label in REPORT_LABELS, per bucket of bucketSize frames
+###     returns (bucketSize, lows, highs), lows and highs of shape (len(REPORT_LABELS), nBuckets) with NaN for buckets without frames of a label
+def downsampleTrace(meanTS, labels, maxBuckets = DEFAULT_BUCKETS):
+    nFrames = len(meanTS)
+    bucketSize = max(1, math.ceil(nFrames/maxBuckets))
+    nBuckets = math.ceil(nFrames/bucketSize)
+    buckets = np.arange(nFrames)//bucketSize
+
+    lows = np.full((len(REPORT_LABELS), nBuckets), np.inf)
+    highs = np.full((len(REPORT_LABELS), nBuckets), -np.inf)
+    for i, label in enumerate(REPORT_LABELS):
+        mask = labels == label
+        np.minimum.at(lows[i], buckets[mask], meanTS[mask])
+        np.maximum.at(highs[i], buckets[mask], meanTS[mask])
+    lows[np.isinf(lows)] = np.nan
+    highs[np.isinf(highs)] = np.nan
+    return bucketSize, lows, highs
+
+### quantizeTrace: lows and highs as uint16 between lo (0) and hi (EMPTY_BUCKET - 1), empty buckets as EMPTY_BUCKET
+def quantizeTrace(lows, highs, lo, hi):
+    scale = (EMPTY_BUCKET - 1)/(hi - lo) if hi > lo else 0
+    packed = np.full((2,) + lows.shape, EMPTY_BUCKET, dtype = '<u2')
+    for i, arr in enumerate([lows, highs]):
+        full = ~np.isnan(arr)
+        packed[i][full] = np.round((arr[full] - lo)*scale)
+    return packed
+
+### trigsMethod: how the trigger file of an image was made, from its manifest (see buildManifest)
+def trigsMethod(trigPath):
+    if not os.path.isfile(trigPath):
+        return 'none'
+    manifest = readManifest(trigPath)
+    if manifest is None:
+        return 'unknown'
+    if manifest.get('step') == 'trigs':
+        return 'smr'
+    params = manifest.get('params', {})
+    if params.get('outputTrigs') == 'simp':
+        return 'simpFix'
+    if params.get('outputTrigs') == 'manual':
+        return 'manual'
+    if params.get('splitMethod') in ('dbscan', 'gap'):
+        return params['splitMethod']
+    return 'autoFix'
+
+### sheetFlag: 0/1 value of a control sheet flag, 0 when it is empty
+def sheetFlag(sheet, image, col):
+    return 1 if sheet.get(image, col) == 1 else 0
+
+### reportImage: metadata and packed trace of one image, None if its mean time series is not available
+def reportImage(tifPath, opDir, sheet, maxBuckets = DEFAULT_BUCKETS, cachedOnly = False):
+    image = os.path.basename(tifPath).split('.')[0]
+    labels = parseImageName(image)
+
+    meanTS = loadCached(tifPath, 'meanTS') if cachedOnly else getMeanTS(tifPath)
+    # images only looked at with --preview have the preview mean time series instead
+    if meanTS is None and getPreviewStep() > 0:
+        meanTS = loadCached(tifPath, statKind('mean', getPreviewStep()))
+    if meanTS is None:
+        return None, None
+    meanTS = np.asarray(meanTS, dtype = float)
+    nFrames = len(meanTS)
+
+    info = {'image': image, 'nFrames': nFrames, 'crossedTrigs': sheetFlag(sheet, image, 'CrossedTrigs'),
+            'autoFix': sheetFlag(sheet, image, 'autoFix'), 'simpFix': sheetFlag(sheet, image, 'simpFix'),
+            'writeImgs': sheetFlag(sheet, image, 'writeImgs'), 'nTrigs': 0, 'nCyan': 0, 'nUv': 0, 'nDropped': 0,
+            'method': 'none', 'split': False}
+    if labels is not None:
+        info.update({'dataset': labels['dataset'], 'session': labels['session'], 'animal': labels['animal'], 'run': labels['run'],
+                     'task': labels['task'], 'part': labels['part']})
+
+    frameLabels = np.zeros(nFrames, dtype = int)
+    if labels is not None:
+        outDir = imageOutDir(opDir, image, labels)
+        trigPath = os.path.join(outDir, 'OpticalOrder.csv')
+        info['method'] = trigsMethod(trigPath)
+        info['split'] = os.path.isfile(os.path.join(outDir, 'rawsignl.nii.gz'))
+        if os.path.isfile(trigPath):
+            trigs = pd.read_csv(trigPath)['opticalOrder'].values
+            info['nTrigs'] = len(trigs)
+            info['nCyan'], info['nUv'], info['nDropped'] = [int(np.sum(trigs == label)) for label in (1, 2, 3)]
+            if len(trigs) > 0:
+                frameLabels = fitLabels(trigs, nFrames)
+
+    finite = meanTS[np.isfinite(meanTS)]
+    lo, hi = (float(finite.min()), float(finite.max())) if len(finite) > 0 else (0.0, 0.0)
+    bucketSize, lows, highs = downsampleTrace(meanTS, frameLabels, maxBuckets)
+    info.update({'lo': lo, 'hi': hi, 'bucketSize': bucketSize, 'nBuckets': lows.shape[1]})
+    return info, quantizeTrace(lows, highs, lo, hi)
+
+### writeQcReport: write the report of the tifs matching orgDir/matchTemplate/*.tif to reportPath; returns the number of images in it
+###     cachedOnly leaves out the images whose mean time series is not cached yet instead of reading their tif
+def writeQcReport(orgDir, opDir, sheetPath, reportPath, matchTemplate = '*/*/*/*/', maxBuckets = DEFAULT_BUCKETS, cachedOnly = False):
+    sheet = ControlSheet.load(sheetPath)
+    tifPaths = natsort.natsorted(glob.glob(os.path.join(orgDir, matchTemplate, '*.tif')))
+
+    images = []
+    traces = []
+    missing = []
+    offset = 0
+    for tifPath in tifPaths:
+        info, packed = reportImage(tifPath, opDir, sheet, maxBuckets, cachedOnly)
+        if info is None:
+            missing.append(os.path.basename(tifPath))
+            continue
+        info['offset'] = offset
+        offset = offset + packed.size
+        images.append(info)
+        traces.append(packed.ravel())
+
+    blob = np.concatenate(traces).astype('<u2').tobytes() if len(traces) > 0 else b''
+    meta = {'labels': list(REPORT_LABELS), 'empty': EMPTY_BUCKET, 'images': images, 'missing': missing,
+            'orgDir': os.path.abspath(orgDir), 'opDir': os.path.abspath(opDir), 'sheet': os.path.abspath(sheetPath)}
+
+    page = REPORT_TEMPLATE.replace('__META__', json.dumps(meta).replace('</', '<\\/'))
+    page = page.replace('__BLOB__', base64.b64encode(zlib.compress(blob, 6)).decode('ascii'))
+
+    if os.path.dirname(reportPath) != '' and not os.path.isdir(os.path.dirname(reportPath)):
+        os.makedirs(os.path.dirname(reportPath))
+    tmpPath = reportPath + '.part'
+    with open(tmpPath, 'w') as f:
+        f.write(page)
+    os.replace(tmpPath, reportPath)
+    return len(images)
+
+REPORT_TEMPLATE = '''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Trigger QC report</title>
+<style>
+body { font-family: sans-serif; margin: 1em; }
+#filters { position: sticky; top: 0; background: #fff; padding: 0.5em 0; border-bottom: 1px solid #ccc; z-index: 1; }
+#filters label { margin-right: 1.5em; }
+.card { margin: 0.8em 0; }
+.card .name { font-weight: bold; }
+.card .stats { color: #555; font-size: 0.9em; }
+.card canvas { border: 1px solid #ddd; display: block; }
+.dropped { color: #c00; }
+.legend span { margin-right: 1em; }
+</style>
+</head>
+<body>
+<h2>Trigger QC report</h2>
+<div class="legend"><span style="color:blue">&#9679; Cyan</span><span style="color:#cc0">&#9679; Ultraviolet</span>
+<span style="color:red">&#9679; Dropped</span><span style="color:gray">&#9679; No triggers</span></div>
+<div id="filters">
+<label>CrossedTrigs <select id="fCrossed"><option value="any">any</option><option value="1">flagged</option><option value="0">not flagged</option></select></label>
+<label>Dropped frames &ge; <input id="fDropped" type="number" min="0" value="0" style="width:5em"></label>
+<label>Triggers from <select id="fMethod"><option value="any">any</option></select></label>
+<label>Name contains <input id="fName" type="text"></label>
+<span id="count"></span>
+</div>
+<div id="cards"></div>
+<div id="missing"></div>
+<script id="meta" type="application/json">__META__</script>
+<script id="blob" type="application/octet-stream">__BLOB__</script>
+<script>
+const meta = JSON.parse(document.getElementById('meta').textContent);
+const colors = {0: 'rgba(128,128,128,0.6)', 1: 'rgba(0,0,255,0.5)', 2: 'rgba(200,200,0,0.6)', 3: 'rgba(255,0,0,0.9)'};
+let values = null;
+
+async function decodeBlob() {
+  const text = document.getElementById('blob').textContent.trim();
+  const bytes = Uint8Array.from(atob(text), c => c.charCodeAt(0));
+  const stream = new Blob([bytes]).stream().pipeThrough(new DecompressionStream('deflate'));
+  return new Uint16Array(await new Response(stream).arrayBuffer());
+}
+
+function drawTrace(canvas, img) {
+  const ctx = canvas.getContext('2d');
+  const w = canvas.width, h = canvas.height, pad = 4;
+  const nb = img.nBuckets, nl = meta.labels.length;
+  ctx.clearRect(0, 0, w, h);
+  meta.labels.forEach((label, li) => {
+    ctx.fillStyle = colors[label];
+    const lowAt = img.offset + li*nb, highAt = img.offset + (nl + li)*nb;
+    for (let b = 0; b < nb; b++) {
+      const lo = values[lowAt + b], hi = values[highAt + b];
+      if (lo === meta.empty) continue;
+      const x = pad + (b + 0.5)/nb*(w - 2*pad);
+      const yHi = h - pad - hi/(meta.empty - 1)*(h - 2*pad), yLo = h - pad - lo/(meta.empty - 1)*(h - 2*pad);
+      ctx.fillRect(x - 1, yHi - 1, 2, Math.max(2, yLo - yHi + 2));
+    }
+  });
+  ctx.fillStyle = '#333';
+  ctx.fillText(img.hi.toFixed(1), 2, 10);
+  ctx.fillText(img.lo.toFixed(1), 2, h - 2);
+}
+
+const observer = new IntersectionObserver(entries => {
+  entries.forEach(entry => {
+    if (entry.isIntersecting && values !== null) {
+      drawTrace(entry.target, meta.images[entry.target.dataset.index]);
+      observer.unobserve(entry.target);
+    }
+  });
+});
+
+function makeCard(img, index) {
+  const card = document.createElement('div');
+  card.className = 'card';
+  const name = document.createElement('div');
+  name.className = 'name';
+  name.textContent = img.image;
+  const stats = document.createElement('div');
+  stats.className = 'stats';
+  stats.innerHTML = img.nFrames + ' frames, ' + img.nTrigs + ' triggers (' + img.nCyan + ' cyan, ' + img.nUv + ' UV, ' +
+    '<span class="' + (img.nDropped > 0 ? 'dropped' : '') + '">' + img.nDropped + ' dropped</span>), triggers from ' + img.method +
+    (img.crossedTrigs ? ', CrossedTrigs' : '') + (img.autoFix ? ', autoFix' : '') + (img.simpFix ? ', simpFix' : '') +
+    (img.split ? ', split' : ', not split') + (img.nTrigs > 0 && img.nTrigs !== img.nFrames ? ', <span class="dropped">trigger count differs from frame count</span>' : '');
+  const canvas = document.createElement('canvas');
+  canvas.width = 1000;
+  canvas.height = 140;
+  canvas.dataset.index = index;
+  card.append(name, stats, canvas);
+  observer.observe(canvas);
+  return card;
+}
+
+function applyFilters() {
+  const crossed = document.getElementById('fCrossed').value;
+  const dropped = Number(document.getElementById('fDropped').value) || 0;
+  const method = document.getElementById('fMethod').value;
+  const text = document.getElementById('fName').value;
+  let shown = 0;
+  meta.images.forEach(img => {
+    const ok = (crossed === 'any' || String(img.crossedTrigs) === crossed) && img.nDropped >= dropped &&
+      (method === 'any' || img.method === method) && img.image.includes(text);
+    img.card.style.display = ok ? '' : 'none';
+    shown += ok ? 1 : 0;
+  });
+  document.getElementById('count').textContent = shown + ' of ' + meta.images.length + ' images';
+}
+
+const methodSelect = document.getElementById('fMethod');
+[...new Set(meta.images.map(img => img.method))].sort().forEach(m => methodSelect.add(new Option(m, m)));
+const cards = document.getElementById('cards');
+meta.images.forEach((img, i) => { img.card = makeCard(img, i); cards.append(img.card); });
+if (meta.missing.length > 0) {
+  document.getElementById('missing').textContent = 'No mean time series cached for: ' + meta.missing.join(', ');
+}
+['fCrossed', 'fDropped', 'fMethod', 'fName'].forEach(id => document.getElementById(id).addEventListener('input', applyFilters));
+applyFilters();
+decodeBlob().then(v => {
+  values = v;
+  document.querySelectorAll('canvas').forEach(c => { observer.unobserve(c); observer.observe(c); });
+});
+</script>
+</body>
+</html>
+'''
+
+
+if __name__ == '__main__':
+
+    parser=argparse.ArgumentParser(description='Write a single HTML page for reviewing the trigger splits of all images')
+    parser.add_argument('orgDir',type=str,help='Path to the organized raw data (.tif and .smr files)')
+    parser.add_argument('opDir',type=str,help='Path to the output directory of genTrigsNii.py')
+    parser.add_argument('trigReplaceDf',type=str,help='Path to csv file which controls the semi automatic generation of trigger files')
+    parser.add_argument('reportPath',type=str,help='Path of the HTML page to write')
+    parser.add_argument('--matchTemplate',type=str,help='a string to feed to glob to match certain sessions/cell types for example: SLC/ses-*/animal*/ca2/ will do all SLC data',default='*/*/*/*/')
+    parser.add_argument('--buckets',type=int,help='number of points each time series is reduced to, default '+str(DEFAULT_BUCKETS),default=DEFAULT_BUCKETS)
+    parser.add_argument('--cachedOnly',action='store_true',help='leave out images whose mean time series is not cached instead of reading their tif')
+    parser.add_argument('--cacheDir',type=str,help='directory for the cache of per-frame mean time series, default ~/.cache/ca2dataScripts',default=None)
+
+    args=parser.parse_args()
+
+    setCacheDir(args.cacheDir)
+    nImages = writeQcReport(args.orgDir, args.opDir, args.trigReplaceDf, args.reportPath, args.matchTemplate, args.buckets, args.cachedOnly)
+    print('Wrote', nImages, 'images to', args.reportPath)
@@ -4,16 +4,20 @@ import pandas as pd
 import nibabel as nb
 import scipy as sp
 import pdb
-import glob
 import argparse
+from niiIO import OUTPUT_DTYPES, concatNii, setGzipOptions
+from buildManifest import isDryRun, needsBuild, plannedGlob, recordBuild, recordCommand, setBuildOptions, willExist
+from dataIndex import indexedExists, indexedGlob, indexedWalk, refreshPipelineIndex, setIndexOptions
 
 
-def runBiswebCa2(ipDict,hpc=0):
+def runBiswebCa2(ipDict,hpc=0,build=None):
 
     '''
     Run the bisweb script via the command line here
     Provide all arguments for the script in the input
-    dictionary
+    dictionary. build is the (step, outputs, inputs, params)
+    of the run (see biswebBuild), its manifests are written
+    once the outputs exist
     '''
 
     acceptableTerms = ['pythonPath','calPreprocPath','signal','noise','opticalorder','segnum','createmcref','createmask','signalout','noiseout','debug','workdir','mcrefsignal','mcrefnoise','mask','runoption']
@@ -28,22 +32,47 @@ def runBiswebCa2(ipDict,hpc=0):
 
     if hpc == 0:
         os.system(cmd)
+        if build is not None and all([os.path.isfile(op) for op in build[1]]):
+            recordBuild(*build)
 
     else:
+        # the job records the manifests itself once it has run
+        if build is not None:
+            cmd = cmd + ' && ' + recordCommand(*build)
         with open('joblistglob.txt','a') as f:
             f.write(cmd+'\n')
 
 
 
-def concatNiftis(ippaths,oppath):
+def biswebBuild(step,ipDict,inputKeys):
 
-    fileObjs = [nb.Nifti1Image.load(ip) for ip in ippaths]
+    '''
+    Describe a bisweb run for the build manifests: its outputs
+    are the signal and noise outputs, its inputs the files
+    under inputKeys, and every other argument is a parameter
+    '''
+
+    outputKeys = ['signalout','noiseout']
+    params = {k:v for k,v in ipDict.items() if k not in inputKeys+outputKeys}
 
-    opArr = np.concatenate([fO.get_fdata() for fO in fileObjs],axis=-1)
+    return step, [ipDict[k] for k in outputKeys], [ipDict[k] for k in inputKeys], params
 
-    opImg = nb.Nifti1Image(opArr,fileObjs[0].affine)
 
-    nb.save(opImg,oppath)
+
+def concatNiftis(ippaths,oppath,outDtype=None):
+
+    '''
+    Concatenate NIfTI files along the last axis and save
+    the result in the stored dtype and scaling of the parts,
+    or with the dtype given by the outDtype policy (see
+    niiIO.OUTPUT_DTYPES) when one is given, falling back to
+    a wider float dtype if the values cannot be stored exactly.
+    The parts are streamed a block at a time (see
+    niiIO.concatNii), after checking from their headers
+    that their volume shapes and affines match
+    '''
+
+    concatNii(ippaths,oppath,outDtype)
 
 
 
@@ -59,6 +88,14 @@ if __name__ == '__main__':
     parser.add_argument('singPath',type=str,help='Path to bisweb calcium preproc singularity file')
     parser.add_argument('--tag',type=str,help='substring to run only subset of data',default='ses') 
     parser.add_argument('--hpc',type=str,help='If true will print commands to text file called joblist.txt',default=0) 
+    parser.add_argument('--gzipThreads',type=int,help='number of threads used to compress the .nii.gz outputs, default all cores',default=None)
+    parser.add_argument('--gzipLevel',type=int,help='gzip compression level (1-9) of the .nii.gz outputs, default 1',default=None)
+    parser.add_argument('--outDtype',type=str,choices=OUTPUT_DTYPES,help='data type of the concatenated NIfTI files, default the stored type of the parts; falls back to a float type if the values cannot be stored exactly',default=None)
+    parser.add_argument('--dry-run','--dryRun',dest='dryRun',action='store_true',help='print which outputs would be built and why, without running anything')
+    parser.add_argument('--rebuildUnrecorded',action='store_true',help='rebuild existing outputs that have no build manifest yet, instead of taking the complete ones as up to date and writing their manifests')
+    parser.add_argument('--adoptOutputs',action='store_true',help=argparse.SUPPRESS)
+    parser.add_argument('--indexPath',type=str,help='path to the index of the raw data and outputs (see dataIndex.py), default dataIndex.sqlite in the cache directory',default=None)
+    parser.add_argument('--noIndex',action='store_true',help='list the output directory from the file system instead of the index')
 
     args=parser.parse_args()
 
@@ -71,10 +108,18 @@ if __name__ == '__main__':
     humanMadeMasks = args.humanMadeMasks
     ftags = args.tag.split(',')
     hpc = args.hpc
+    outDtype = args.outDtype
+    setGzipOptions(args.gzipThreads, args.gzipLevel)
+    # outputs are only rebuilt when their inputs or parameters changed (see buildManifest.py)
+    setBuildOptions(dryRun = args.dryRun, adopt = not args.rebuildUnrecorded)
+    # the output directory is listed from the index, which only lists directories that changed since the last run (see dataIndex.py)
+    setIndexOptions(not args.noIndex, args.indexPath)
+    if not isDryRun():
+        refreshPipelineIndex(opDir = opdir, jobs = os.cpu_count() or 1)
 
 
     # Walk through input directory
-    for root,dirs,fs in sorted(os.walk(opdir)):
+    for root,dirs,fs in sorted(indexedWalk(opdir)):
         for f in sorted(fs):
             if f == 'rawsignl.nii.gz' and all([ft in root for ft in ftags]):
 
@@ -107,7 +152,7 @@ if __name__ == '__main__':
 
                 pathToFirst = root.replace('EPI'+str(epiNum), 'EPI1').replace('part-0'+str(partNum-1), 'part-00').replace(stim,'*')
 
-                pathToFirst = glob.glob(pathToFirst)
+                pathToFirst = indexedGlob(pathToFirst)
 
                 if len(pathToFirst) == 1:
                     pathToFirst = pathToFirst[0]
@@ -162,25 +207,27 @@ if __name__ == '__main__':
 
                 
 
-                checkIps = [os.path.isfile(ipDict[ipF]) for ipF in checkIpsList]
+                checkIps = indexedExists([ipDict[ipF] for ipF in checkIpsList])
  
                 ipDict2 = ipDict
                 del ipDict2['mask']
 
-                checkIps2 = [os.path.isfile(ipDict2[ipF]) for ipF in checkIpsList if ipF != 'mask']
+                checkIps2 = indexedExists([ipDict2[ipF] for ipF in checkIpsList if ipF != 'mask'])
+
+                spatialBuild = biswebBuild('preprocSpatial',ipDict2,[ipF for ipF in checkIpsList if ipF != 'mask'])
 
-                if all(checkIps2) and not os.path.isfile(lastFile):
+                if all(checkIps2) and needsBuild(*spatialBuild):
 
                     print('Calculating for ',ippath)
-                    runBiswebCa2(ipDict2,hpc=hpc)
+                    runBiswebCa2(ipDict2,hpc=hpc,build=spatialBuild)
 
                 #spatialSignlFilePath = os.path.join(opdir,cellType,sesh,animalNum,'ca2/',f.split('.')[0].split('_part')[0],'part-*','signl_out.nii.gz')
                 spatialSignlFilePath = os.path.join('/'.join(root.split('/')[:-1]),'part-*', 'signl_out.nii.gz')
                 #spatialNoiseFilePath = os.path.join(opdir,cellType,sesh,animalNum,'ca2/',f.split('.')[0].split('_part')[0],'part-*','noise_out.nii.gz')
                 spatialNoiseFilePath = os.path.join('/'.join(root.split('/')[:-1]),'part-*', 'noise_out.nii.gz')
 
-                spatialSignlFiles = sorted(glob.glob(spatialSignlFilePath))
-                spatialNoiseFiles = sorted(glob.glob(spatialNoiseFilePath))
+                spatialSignlFiles = plannedGlob(spatialSignlFilePath)
+                spatialNoiseFiles = plannedGlob(spatialNoiseFilePath)
 
 
 
@@ -192,10 +239,12 @@ if __name__ == '__main__':
                     threePartSignlPath = os.path.join('/'.join(root.split('/')[:-1]),'rawsignl_smooth4_mococombo_threeparts.nii.gz')
                     threePartNoisePath = os.path.join('/'.join(root.split('/')[:-1]),'rawnoise_smooth4_mococombo_threeparts.nii.gz')
 
-                    if not os.path.isfile(threePartSignlPath):
-                        concatNiftis(spatialSignlFiles,threePartSignlPath)
-                    if not os.path.isfile(threePartNoisePath):
-                        concatNiftis(spatialNoiseFiles,threePartNoisePath)
+                    if needsBuild('concat',[threePartSignlPath],spatialSignlFiles,{'outDtype':outDtype}):
+                        concatNiftis(spatialSignlFiles,threePartSignlPath,outDtype)
+                        recordBuild('concat',[threePartSignlPath],spatialSignlFiles,{'outDtype':outDtype})
+                    if needsBuild('concat',[threePartNoisePath],spatialNoiseFiles,{'outDtype':outDtype}):
+                        concatNiftis(spatialNoiseFiles,threePartNoisePath,outDtype)
+                        recordBuild('concat',[threePartNoisePath],spatialNoiseFiles,{'outDtype':outDtype})
                 
 
 
@@ -223,12 +272,13 @@ if __name__ == '__main__':
 
                     checkIpsList = ['signal','noise','mask']
 
-                    checkIps = [os.path.isfile(ipDict[ipF]) for ipF in checkIpsList]
- 
+                    checkIps = [willExist(ipDict[ipF]) for ipF in checkIpsList]
+
+                    temporalBuild = biswebBuild('preprocTemporal',ipDict,checkIpsList)
              
-                    if all(checkIps) and not os.path.isfile(lastFile):
+                    if all(checkIps) and needsBuild(*temporalBuild):
                         if not os.path.isdir(oppath):
                             os.makedirs(oppath)
                         print('Running temporal preprocessing for ', f.split('.')[0].split('_part')[0])
-                        runBiswebCa2(ipDict,hpc=hpc)
+                        runBiswebCa2(ipDict,hpc=hpc,build=temporalBuild)
 
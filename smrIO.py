@@ -0,0 +1,262 @@
+### smrIO.py: native reader for the CED SON (.smr) files written by Spike2, no neo or MATLAB needed
+### Modelled on the bundled son/ MATLAB library (SONFileHeader, SONChannelInfo, SONGetBlockHeaders, SONGetADCChannel).
+### Only the file and channel headers are parsed when a file is opened. The first time a channel is used its chain of data blocks is
+### walked once to build a block index (file position, first sample, start/end time and number of samples of every block), and the
+### samples of any range of the channel are then read from the memory mapped file, as int16 or scaled to the channel units on demand.
+### Parse time and memory therefore scale with the channels (and spans) that are used rather than with everything the rig recorded.
+### usage: from smrIO import openSmrReader, readSmrChannel; reader = openSmrReader(smrPath); trig = readSmrChannel(reader, 'Trigger')
+import os
+import numpy as np
+import pandas as pd
+
+# file header: the first 512 bytes of the file (SONFileHeader)
+SON_FILE_HEADER = np.dtype([('systemID', '<i2'), ('copyright', 'S10'), ('creator', 'S8'), ('usPerTime', '<i2'), ('timePerADC', '<i2'),
+                            ('fileState', '<i2'), ('firstData', '<i4'), ('channels', '<i2'), ('chanSize', '<i2'), ('extraData', '<i2'),
+                            ('bufferSize', '<i2'), ('osFormat', '<i2'), ('maxFTime', '<i4'), ('dTimeBase', '<f8'), ('timeDetail', 'u1', 6),
+                            ('timeYear', '<i2'), ('pad', 'S52'), ('fileComment', 'S80', 5)])
+
+# channel header: 140 bytes per channel following the file header (SONChannelInfo); the last 16 bytes depend on the channel kind,
+# for waveform channels (kinds 1, 6, 7 and 9) they hold scale (min), offset (max), units and divide (SON < 6) or interleave
+SON_CHANNEL_HEADER = np.dtype([('delSize', '<i2'), ('nextDelBlock', '<i4'), ('firstBlock', '<i4'), ('lastBlock', '<i4'), ('blocks', '<u2'),
+                               ('nExtra', '<i2'), ('preTrig', '<i2'), ('blocksMSW', '<u2'), ('phySz', '<i2'), ('maxData', '<i2'),
+                               ('comment', 'S72'), ('maxChanTime', '<i4'), ('lChanDvd', '<i4'), ('phyChan', '<i2'), ('title', 'S10'),
+                               ('idealRate', '<f4'), ('kind', 'u1'), ('pad', 'i1'), ('scale', '<f4'), ('offset', '<f4'), ('units', 'S6'),
+                               ('divide', '<i2')])
+
+# data block header: predecessor and successor block, times of the first and last item, channel number and number of items (20 bytes)
+SON_BLOCK_HEADER = np.dtype([('predBlock', '<i4'), ('succBlock', '<i4'), ('startTime', '<i4'), ('endTime', '<i4'), ('chan', '<i2'), ('items', '<i2')])
+
+# channel kinds holding continuously sampled waveforms and the dtype of their samples on disk
+SON_WAVE_KINDS = {1: np.dtype('<i2'), 9: np.dtype('<f4')}
+SON_KIND_NAMES = {0: 'empty', 1: 'Adc', 2: 'EventFall', 3: 'EventRise', 4: 'EventBoth', 5: 'Marker', 6: 'AdcMark', 7: 'RealMark',
+                  8: 'TextMark', 9: 'RealWave'}
+
+# SON version 9 files (Spike2 big files) store block pointers in units of 512 bytes
+SON_DISK_BLOCK = 512
+
+# number of samples read per chunk by iterSmrChannel (20 s at 25 kHz)
+SMR_CHUNK_SAMPLES = 500000
+
+### pascalString: decode a length prefixed string as stored in the SON headers
+def pascalString(raw):
+    if len(raw) == 0:
+        return ''
+    return raw[1:1+raw[0]].decode('latin-1')
+
+class SonFile:
+    '''
+    Read only access to a SON (.smr) file.
+    Channels are numbered from 1 as in the son/ MATLAB library; waveform channels can also be looked up by title with channelNumber.
+    '''
+
+    def __init__(self, smrPath):
+        self.path = smrPath
+        self.fileSize = os.path.getsize(smrPath)
+        with open(smrPath, 'rb') as f:
+            raw = f.read(SON_FILE_HEADER.itemsize)
+            if len(raw) < SON_FILE_HEADER.itemsize:
+                raise ValueError(smrPath + ' is too short to be a SON file')
+            head = np.frombuffer(raw, dtype = SON_FILE_HEADER)[0]
+            nChannels = int(head['channels'])
+            raw = f.read(nChannels*SON_CHANNEL_HEADER.itemsize)
+            if nChannels <= 0 or len(raw) < nChannels*SON_CHANNEL_HEADER.itemsize:
+                raise ValueError(smrPath + ' has a missing or truncated channel header table')
+            chans = np.frombuffer(raw, dtype = SON_CHANNEL_HEADER)
+
+        self.fileHeader = head
+        self.systemID = int(head['systemID'])
+        self.usPerTime = int(head['usPerTime'])
+        self.timePerADC = int(head['timePerADC'])
+        # the time base is only stored from SON version 6 on, earlier files count in microseconds
+        self.dTimeBase = float(head['dTimeBase']) if self.systemID >= 6 else 1e-6
+        self.tickSeconds = self.usPerTime*self.dTimeBase
+        self.blockUnit = SON_DISK_BLOCK if self.systemID >= 9 else 1
+
+        self.channels = {}
+        for i, ch in enumerate(chans):
+            kind = int(ch['kind'])
+            if kind == 0:
+                continue
+            info = {'chan': i+1, 'kind': kind, 'title': pascalString(ch['title']), 'comment': pascalString(ch['comment']),
+                    'phyChan': int(ch['phyChan']), 'firstBlock': int(ch['firstBlock']), 'blocks': int(ch['blocks']),
+                    'maxChanTime': int(ch['maxChanTime']), 'idealRate': float(ch['idealRate']), 'nExtra': int(ch['nExtra'])}
+            if self.systemID >= 9:
+                info['blocks'] += int(ch['blocksMSW']) << 16
+            if kind in SON_WAVE_KINDS:
+                info['units'] = pascalString(ch['units'])
+                info['scale'] = float(ch['scale'])
+                info['offset'] = float(ch['offset'])
+                # sample interval in clock ticks (SONGetSampleInterval)
+                if self.systemID < 6:
+                    info['interval'] = int(ch['divide'])*self.timePerADC
+                else:
+                    info['interval'] = int(ch['lChanDvd'])
+            self.channels[i+1] = info
+
+        self.blockIndexes = {}
+        self.fileMap = None
+
+    ### channelNumber: number of the waveform channel with the given title
+    def channelNumber(self, title):
+        for chan, info in self.channels.items():
+            if info['title'] == title and info['kind'] in SON_WAVE_KINDS:
+                return chan
+        raise KeyError('no waveform channel called ' + title + ' in ' + self.path)
+
+    ### sampleRate: sampling rate of a waveform channel in Hz
+    def sampleRate(self, chan):
+        return 1.0/(self.channels[chan]['interval']*self.tickSeconds)
+
+    ### blockIndex: index of the data blocks of a channel in time order (SONGetBlockHeaders), built on first use
+    ###     structured array with the file position of the block data, the number of the first sample in the block,
+    ###     the times (clock ticks) of the first and last sample and the number of samples
+    def blockIndex(self, chan):
+        if chan in self.blockIndexes:
+            return self.blockIndexes[chan]
+
+        info = self.channels[chan]
+        fileMap = self.getFileMap()
+        entries = []
+        pos = info['firstBlock']*self.blockUnit
+        while info['blocks'] > 0 and pos >= 0:
+            if pos + SON_BLOCK_HEADER.itemsize > self.fileSize or len(entries) >= info['blocks']:
+                raise ValueError('block chain of channel %d in %s is corrupt' % (chan, self.path))
+            block = fileMap[pos:pos+SON_BLOCK_HEADER.itemsize].view(SON_BLOCK_HEADER)[0]
+            entries.append((pos + SON_BLOCK_HEADER.itemsize, block['startTime'], block['endTime'], block['items']))
+            succ = int(block['succBlock'])
+            pos = succ*self.blockUnit if succ != -1 else -1
+
+        index = np.zeros(len(entries), dtype = [('pos', 'i8'), ('first', 'i8'), ('startTime', 'i8'), ('endTime', 'i8'), ('items', 'i8')])
+        if len(entries) > 0:
+            entries = np.array(entries, dtype = np.int64)
+            index['pos'], index['startTime'], index['endTime'], index['items'] = entries.T
+            index['first'][1:] = np.cumsum(index['items'][:-1])
+
+        self.blockIndexes[chan] = index
+        return index
+
+    ### getFileMap: read only byte memory map of the whole file, opened on first use
+    def getFileMap(self):
+        if self.fileMap is None:
+            self.fileMap = np.memmap(self.path, dtype = np.uint8, mode = 'r')
+        return self.fileMap
+
+    ### channelSize: number of samples in a waveform channel
+    def channelSize(self, chan):
+        index = self.blockIndex(chan)
+        return int(index['items'].sum())
+
+    ### sampleIndex: index of the first sample of a waveform channel at or after the given time in seconds, taking gaps
+    ###     between blocks (paused recordings) into account
+    def sampleIndex(self, chan, seconds):
+        index = self.blockIndex(chan)
+        interval = self.channels[chan]['interval']
+        tick = seconds/self.tickSeconds
+        b = np.searchsorted(index['endTime'], tick, side = 'left')
+        if b == len(index):
+            return self.channelSize(chan)
+        return int(index['first'][b] + max(0, np.ceil((tick - index['startTime'][b])/interval)))
+
+    ### read: samples iStart:iStop (default: all) of a waveform channel, raw as stored (int16 for ADC channels) or scaled to the
+    ###     channel units as scale*adc/6553.6 + offset (SONADCToDouble) in the given dtype
+    def read(self, chan, iStart = None, iStop = None, scale = True, dtype = np.float32):
+        info = self.channels[chan]
+        if info['kind'] not in SON_WAVE_KINDS:
+            raise ValueError('channel %d of %s is a %s channel, not a waveform' % (chan, self.path, SON_KIND_NAMES.get(info['kind'], 'unknown')))
+
+        index = self.blockIndex(chan)
+        nSamples = self.channelSize(chan)
+        iStart = 0 if iStart is None else min(max(int(iStart), 0), nSamples)
+        iStop = nSamples if iStop is None else min(max(int(iStop), iStart), nSamples)
+
+        diskDtype = SON_WAVE_KINDS[info['kind']]
+        out = np.empty(iStop - iStart, dtype = diskDtype)
+        fileMap = self.getFileMap()
+        b0 = max(np.searchsorted(index['first'], iStart, side = 'right') - 1, 0)
+        b1 = np.searchsorted(index['first'], iStop, side = 'left')
+        for b in range(b0, b1):
+            lo = max(iStart, index['first'][b])
+            hi = min(iStop, index['first'][b] + index['items'][b])
+            pos = index['pos'][b] + (lo - index['first'][b])*diskDtype.itemsize
+            out[lo-iStart:hi-iStart] = fileMap[pos:pos+(hi-lo)*diskDtype.itemsize].view(diskDtype)
+
+        if not scale:
+            return out
+        if info['kind'] == 9:
+            return out.astype(dtype)
+        data = out.astype(dtype)
+        data *= data.dtype.type(info['scale']/6553.6)
+        data += data.dtype.type(info['offset'])
+        return data
+
+    ### readItems: all items of an event (kinds 2 to 4) or marker (kinds 5 to 8) channel as a structured array with the time of each item
+    ###     in clock ticks ('tick') and, for marker channels, the four marker codes ('markers') and the attached data ('extra', nExtra bytes)
+    def readItems(self, chan):
+        info = self.channels[chan]
+        if info['kind'] in (2, 3, 4):
+            itemDtype = np.dtype([('tick', '<i4')])
+        elif info['kind'] in (5, 6, 7, 8):
+            fields = [('tick', '<i4'), ('markers', 'u1', 4)]
+            if info['nExtra'] > 0:
+                fields.append(('extra', 'u1', info['nExtra']))
+            itemDtype = np.dtype(fields)
+        else:
+            raise ValueError('channel %d of %s is a %s channel, not an event or marker channel' % (chan, self.path, SON_KIND_NAMES.get(info['kind'], 'unknown')))
+
+        index = self.blockIndex(chan)
+        fileMap = self.getFileMap()
+        items = np.empty(int(index['items'].sum()), dtype = itemDtype)
+        for b in range(len(index)):
+            first, n = index['first'][b], index['items'][b]
+            items[first:first+n] = fileMap[index['pos'][b]:index['pos'][b]+n*itemDtype.itemsize].view(itemDtype)
+        return items
+
+    ### close: release the memory map
+    def close(self):
+        self.fileMap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        self.close()
+        return False
+
+### openSmrReader: open an smr file and parse its file and channel headers, no samples are read
+def openSmrReader(smrPath):
+    return SonFile(smrPath)
+
+### smrChannelTable: dataframe with one row per waveform channel (name, chan, kind, sampling_rate, dtype, units, gain, offset, phyChan) of an open reader
+def smrChannelTable(reader):
+    rows = []
+    for chan, info in reader.channels.items():
+        if info['kind'] not in SON_WAVE_KINDS:
+            continue
+        gain = info['scale']/6553.6 if info['kind'] == 1 else 1.0
+        offset = info['offset'] if info['kind'] == 1 else 0.0
+        rows.append({'name': info['title'], 'chan': chan, 'kind': SON_KIND_NAMES[info['kind']], 'sampling_rate': reader.sampleRate(chan),
+                     'dtype': SON_WAVE_KINDS[info['kind']].name, 'units': info['units'], 'gain': gain, 'offset': offset, 'phyChan': info['phyChan']})
+    return pd.DataFrame(rows, columns = ['name', 'chan', 'kind', 'sampling_rate', 'dtype', 'units', 'gain', 'offset', 'phyChan'])
+
+### probeSmr: cheap header only probe of an smr file, returns the channel table described in smrChannelTable
+def probeSmr(smrPath):
+    return smrChannelTable(openSmrReader(smrPath))
+
+### smrChannelSize: number of samples in the waveform channel called name
+def smrChannelSize(reader, name):
+    return reader.channelSize(reader.channelNumber(name))
+
+### readSmrChannel: samples iStart:iStop (default: all) of the waveform channel called name, scaled to the channel units as float32
+def readSmrChannel(reader, name, iStart = None, iStop = None):
+    return reader.read(reader.channelNumber(name), iStart, iStop)
+
+### readSmrSpan: samples of the waveform channel called name recorded between tStart and tStop seconds, scaled to the channel units
+def readSmrSpan(reader, name, tStart, tStop):
+    chan = reader.channelNumber(name)
+    return reader.read(chan, reader.sampleIndex(chan, tStart), reader.sampleIndex(chan, tStop))
+
+### iterSmrChannel: yield the samples of the waveform channel called name in consecutive chunks of at most chunkSize samples
+def iterSmrChannel(reader, name, chunkSize = SMR_CHUNK_SAMPLES):
+    nSamples = smrChannelSize(reader, name)
+    for iStart in range(0, nSamples, chunkSize):
+        yield readSmrChannel(reader, name, iStart, min(iStart + chunkSize, nSamples))
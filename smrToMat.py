@@ -3,8 +3,20 @@ import time
 import subprocess as subp
 import glob
 import pdb
-import argparse 
+import argparse
+import traceback
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import h5py
+from smrIO import openSmrReader, SON_WAVE_KINDS
+from dataIndex import indexedWalk, refreshPipelineIndex, setIndexOptions
 
+# samples per HDF5 chunk of a waveform channel (about 2.6 s at 25 kHz), also the number of samples converted at a time
+MAT_CHUNK_SAMPLES = 65536
+
+# the first 512 bytes of a MAT v7.3 file are an HDF5 user block holding the MAT file header
+MAT_USERBLOCK_BYTES = 512
 
 def smrMatConv(ippath,oppath):
 
@@ -16,26 +28,220 @@ def smrMatConv(ippath,oppath):
 
     process.kill()
 
+### MAT v7.3 writing helpers: a MAT v7.3 file is an HDF5 file in which every variable carries a MATLAB_class attribute and
+### arrays are stored with their dimensions reversed (a MATLAB n x 1 column is an HDF5 1 x n dataset)
+
+### writeMatArray: write a numeric array as a MATLAB variable (1D arrays become column vectors)
+def writeMatArray(group, name, arr, **kwargs):
+    arr = np.asarray(arr)
+    if arr.ndim < 2:
+        arr = arr.reshape(-1, 1)
+    ds = group.create_dataset(name, data = arr.T, **kwargs)
+    ds.attrs['MATLAB_class'] = np.bytes_(arr.dtype.name if arr.dtype.kind != 'b' else 'logical')
+    return ds
+
+### writeMatChar: write a string as a MATLAB char row vector
+def writeMatChar(group, name, text):
+    if len(text) == 0:
+        ds = group.create_dataset(name, data = np.zeros(2, dtype = np.uint64))
+        ds.attrs['MATLAB_empty'] = np.uint8(1)
+    else:
+        ds = group.create_dataset(name, data = np.array([ord(c) for c in text], dtype = np.uint16).reshape(-1, 1))
+        ds.attrs['MATLAB_int_decode'] = np.int32(2)
+    ds.attrs['MATLAB_class'] = np.bytes_('char')
+    return ds
+
+### writeMatStruct: write a dict of strings, numbers and arrays as a MATLAB scalar struct
+def writeMatStruct(group, name, fields):
+    g = group.create_group(name)
+    g.attrs['MATLAB_class'] = np.bytes_('struct')
+    names = np.empty(len(fields), dtype = object)
+    names[:] = [np.array(list(k), dtype = 'S1') for k in fields]
+    g.attrs.create('MATLAB_fields', names, dtype = h5py.vlen_dtype(np.dtype('S1')))
+    for k, v in fields.items():
+        if isinstance(v, str):
+            writeMatChar(g, k, v)
+        elif isinstance(v, dict):
+            writeMatStruct(g, k, v)
+        else:
+            writeMatArray(g, k, np.asarray(v, dtype = np.float64) if np.isscalar(v) else v)
+    return g
+
+### writeMatHeader: write the 128 byte MAT v7.3 file header into the user block of a closed HDF5 file
+def writeMatHeader(path):
+    text = 'MATLAB 7.3 MAT-file, Platform: GLNXA64, Created on: ' + datetime.now().strftime('%a %b %d %H:%M:%S %Y') + ' HDF5 schema 1.00 .'
+    with open(path, 'r+b') as f:
+        f.write(text.ljust(116).encode('ascii') + b' '*8 + b'\x00\x02' + b'IM')
+
+### smrFileInfo: the FileInfo struct written by SONImport (SONFileHeader)
+def smrFileInfo(reader, smrPath):
+    head = reader.fileHeader
+    return {'FileIdentifier': os.path.abspath(smrPath), 'systemID': int(head['systemID']), 'copyright': head['copyright'].decode('latin-1'),
+            'Creator': head['creator'].decode('latin-1'), 'usPerTime': int(head['usPerTime']), 'timePerADC': int(head['timePerADC']),
+            'filestate': int(head['fileState']), 'firstdata': int(head['firstData']), 'channels': int(head['channels']),
+            'chansize': int(head['chanSize']), 'extraData': int(head['extraData']), 'buffersize': int(head['bufferSize']),
+            'osFormat': int(head['osFormat']), 'maxFTime': int(head['maxFTime']), 'dTimeBase': reader.dTimeBase}
+
+### writeWaveChannel: stream a waveform channel into chan<N> (int16 ADC values, or double in the channel units when scale is set)
+###     and write its head<N> struct, as SONGetADCChannel does
+def writeWaveChannel(matFile, reader, chan, scale = False, compresslevel = 4):
+    info = reader.channels[chan]
+    index = reader.blockIndex(chan)
+    nSamples = reader.channelSize(chan)
+    dtype = np.float64 if scale else SON_WAVE_KINDS[info['kind']]
+
+    ds = matFile.create_dataset('chan%d' % chan, shape = (1, nSamples), dtype = dtype, chunks = (1, max(min(MAT_CHUNK_SAMPLES, nSamples), 1)),
+                                compression = 'gzip', compression_opts = compresslevel, shuffle = True)
+    ds.attrs['MATLAB_class'] = np.bytes_(np.dtype(dtype).name)
+    vMin, vMax = np.inf, -np.inf
+    for iStart in range(0, nSamples, MAT_CHUNK_SAMPLES):
+        iStop = min(iStart + MAT_CHUNK_SAMPLES, nSamples)
+        data = reader.read(chan, iStart, iStop, scale = scale, dtype = np.float64)
+        ds[0, iStart:iStop] = data
+        vMin, vMax = min(vMin, data.min()), max(vMax, data.max())
+
+    head = {'FileName': reader.path, 'system': 'SON%d' % reader.systemID, 'FileChannel': chan, 'phyChan': info['phyChan'],
+            'kind': 9 if scale else info['kind'], 'comment': info['comment'], 'title': info['title'],
+            'sampleinterval': info['interval']*reader.tickSeconds*1e6, 'scale': info['scale'], 'offset': info['offset'],
+            'min': vMin if nSamples > 0 else np.nan, 'max': vMax if nSamples > 0 else np.nan, 'units': info['units'],
+            'interleave': 1, 'mode': 'Continuous', 'npoints': nSamples,
+            'start': index['startTime'][0]*reader.tickSeconds if len(index) > 0 else 0.0,
+            'stop': index['endTime'][-1]*reader.tickSeconds if len(index) > 0 else 0.0, 'TimeUnits': 'Seconds', 'transpose': 1}
+    writeMatStruct(matFile, 'head%d' % chan, head)
+
+### writeEventChannel: write an event channel (times in seconds) or marker channel (struct of timings and marker codes) as chan<N>
+###     and its head<N> struct; the waveform, real or text payload of AdcMark, RealMark and TextMark items is not exported
+def writeEventChannel(matFile, reader, chan):
+    info = reader.channels[chan]
+    items = reader.readItems(chan)
+    timings = items['tick']*reader.tickSeconds
+
+    if info['kind'] in (2, 3, 4):
+        writeMatArray(matFile, 'chan%d' % chan, timings)
+    else:
+        writeMatStruct(matFile, 'chan%d' % chan, {'timings': timings, 'markers': items['markers']})
+
+    head = {'FileName': reader.path, 'system': 'SON%d' % reader.systemID, 'FileChannel': chan, 'phyChan': info['phyChan'],
+            'kind': info['kind'], 'npoints': len(items), 'comment': info['comment'], 'title': info['title'], 'TimeUnits': 'Seconds'}
+    writeMatStruct(matFile, 'head%d' % chan, head)
+
+### smrMatNative: convert an smr file to a MAT v7.3 (HDF5) file with the same variables as SONImport (FileInfo, chan<N>, head<N>)
+###     without MATLAB. Waveforms are stored in compressed chunks so that they can be read partially (e.g. h5py f['chan1'][0, a:b]).
+###     The size and modification time of the smr file are stored as attributes, see matUpToDate.
+###     The file is written to oppath + '.part', which replaces oppath once complete.
+def smrMatNative(ippath, oppath, scale = False, compresslevel = 4):
+    st = os.stat(ippath)
+    reader = openSmrReader(ippath)
 
+    tmpPath = oppath + '.part'
+    try:
+        with h5py.File(tmpPath, 'w', userblock_size = MAT_USERBLOCK_BYTES) as matFile:
+            matFile.attrs['sourceSize'] = np.int64(st.st_size)
+            matFile.attrs['sourceMtime'] = np.int64(st.st_mtime_ns)
+            writeMatStruct(matFile, 'FileInfo', smrFileInfo(reader, ippath))
+            for chan, info in reader.channels.items():
+                if info['kind'] in SON_WAVE_KINDS:
+                    writeWaveChannel(matFile, reader, chan, scale = scale, compresslevel = compresslevel)
+                else:
+                    writeEventChannel(matFile, reader, chan)
+        writeMatHeader(tmpPath)
+        os.replace(tmpPath, oppath)
+    except BaseException:
+        if os.path.exists(tmpPath):
+            os.remove(tmpPath)
+        raise
+    finally:
+        reader.close()
+
+### matUpToDate: True if oppath was converted by smrMatNative from the current version (same size and modification time) of ippath
+def matUpToDate(ippath, oppath):
+    if not os.path.isfile(oppath):
+        return False
+    st = os.stat(ippath)
+    try:
+        with h5py.File(oppath, 'r') as matFile:
+            return (int(matFile.attrs.get('sourceSize', -1)) == st.st_size and int(matFile.attrs.get('sourceMtime', -1)) == st.st_mtime_ns)
+    except OSError:
+        return False
+
+### convertJob: worker process entry point, returns (smr path, mat path, error message or '')
+def convertJob(ippath, oppath, scale, compresslevel):
+    try:
+        smrMatNative(ippath, oppath, scale = scale, compresslevel = compresslevel)
+        return ippath, oppath, ''
+    except Exception:
+        return ippath, oppath, traceback.format_exc()
+
+### findSmrFiles: (smr path, mat path) of every .smr file below orgDir, listed from the data index when it is used (see dataIndex.indexedWalk)
+def findSmrFiles(orgdir):
+    pairs = []
+    for root, dirs, fs in sorted(indexedWalk(orgdir)):
+        for f in sorted(fs):
+            if f.endswith('.smr'):
+                fpath = os.path.join(root,f)
+                pairs.append((fpath, os.path.splitext(fpath)[0] + '.mat'))
+    return pairs
+
+### batchConvert: convert every out of date .smr file below orgDir with smrMatNative, jobs files at a time
+def batchConvert(orgdir, jobs = 1, force = False, scale = False, compresslevel = 4):
+    pairs = findSmrFiles(orgdir)
+    todo = [(ip, op) for ip, op in pairs if force or not matUpToDate(ip, op)]
+    print('Found', len(pairs), 'smr files,', len(pairs) - len(todo), 'already converted,', len(todo), 'to convert')
+
+    failed = []
+    with ProcessPoolExecutor(max_workers = max(jobs, 1)) as pool:
+        futures = [pool.submit(convertJob, ip, op, scale, compresslevel) for ip, op in todo]
+        for future in futures:
+            ippath, oppath, err = future.result()
+            if err == '':
+                print('File written to:', oppath)
+            else:
+                print('Could not convert', ippath)
+                print(err)
+                failed.append(ippath)
+    return failed
 
 
 
 if __name__ == '__main__':
 
+    # the original interface (python smrToMat.py orgDir) converts with MATLAB, as the 'matlab' command
+    if len(sys.argv) > 1 and sys.argv[1] not in ('batch', 'matlab', '-h', '--help'):
+        sys.argv.insert(1, 'matlab')
 
     parser=argparse.ArgumentParser(description='Run script to convert smr files to mat files')
-    parser.add_argument('orgDir',type = str, help="Path to organized data directory")
+    subparsers = parser.add_subparsers(dest = 'command', required = True)
+
+    matlabParser = subparsers.add_parser('matlab', help = 'convert every smr file with MATLAB and the son library, one MATLAB process per file')
+    matlabParser.add_argument('orgDir',type = str, help="Path to organized data directory")
+
+    batchParser = subparsers.add_parser('batch', help = 'convert smr files that are new or changed since their last conversion to MAT v7.3 (HDF5) files in parallel, without MATLAB')
+    batchParser.add_argument('orgDir',type = str, help="Path to organized data directory")
+    batchParser.add_argument('--jobs',type = int, help='number of files converted in parallel worker processes, default all cores', default = os.cpu_count())
+    batchParser.add_argument('--force',action = 'store_true', help='convert all files, including those that are up to date')
+    batchParser.add_argument('--scale',action = 'store_true', help='store waveforms as double in the channel units instead of int16 ADC values')
+    batchParser.add_argument('--compressLevel',type = int, help='gzip compression level (0-9) of the waveform chunks, default 4', default = 4)
+    batchParser.add_argument('--indexPath',type = str, help='path to the index of the raw data (see dataIndex.py), default dataIndex.sqlite in the cache directory', default = None)
+    batchParser.add_argument('--noIndex',action = 'store_true', help='list the smr files from the file system instead of the index')
 
     args=parser.parse_args()
     orgdir = args.orgDir
 
+    if args.command == 'batch':
+        # the smr files are listed from the index, which only lists directories that changed since the last run (see dataIndex.py)
+        setIndexOptions(not args.noIndex, args.indexPath)
+        refreshPipelineIndex(orgDir = orgdir, jobs = args.jobs)
+        failed = batchConvert(orgdir, jobs = args.jobs, force = args.force, scale = args.scale, compresslevel = args.compressLevel)
+        if len(failed) > 0:
+            sys.exit(1)
+
+    else:
+        for root, dirs, fs in os.walk(orgdir):
+            for f in fs:
+                if f.endswith('.smr'):
+                    fpath = os.path.join(root,f)
+                    matpath = fpath.replace('.smr','.mat')
+                    print('Converting: ', fpath)
+                    smrMatConv(fpath,matpath)
+                    print('File written to:', matpath)
 
-    for root, dirs, fs in os.walk(orgdir):
-        for f in fs:
-            if f.endswith('.smr'):
-                fpath = os.path.join(root,f)
-                matpath = fpath.replace('.smr','.mat')
-                print('Converting: ', fpath)
-                smrMatConv(fpath,matpath)
-                print('File written to:', matpath)
-                
@@ -0,0 +1,303 @@
+### smrTrigs.py: decoding of the camera trigger and LED channels of the smr recordings
+### The channels are read in fixed size chunks (see smrIO.iterSmrChannel) and thresholded chunk by chunk, carrying the state needed
+### across chunk boundaries (the last sample of the previous chunk, the most recent high trigger samples), so peak memory depends on the
+### chunk size only and not on the length of the recording. Nothing longer than a chunk is ever held except the decoded edges.
+from functools import cached_property
+import numpy as np
+import pandas as pd
+from smrIO import SMR_CHUNK_SAMPLES, iterSmrChannel, openSmrReader, smrChannelSize, smrChannelTable
+
+# sampling rate of the trigger and LED channels (Hz)
+TRIG_SAMPLE_RATE = 25000
+
+# channels are high above this value (V)
+TRIG_THRESHOLD = 4
+
+# the last trigger of a recording starts at the 249th last high sample of the trigger channel,
+# and the LED channels are decoded up to 24999 samples after it
+TRIG_TAIL_SAMPLES = 249
+TRIG_WINDOW_PAD = 24999
+
+# recordings whose triggers span less than this (s) are not decoded
+MIN_TRIG_SECONDS = 550
+
+### binaryEdges: rising and falling edges (global sample indices) of a boolean chunk, given the value of the sample before it (None at the start)
+###     a rising edge is the index of the first high sample of a run, a falling edge the index of the first low sample after it
+def binaryEdges(high, prev, offset):
+    if prev is None:
+        changes = np.flatnonzero(high[1:] != high[:-1]) + 1
+    else:
+        changes = np.flatnonzero(np.diff(high, prepend = prev))
+    rising = changes[high[changes]] + offset
+    falling = changes[~high[changes]] + offset
+    return rising, falling
+
+### scanTrigger: one streaming pass over the trigger channel
+###     returns a dict with the channel maximum (trigMax), the number of high samples (nTrigHigh), the first high sample (firstTrigStart),
+###     the TRIG_TAIL_SAMPLES-th last high sample (lastTrigStart, None if there are fewer high samples) and the rising and falling edges
+def scanTrigger(reader, trigName, chunkSize = SMR_CHUNK_SAMPLES):
+    trigMax = -np.inf
+    nHigh = 0
+    first = None
+    tail = np.zeros(0, dtype = np.int64)
+    rising, falling = [], []
+    prev = None
+    offset = 0
+
+    for chunk in iterSmrChannel(reader, trigName, chunkSize):
+        trigMax = max(trigMax, chunk.max())
+        high = chunk > TRIG_THRESHOLD
+        highIdx = np.flatnonzero(high) + offset
+        if len(highIdx) > 0:
+            if first is None:
+                first = int(highIdx[0])
+            nHigh += len(highIdx)
+            tail = np.concatenate([tail, highIdx[-TRIG_TAIL_SAMPLES:]])[-TRIG_TAIL_SAMPLES:]
+
+        r, f = binaryEdges(high, prev, offset)
+        rising.append(r)
+        falling.append(f)
+        prev = high[-1]
+        offset += len(chunk)
+
+    return {'trigMax': trigMax, 'nTrigHigh': nHigh, 'firstTrigStart': first,
+            'lastTrigStart': int(tail[0]) if len(tail) == TRIG_TAIL_SAMPLES else None,
+            'trigRising': np.concatenate(rising + [np.zeros(0, dtype = np.int64)]),
+            'trigFalling': np.concatenate(falling + [np.zeros(0, dtype = np.int64)])}
+
+### scanLeds: one streaming pass over the cyan and UV LED channels
+###     returns the maxima of both channels (led1Max, led2Max) and, within samples [winStart, winStop), the run compressed LED code
+###     2*(cyanName high) + (uvName high): opticalOrder holds the code (2 first channel, 1 second channel, 3 both) of every lit run that ends inside the window, in order,
+###     and frameStarts/frameEnds its first sample and the first sample after it
+def scanLeds(reader, cyanName, uvName, winStart = 0, winStop = None, chunkSize = SMR_CHUNK_SAMPLES):
+    nSamples = min(smrChannelSize(reader, cyanName), smrChannelSize(reader, uvName))
+    winStop = nSamples if winStop is None else min(winStop, nSamples)
+
+    led1Max, led2Max = -np.inf, -np.inf
+    order, starts, ends = [], [], []
+    prev = None
+    runStart = winStart
+    offset = 0
+
+    for chunk1, chunk2 in zip(iterSmrChannel(reader, cyanName, chunkSize), iterSmrChannel(reader, uvName, chunkSize)):
+        led1Max = max(led1Max, chunk1.max())
+        led2Max = max(led2Max, chunk2.max())
+
+        lo = max(winStart - offset, 0)
+        hi = min(winStop - offset, len(chunk1), len(chunk2))
+        if hi > lo:
+            code = 2*(chunk1[lo:hi] > TRIG_THRESHOLD).astype(np.int8) + (chunk2[lo:hi] > TRIG_THRESHOLD)
+            if prev is None:
+                ext, base = code, offset + lo
+            else:
+                ext, base = np.concatenate([[prev], code]), offset + lo - 1
+            # change i sits between samples i and i+1 of ext: the run holding sample i ends there
+            changes = np.flatnonzero(ext[1:] != ext[:-1])
+            runStarts = np.concatenate([[runStart], changes[:-1] + 1 + base]) if len(changes) > 0 else np.zeros(0, dtype = np.int64)
+            values = ext[changes]
+            lit = values != 0
+            order.append(values[lit])
+            starts.append(runStarts[lit])
+            ends.append(changes[lit] + 1 + base)
+            if len(changes) > 0:
+                runStart = changes[-1] + 1 + base
+            prev = code[-1]
+        offset += min(len(chunk1), len(chunk2))
+
+    empty = np.zeros(0, dtype = np.int64)
+    return {'led1Max': led1Max, 'led2Max': led2Max,
+            'opticalOrder': np.concatenate(order + [np.zeros(0, dtype = np.int8)]).astype(np.int64),
+            'frameStarts': np.concatenate(starts + [empty]).astype(np.int64), 'frameEnds': np.concatenate(ends + [empty]).astype(np.int64)}
+
+### scanStim: one streaming pass over a stim channel, sampled over the frame exposure windows [frameStarts, frameEnds) (channel samples)
+###     returns the channel maximum (stimMax), the number of high samples in every window (frameHigh), and the rising and falling edges
+def scanStim(reader, stimName, frameStarts, frameEnds, chunkSize = SMR_CHUNK_SAMPLES):
+    # the number of high samples before each window bound is read off the running count, so every frame costs two lookups
+    bounds = np.concatenate([frameStarts, frameEnds])
+    order = np.argsort(bounds, kind = 'stable')
+    sortedBounds = bounds[order]
+    highBefore = np.zeros(len(bounds), dtype = np.int64)
+
+    stimMax = -np.inf
+    nHigh = 0
+    iBound = 0
+    rising, falling = [], []
+    prev = None
+    offset = 0
+
+    for chunk in iterSmrChannel(reader, stimName, chunkSize):
+        stimMax = max(stimMax, chunk.max())
+        high = chunk > TRIG_THRESHOLD
+        cumHigh = np.concatenate([[0], np.cumsum(high)]) + nHigh
+        iStop = np.searchsorted(sortedBounds, offset + len(chunk), side = 'left')
+        highBefore[order[iBound:iStop]] = cumHigh[sortedBounds[iBound:iStop] - offset]
+        iBound = iStop
+
+        r, f = binaryEdges(high, prev, offset)
+        rising.append(r)
+        falling.append(f)
+        prev = high[-1]
+        nHigh = int(cumHigh[-1])
+        offset += len(chunk)
+
+    # bounds at or past the end of the channel see every high sample
+    highBefore[order[iBound:]] = nHigh
+    nFrames = len(frameStarts)
+    return {'stimMax': stimMax, 'frameHigh': highBefore[nFrames:] - highBefore[:nFrames],
+            'stimRising': np.concatenate(rising + [np.zeros(0, dtype = np.int64)]),
+            'stimFalling': np.concatenate(falling + [np.zeros(0, dtype = np.int64)])}
+
+### decodeTriggerEdges: decode the trigger and LED channels of an open smr reader in two streaming passes
+###     the trigger channel is scanned first to find the window holding the triggers, then both LED channels are scanned together;
+###     returns the union of the scanTrigger and scanLeds dicts (the LED runs are empty if the trigger channel has too few high samples)
+def decodeTriggerEdges(reader, trigName = 'Trigger', cyanName = 'LED1', uvName = 'LED2', chunkSize = SMR_CHUNK_SAMPLES):
+    edges = scanTrigger(reader, trigName, chunkSize)
+    if edges['lastTrigStart'] is None:
+        winStart, winStop = 0, 0
+    else:
+        winStart, winStop = edges['firstTrigStart'], edges['lastTrigStart'] + TRIG_WINDOW_PAD
+    edges.update(scanLeds(reader, cyanName, uvName, winStart, winStop, chunkSize))
+    edges['winStart'], edges['winStop'] = winStart, winStop
+    return edges
+
+class SmrDecoder:
+    '''
+    Decode the trigger, LED and stim channels of an smr file.
+    The file is opened once and every result is computed the first time it is asked for and then kept, so the optical order,
+    the consecutive trigger mask, the stim tables and the error flags can be asked for in any order at the cost of a single decode.
+    '''
+
+    def __init__(self, smrPath, trigName = 'Trigger', cyanName = 'LED1', uvName = 'LED2', ledStimName = 'stim_LED', pawStimName = 'stim_Paw'):
+        self.smrPath = smrPath
+        self.trigName = trigName
+        self.cyanName = cyanName
+        self.uvName = uvName
+        self.ledStimName = ledStimName
+        self.pawStimName = pawStimName
+        self.reader = openSmrReader(smrPath)
+
+    ### infoDf: channel table of the file (see smrIO.smrChannelTable)
+    @cached_property
+    def infoDf(self):
+        return smrChannelTable(self.reader)
+
+    def hasChannel(self, name):
+        return name in self.infoDf.name.values
+
+    ### edges: trigger and LED edges from decodeTriggerEdges, None if the trigger or an LED channel is missing
+    @cached_property
+    def edges(self):
+        if not all([self.hasChannel(chanName) for chanName in [self.trigName, self.cyanName, self.uvName]]):
+            return None
+        return decodeTriggerEdges(self.reader, self.trigName, self.cyanName, self.uvName)
+
+    ### opticalErr: reason the optical order could not be decoded, '' if it was
+    @cached_property
+    def opticalErr(self):
+        edges = self.edges
+        if edges is None or not all([edges[chanMax] > TRIG_THRESHOLD for chanMax in ['trigMax', 'led1Max', 'led2Max']]):
+            return '#trig/led1/led2 channel empty#'
+        if edges['lastTrigStart'] is None or (edges['lastTrigStart'] - edges['firstTrigStart'])/TRIG_SAMPLE_RATE <= MIN_TRIG_SECONDS:
+            return '#length of trig channel less than 550 sec#'
+        return ''
+
+    ### opticalOrder: LED code of every frame (2*LED1 + LED2, see scanLeds) between the first and last trigger, None if it could not be decoded
+    @property
+    def opticalOrder(self):
+        if self.opticalErr != '':
+            return None
+        return self.edges['opticalOrder']
+
+    ### opTableOptical: the optical order as a dataframe with an opticalOrder column, False if it could not be decoded
+    @property
+    def opTableOptical(self):
+        if self.opticalOrder is None:
+            return False
+        return pd.DataFrame({'opticalOrder': self.opticalOrder})
+
+    ### consecMask: True for every frame with the same LED code as the frame before it, None if the optical order could not be decoded
+    @cached_property
+    def consecMask(self):
+        if self.opticalOrder is None:
+            return None
+        return np.insert(np.diff(self.opticalOrder) == 0, 0, False)
+
+    ### consecutiveTriggers: number of frames with the same LED code as the frame before it
+    @property
+    def consecutiveTriggers(self):
+        if self.consecMask is None:
+            return 0
+        return int(self.consecMask.sum())
+
+    ### frameTimes: frame exposure windows in seconds, (frameStarts, frameEnds), None if the optical order could not be decoded
+    @property
+    def frameTimes(self):
+        if self.opticalOrder is None:
+            return None
+        ledRate = self.infoDf[self.infoDf.name == self.cyanName].sampling_rate.values[0]
+        return self.edges['frameStarts']/ledRate, self.edges['frameEnds']/ledRate
+
+    ### stimTables: (per frame stim table or False, stim event table or False, stim error flags)
+    ###     every stim channel holding a stimulus is sampled over the exposure window of every frame: <col> is 1 if the stimulus
+    ###     was on at any time during the exposure and <col>Frac the fraction of the exposure it was on; the events are the onsets
+    ###     and offsets of the stimulus (s) with the first and last frame they overlap (-1 if none)
+    @cached_property
+    def stimTables(self):
+        err = ''
+        opTableStim = pd.DataFrame({})
+        events = []
+        for col, stimName in [('ledStim', self.ledStimName), ('pawStim', self.pawStimName)]:
+            if not self.hasChannel(stimName) or self.frameTimes is None:
+                if col == 'ledStim':
+                    err = err + '#ledStim channel empty or no decoded frames#'
+                continue
+
+            frameStartSec, frameEndSec = self.frameTimes
+            stimRate = self.infoDf[self.infoDf.name == stimName].sampling_rate.values[0]
+            frameStarts = np.round(frameStartSec*stimRate).astype(np.int64)
+            frameEnds = np.maximum(np.round(frameEndSec*stimRate).astype(np.int64), frameStarts + 1)
+            stim = scanStim(self.reader, stimName, frameStarts, frameEnds)
+            if stim['stimMax'] <= TRIG_THRESHOLD:
+                if col == 'ledStim':
+                    err = err + '#ledStim channel empty or no decoded frames#'
+                continue
+
+            if len(opTableStim.columns) == 0:
+                opTableStim['frameStart'] = frameStartSec
+                opTableStim['frameEnd'] = frameEndSec
+                opTableStim['opticalOrder'] = self.opticalOrder
+            opTableStim[col] = (stim['frameHigh'] > 0).astype(int)
+            opTableStim[col + 'Frac'] = stim['frameHigh']/(frameEnds - frameStarts)
+
+            # an offset is the first falling edge after each onset, NaN if the stimulus is still on at the end of the channel
+            onsets = stim['stimRising']
+            offsets = np.full(len(onsets), np.nan)
+            iFall = np.searchsorted(stim['stimFalling'], onsets, side = 'right')
+            hasOffset = iFall < len(stim['stimFalling'])
+            offsets[hasOffset] = stim['stimFalling'][iFall[hasOffset]]
+            firstFrame = np.searchsorted(frameEnds, onsets, side = 'right')
+            lastFrame = np.searchsorted(frameStarts, np.where(hasOffset, offsets, np.inf), side = 'left') - 1
+            noFrame = (firstFrame > lastFrame) | (firstFrame >= len(frameStarts))
+            events.append(pd.DataFrame({'stim': col, 'onset': onsets/stimRate, 'offset': offsets/stimRate,
+                                        'firstFrame': np.where(noFrame, -1, firstFrame), 'lastFrame': np.where(noFrame, -1, lastFrame)}))
+
+        if len(opTableStim.columns) == 0:
+            opTableStim = False
+        stimEvents = pd.concat(events, ignore_index = True) if len(events) > 0 else False
+        return opTableStim, stimEvents, err
+
+    ### opTableStim: per frame stim table with ledStim and/or pawStim columns, False if there is no stimulus
+    @property
+    def opTableStim(self):
+        return self.stimTables[0]
+
+    ### stimEvents: stim onsets and offsets, False if there is no stimulus
+    @property
+    def stimEvents(self):
+        return self.stimTables[1]
+
+    ### err: all error flags of the optical and stim decoding, '#no error#' if there were none
+    @property
+    def err(self):
+        err = self.opticalErr + self.stimTables[2]
+        return err if err != '' else '#no error#'
@@ -0,0 +1,514 @@
+### tifIO.py: header level access to the raw .tif movies
+### The IFD chain of a TIF file is parsed once, and for uncompressed stacks whose frames sit at a regular stride in the file
+### (what the camera software and ImageJ write) the movie is exposed as a read only memory map of shape (nFrames, rows, cols)
+### in the native dtype of the camera (normally uint16). Nothing is copied: reading a frame costs page cache I/O only.
+### Compressed, tiled or irregularly laid out files fall back to decoding each page with PIL.
+### usage: from tifIO import openTifMovie; movie = openTifMovie('SLC_animal06_ses-2_2019-01-17_EPI1_REST_part-00.tif')
+import os
+import re
+import struct
+import logging
+import numpy as np
+from PIL import Image, ImageSequence
+
+# TIF tags needed to locate the pixel data of each page
+TAG_WIDTH = 256
+TAG_LENGTH = 257
+TAG_BITSPERSAMPLE = 258
+TAG_COMPRESSION = 259
+TAG_DESCRIPTION = 270
+TAG_STRIPOFFSETS = 273
+TAG_SAMPLESPERPIXEL = 277
+TAG_STRIPBYTECOUNTS = 279
+TAG_PLANARCONFIG = 284
+TAG_TILEWIDTH = 322
+TAG_SAMPLEFORMAT = 339
+
+# (struct code, size in bytes) of the TIF field types we may need to read
+FIELD_TYPES = {1: ('B', 1), 2: ('s', 1), 3: ('H', 2), 4: ('I', 4), 6: ('b', 1), 7: ('B', 1), 8: ('h', 2), 9: ('i', 4), 11: ('f', 4), 12: ('d', 8), 16: ('Q', 8), 17: ('q', 8), 18: ('Q', 8)}
+
+# numpy dtype kind for the SampleFormat tag: 1 unsigned int, 2 signed int, 3 float
+SAMPLE_KINDS = {1: 'u', 2: 'i', 3: 'f'}
+
+### readTifHeader: byte order, BigTIFF flag and offset of the first IFD
+def readTifHeader(f):
+    f.seek(0)
+    head = f.read(16)
+    if len(head) < 8:
+        raise ValueError('file too short to be a TIF')
+
+    if head[:2] == b'II':
+        bo = '<'
+    elif head[:2] == b'MM':
+        bo = '>'
+    else:
+        raise ValueError('not a TIF file (bad byte order mark)')
+
+    magic = struct.unpack(bo+'H', head[2:4])[0]
+    if magic == 42:
+        bigTiff = False
+        firstIfd = struct.unpack(bo+'I', head[4:8])[0]
+    elif magic == 43:
+        if len(head) < 16:
+            raise ValueError('file too short to be a BigTIFF')
+        bigTiff = True
+        firstIfd = struct.unpack(bo+'Q', head[8:16])[0]
+    else:
+        raise ValueError('not a TIF file (bad magic number %d)' % magic)
+
+    return bo, bigTiff, firstIfd
+
+### readTagValue: read the value(s) of a single IFD entry, following the offset when the value does not fit inline
+def readTagValue(f, bo, bigTiff, fieldType, count, valueBytes):
+    if fieldType not in FIELD_TYPES:
+        return None
+    code, size = FIELD_TYPES[fieldType]
+    nBytes = size*count
+
+    if nBytes <= len(valueBytes):
+        raw = valueBytes[:nBytes]
+    else:
+        offset = struct.unpack(bo+('Q' if bigTiff else 'I'), valueBytes)[0]
+        f.seek(offset)
+        raw = f.read(nBytes)
+        if len(raw) < nBytes:
+            raise ValueError('tag value runs past the end of the file')
+
+    if code == 's':
+        return raw.rstrip(b'\x00').decode('latin-1')
+    if count == 1:
+        return struct.unpack(bo+code, raw)[0]
+    return np.frombuffer(raw, dtype=np.dtype(bo+code)).astype(np.int64)
+
+# tags read from every page by readTifIFDs
+PAGE_TAGS = (TAG_WIDTH, TAG_LENGTH, TAG_BITSPERSAMPLE, TAG_COMPRESSION, TAG_DESCRIPTION, TAG_STRIPOFFSETS, TAG_SAMPLESPERPIXEL,
+             TAG_STRIPBYTECOUNTS, TAG_PLANARCONFIG, TAG_TILEWIDTH, TAG_SAMPLEFORMAT)
+
+# number of IFDs tifFrameCount spot checks when the IFDs sit at a regular stride, on top of the first few and the last two,
+# and how far below the last position the stride allows it looks for the end of the chain
+STRIDE_PROBES = 16
+STRIDE_TAIL_STEPS = 8
+
+### TifHeaderError: a TIF whose header or IFD chain cannot be read; reason is a short machine readable label
+###     ('not a tif', 'truncated', 'loop', 'no images'), offset the file position where the problem was found (None if not applicable)
+class TifHeaderError(ValueError):
+    '''
+    Raised for truncated or corrupt TIF files, carrying the path, a short reason label and the offending file offset,
+    so callers can report or tabulate bad files instead of getting an unknown frame count.
+    '''
+
+    def __init__(self, path, reason, message, offset = None):
+        super().__init__('%s: %s' % (path, message))
+        self.path = path
+        self.reason = reason
+        self.offset = offset
+
+### ifdLayout: struct codes and sizes of the IFD fields: (count format, count size, entry size, offset format, entry format)
+def ifdLayout(bo, bigTiff):
+    if bigTiff:
+        return 'Q', 8, 20, 'Q', bo+'HHQ'
+    return 'H', 2, 12, 'I', bo+'HHI'
+
+### readIFD: read the IFD at ifdOffset, returns (tags, offset of the next IFD); only the tags in wanted are decoded
+def readIFD(f, bo, bigTiff, ifdOffset, fileSize, wanted):
+    countFmt, countSize, entrySize, offFmt, entryFmt = ifdLayout(bo, bigTiff)
+    offSize = struct.calcsize(offFmt)
+    if ifdOffset + countSize > fileSize:
+        raise ValueError('IFD offset %d points past the end of the file' % ifdOffset)
+
+    f.seek(ifdOffset)
+    nEntries = struct.unpack(bo+countFmt, f.read(countSize))[0]
+    block = f.read(nEntries*entrySize + offSize)
+    if len(block) < nEntries*entrySize + offSize:
+        raise ValueError('IFD at offset %d is truncated' % ifdOffset)
+
+    tags = {}
+    headSize = struct.calcsize(entryFmt)
+    for e in range(nEntries):
+        entry = block[e*entrySize:(e+1)*entrySize]
+        tag, fieldType, count = struct.unpack(entryFmt, entry[:headSize])
+        if tag in wanted:
+            tags[tag] = readTagValue(f, bo, bigTiff, fieldType, count, entry[headSize:])
+
+    return tags, struct.unpack(bo+offFmt, block[nEntries*entrySize:])[0]
+
+### readTifIFDs: walk the IFD chain and return the header information needed to locate the data of every page
+def readTifIFDs(tifPath):
+    fileSize = os.path.getsize(tifPath)
+
+    with open(tifPath, 'rb') as f:
+        bo, bigTiff, ifdOffset = readTifHeader(f)
+
+        pages = []
+        seen = set()
+        while ifdOffset != 0:
+            if ifdOffset in seen:
+                raise ValueError('IFD chain loops back on itself at offset %d' % ifdOffset)
+            seen.add(ifdOffset)
+
+            tags, ifdOffset = readIFD(f, bo, bigTiff, ifdOffset, fileSize, PAGE_TAGS)
+            pages.append(tags)
+
+    if len(pages) == 0:
+        raise ValueError('TIF file contains no images')
+
+    return {'byteOrder': bo, 'bigTiff': bigTiff, 'fileSize': fileSize, 'pages': pages,
+            'description': pages[0].get(TAG_DESCRIPTION, '')}
+
+### pageDtype: numpy dtype of the samples in a page
+def pageDtype(page, bo):
+    bps = page.get(TAG_BITSPERSAMPLE, 1)
+    if not np.isscalar(bps):
+        bps = int(bps[0])
+    fmt = page.get(TAG_SAMPLEFORMAT, 1)
+    if not np.isscalar(fmt):
+        fmt = int(fmt[0])
+    if bps % 8 != 0 or fmt not in SAMPLE_KINDS:
+        return None
+    return np.dtype(bo + SAMPLE_KINDS[fmt] + str(bps//8))
+
+### pageDataOffset: byte offset of the pixel data of an uncompressed page stored in contiguous strips, None otherwise
+def pageDataOffset(page, nBytes):
+    offsets = np.atleast_1d(page.get(TAG_STRIPOFFSETS, []))
+    counts = np.atleast_1d(page.get(TAG_STRIPBYTECOUNTS, []))
+    if len(offsets) == 0 or len(offsets) != len(counts):
+        return None
+    if len(offsets) > 1 and not np.array_equal(offsets[1:], offsets[:-1] + counts[:-1]):
+        return None
+    if counts.sum() < nBytes:
+        return None
+    return int(offsets[0])
+
+### imagejFrameCount: number of images stated in an ImageJ ImageDescription, 0 if absent
+def imagejFrameCount(description):
+    if not isinstance(description, str) or not description.startswith('ImageJ'):
+        return 0
+    match = re.search(r'^images=(\d+)', description, re.MULTILINE)
+    return int(match.group(1)) if match else 0
+
+### tifFrameLayout: describe where the frames of a TIF live on disk, or return None if the file cannot be memory mapped
+###     returns (dataOffset, frameStride, nFrames, rows, cols, dtype)
+def tifFrameLayout(info):
+    pages = info['pages']
+    first = pages[0]
+    rows = first.get(TAG_LENGTH)
+    cols = first.get(TAG_WIDTH)
+    dtype = pageDtype(first, info['byteOrder'])
+
+    if rows is None or cols is None or dtype is None:
+        return None
+
+    # only plain single channel uncompressed strips can be mapped straight into an array
+    for page in pages:
+        if (page.get(TAG_COMPRESSION, 1) != 1 or page.get(TAG_SAMPLESPERPIXEL, 1) != 1 or TAG_TILEWIDTH in page
+                or page.get(TAG_LENGTH) != rows or page.get(TAG_WIDTH) != cols or pageDtype(page, info['byteOrder']) != dtype):
+            return None
+
+    frameBytes = rows*cols*dtype.itemsize
+    offsets = [pageDataOffset(page, frameBytes) for page in pages]
+    if any(o is None for o in offsets):
+        return None
+
+    nFrames = len(pages)
+    # ImageJ writes stacks larger than 4GB with a single IFD and the frames back to back after the first one
+    nImagej = imagejFrameCount(info['description'])
+    if nFrames == 1 and nImagej > 1:
+        nFrames = nImagej
+        frameStride = frameBytes
+    elif nFrames > 1:
+        strides = np.diff(offsets)
+        if not np.all(strides == strides[0]) or strides[0] < frameBytes:
+            return None
+        frameStride = int(strides[0])
+    else:
+        frameStride = frameBytes
+
+    if offsets[0] + (nFrames - 1)*frameStride + frameBytes > info['fileSize']:
+        return None
+
+    return offsets[0], frameStride, nFrames, rows, cols, dtype
+
+# frame counts computed in this process, keyed on (path, size, modification time)
+frameCountMemo = {}
+
+### nextIfdOffset: offset of the IFD following the one at ifdOffset, reading only its entry count and next pointer
+def nextIfdOffset(f, tifPath, bo, bigTiff, ifdOffset, fileSize):
+    countFmt, countSize, entrySize, offFmt, entryFmt = ifdLayout(bo, bigTiff)
+    offSize = struct.calcsize(offFmt)
+    if ifdOffset + countSize > fileSize:
+        raise TifHeaderError(tifPath, 'truncated', 'IFD offset %d points past the end of the file' % ifdOffset, ifdOffset)
+
+    f.seek(ifdOffset)
+    nEntries = struct.unpack(bo+countFmt, f.read(countSize))[0]
+    nextPos = ifdOffset + countSize + nEntries*entrySize
+    if nextPos + offSize > fileSize:
+        raise TifHeaderError(tifPath, 'truncated', 'IFD at offset %d is truncated' % ifdOffset, ifdOffset)
+    f.seek(nextPos)
+    return struct.unpack(bo+offFmt, f.read(offSize))[0]
+
+### strideFrameCount: number of IFDs when they sit at a regular stride (what the camera software writes), None if they do not
+###     the stride is taken from the first IFDs and confirmed at STRIDE_PROBES spots along the chain and at its last two IFDs,
+###     so a long regular chain is counted from a few dozen small reads instead of one per frame
+def strideFrameCount(f, tifPath, bo, bigTiff, firstIfd, fileSize):
+    offsets = [firstIfd]
+    while len(offsets) < 4:
+        nextOffset = nextIfdOffset(f, tifPath, bo, bigTiff, offsets[-1], fileSize)
+        if nextOffset == 0:
+            return len(offsets)
+        offsets.append(nextOffset)
+
+    strides = np.diff(offsets)
+    stride = int(strides[0])
+    if stride <= 0 or not np.all(strides == stride):
+        return None
+
+    # look for the end of the chain just below the last IFD the stride allows, then check that every probed IFD points to the next one;
+    # positions off the chain hold pixel data, so anything unexpected there sends the caller back to walking the chain
+    countSize = ifdLayout(bo, bigTiff)[1]
+    nMax = (fileSize - firstIfd - countSize)//stride + 1
+    try:
+        for n in range(nMax, max(nMax - STRIDE_TAIL_STEPS, len(offsets)), -1):
+            if nextIfdOffset(f, tifPath, bo, bigTiff, firstIfd + (n - 1)*stride, fileSize) == 0:
+                break
+        else:
+            return None
+
+        for k in sorted(set(np.linspace(len(offsets) - 1, n - 2, STRIDE_PROBES).astype(int))):
+            if nextIfdOffset(f, tifPath, bo, bigTiff, firstIfd + k*stride, fileSize) != firstIfd + (k + 1)*stride:
+                return None
+    except TifHeaderError:
+        return None
+    return n
+
+### tifFrameCount: number of frames in a TIF, from its header only
+###     ImageJ stacks are counted from the images= entry of their description when the frames it announces fit in the file,
+###     other files by following the chain of IFD offsets without decoding the pages (see strideFrameCount). Results are kept per
+###     (path, size, modification time); truncated or corrupt files raise TifHeaderError
+def tifFrameCount(tifPath):
+    st = os.stat(tifPath)
+    memoKey = (os.path.abspath(tifPath), st.st_size, st.st_mtime_ns)
+    if memoKey in frameCountMemo:
+        return frameCountMemo[memoKey]
+
+    fileSize = st.st_size
+    with open(tifPath, 'rb') as f:
+        try:
+            bo, bigTiff, firstIfd = readTifHeader(f)
+        except ValueError as e:
+            raise TifHeaderError(tifPath, 'not a tif', str(e), 0)
+        if firstIfd == 0:
+            raise TifHeaderError(tifPath, 'no images', 'TIF file contains no images', 0)
+
+        try:
+            first, secondIfd = readIFD(f, bo, bigTiff, firstIfd, fileSize, PAGE_TAGS)
+        except ValueError as e:
+            raise TifHeaderError(tifPath, 'truncated', str(e), firstIfd)
+
+        nFrames = None
+        nImagej = imagejFrameCount(first.get(TAG_DESCRIPTION, ''))
+        dtype = pageDtype(first, bo)
+        if nImagej > 1 and dtype is not None and first.get(TAG_LENGTH) is not None and first.get(TAG_WIDTH) is not None:
+            frameBytes = first[TAG_LENGTH]*first[TAG_WIDTH]*dtype.itemsize
+            dataOffset = pageDataOffset(first, frameBytes)
+            if dataOffset is not None and dataOffset + nImagej*frameBytes <= fileSize:
+                nFrames = nImagej
+
+        if nFrames is None:
+            nFrames = strideFrameCount(f, tifPath, bo, bigTiff, firstIfd, fileSize)
+
+        if nFrames is None:
+            nFrames = 1
+            seen = {firstIfd}
+            ifdOffset = secondIfd
+            while ifdOffset != 0:
+                if ifdOffset in seen:
+                    raise TifHeaderError(tifPath, 'loop', 'IFD chain loops back on itself at offset %d' % ifdOffset, ifdOffset)
+                seen.add(ifdOffset)
+                ifdOffset = nextIfdOffset(f, tifPath, bo, bigTiff, ifdOffset, fileSize)
+                nFrames += 1
+
+    frameCountMemo[memoKey] = nFrames
+    return nFrames
+
+### probedFrameLayout: layout (see tifFrameLayout) of a stack whose IFDs and frames both sit at a regular stride, found from the IFDs of
+###     STRIDE_PROBES pages spread along the chain instead of all of them; None if the probed pages do not fit that pattern
+###     pages between the probes are assumed to follow it, as strideFrameCount does, so this is meant for estimates (see frameStats)
+def probedFrameLayout(tifPath):
+    nFrames = tifFrameCount(tifPath)
+    fileSize = os.path.getsize(tifPath)
+    if nFrames < 4:
+        return None
+
+    with open(tifPath, 'rb') as f:
+        bo, bigTiff, firstIfd = readTifHeader(f)
+        # some writers put the first IFD before the data and the others after it, so the stride is taken from the second IFD on
+        first, secondIfd = readIFD(f, bo, bigTiff, firstIfd, fileSize, PAGE_TAGS)
+        second, thirdIfd = readIFD(f, bo, bigTiff, secondIfd, fileSize, PAGE_TAGS)
+        ifdStride = thirdIfd - secondIfd
+        probes = sorted(set(np.linspace(2, nFrames - 1, STRIDE_PROBES).astype(int)))
+        try:
+            pages = [first, second] + [readIFD(f, bo, bigTiff, secondIfd + (k - 1)*ifdStride, fileSize, PAGE_TAGS)[0] for k in probes]
+        except ValueError:
+            return None
+        probes = [0, 1] + probes
+
+    # the probed pages must pass the same checks as the pages of a full walk, with their data at a regular stride as well
+    info = {'byteOrder': bo, 'bigTiff': bigTiff, 'fileSize': fileSize, 'pages': pages[:2], 'description': first.get(TAG_DESCRIPTION, '')}
+    layout = tifFrameLayout(info)
+    if layout is None:
+        return None
+    dataOffset, frameStride, _, rows, cols, dtype = layout
+    for k, page in zip(probes, pages):
+        if tifFrameLayout(dict(info, pages = [page])) is None or pageDataOffset(page, rows*cols*dtype.itemsize) != dataOffset + k*frameStride:
+            return None
+        if page.get(TAG_LENGTH) != rows or page.get(TAG_WIDTH) != cols or pageDtype(page, bo) != dtype:
+            return None
+
+    if dataOffset + (nFrames - 1)*frameStride + rows*cols*dtype.itemsize > fileSize:
+        return None
+    return dataOffset, frameStride, nFrames, rows, cols, dtype
+
+### readTifPIL: decode every page with PIL into a (nFrames, rows, cols) array, for files that cannot be memory mapped
+def readTifPIL(tifPath):
+    img = Image.open(tifPath)
+    first = np.array(img)
+    movie = np.empty((img.n_frames,) + first.shape, dtype=first.dtype)
+    for i, page in enumerate(ImageSequence.Iterator(img)):
+        movie[i] = np.array(page)
+    return movie
+
+### openTifMovie: return the movie in tifPath as an array of shape (nFrames, rows, cols) in the native dtype of the file
+###     uncompressed stacks are returned as a zero copy, read only view of a memory map of the file
+def openTifMovie(tifPath):
+    info = readTifIFDs(tifPath)
+    layout = tifFrameLayout(info)
+
+    if layout is None:
+        logging.info('%s cannot be memory mapped, decoding pages with PIL', tifPath)
+        return readTifPIL(tifPath)
+
+    return mapTifMovie(tifPath, layout)
+
+### mapTifMovie: zero copy (nFrames, rows, cols) view of the frames described by a layout from tifFrameLayout
+def mapTifMovie(tifPath, layout):
+    dataOffset, frameStride, nFrames, rows, cols, dtype = layout
+    fileMap = np.memmap(tifPath, dtype=np.uint8, mode='r')
+
+    return np.ndarray((nFrames, rows, cols), dtype=dtype, buffer=fileMap, offset=dataOffset,
+                      strides=(frameStride, cols*dtype.itemsize, dtype.itemsize))
+
+### iterTifFrames: yield the frames of the movie in tifPath one at a time as (rows, cols) arrays
+###     memory mapped files yield views into the map; other files are decoded one page at a time, so memory stays at one frame
+def iterTifFrames(tifPath):
+    info = readTifIFDs(tifPath)
+    layout = tifFrameLayout(info)
+
+    if layout is None:
+        img = Image.open(tifPath)
+        for page in ImageSequence.Iterator(img):
+            yield np.array(page)
+    else:
+        movie = mapTifMovie(tifPath, layout)
+        for i in range(movie.shape[0]):
+            yield movie[i]
+
+### iterTifBlocks: yield the frames of the movie in tifPath in blocks of up to blockFrames frames, as (n, rows, cols) arrays
+###     memory mapped files yield views into the map; other files are decoded one page at a time
+###     with probe set, a regularly laid out file is mapped from a few of its IFDs (see probedFrameLayout) instead of all of them
+def iterTifBlocks(tifPath, blockFrames = 64, probe = False):
+    layout = probedFrameLayout(tifPath) if probe else None
+    if layout is None:
+        layout = tifFrameLayout(readTifIFDs(tifPath))
+
+    if layout is None:
+        block = []
+        for frame in iterTifFrames(tifPath):
+            block.append(frame)
+            if len(block) == blockFrames:
+                yield np.stack(block)
+                block = []
+        if len(block) > 0:
+            yield np.stack(block)
+    else:
+        movie = mapTifMovie(tifPath, layout)
+        for i in range(0, movie.shape[0], blockFrames):
+            yield movie[i:i + blockFrames]
+
+# per-frame statistics that frameStats knows how to compute, besides percentiles written 'p' followed by the percentile (e.g. 'p5', 'p99.5')
+# saturated is the number of pixels at the largest value of the integer dtype of the movie (always 0 for float movies)
+FRAME_STATS = ('mean', 'min', 'max', 'std', 'median', 'saturated')
+
+# prefix of the statistics computed over the pixels of the mask given to frameStats
+MASK_PREFIX = 'roi.'
+
+### statPercentile: the percentile computed by a statistic (50 for 'median'), None if it is not a percentile
+def statPercentile(stat):
+    if stat == 'median':
+        return 50.0
+    if stat.startswith('p'):
+        try:
+            q = float(stat[1:])
+        except ValueError:
+            return None
+        if 0 <= q <= 100:
+            return q
+    return None
+
+### isFrameStat: True if frameStats can compute the statistic
+def isFrameStat(stat):
+    return stat in FRAME_STATS or statPercentile(stat) is not None
+
+### blockStats: statistics of each row of a (frames, pixels) array; all percentiles are found with one partition per frame
+def blockStats(pixels, stats, saturation):
+    values = {}
+    quantiles = [st for st in stats if statPercentile(st) is not None]
+    if len(quantiles) > 0:
+        qs = np.percentile(pixels, [statPercentile(st) for st in quantiles], axis = 1)
+        for st, q in zip(quantiles, qs):
+            values[st] = q
+    for st in stats:
+        if st == 'mean':
+            values[st] = pixels.mean(axis = 1, dtype = np.float64)
+        elif st == 'min':
+            values[st] = pixels.min(axis = 1)
+        elif st == 'max':
+            values[st] = pixels.max(axis = 1)
+        elif st == 'std':
+            values[st] = pixels.std(axis = 1, dtype = np.float64)
+        elif st == 'saturated':
+            values[st] = np.zeros(len(pixels)) if saturation is None else np.sum(pixels >= saturation, axis = 1)
+    return values
+
+### frameStats: per-frame statistics of a tif movie computed in a single streaming pass, one block of frames in memory at a time
+###     stats is any of FRAME_STATS and percentiles ('p5'); returns a dict of 1D float64 arrays with one value per frame
+###     with a boolean (rows, cols) mask the same statistics are also computed over the pixels of the mask in the same pass, under the
+###     names MASK_PREFIX + stat (e.g. 'roi.mean')
+###     with step > 1 only every step-th row and column of each frame (and of the mask) is read, which is enough to tell the wavelengths apart
+###     at a fraction of the cost; the mapped pages holding the other rows are not touched
+def frameStats(tifPath, stats = ('mean',), mask = None, step = 1):
+    if any(not isFrameStat(st) for st in stats):
+        raise ValueError('stats must be percentiles or in ' + str(FRAME_STATS))
+
+    values = {st: [] for st in stats}
+    if mask is not None:
+        mask = np.asarray(mask, dtype = bool)
+        fullMaskShape = mask.shape
+        mask = mask[::step, ::step]
+        if not mask.any():
+            raise ValueError('the mask given for ' + tifPath + ' has no pixels')
+        values.update({MASK_PREFIX + st: [] for st in stats})
+
+    for block in iterTifBlocks(tifPath, probe = step > 1):
+        if mask is not None and fullMaskShape != block.shape[1:]:
+            raise ValueError('mask of shape %s does not fit the frames of %s, of shape %s' % (fullMaskShape, tifPath, block.shape[1:]))
+        if step > 1:
+            block = block[:, ::step, ::step]
+        saturation = np.iinfo(block.dtype).max if block.dtype.kind in 'ui' else None
+
+        for st, v in blockStats(block.reshape(len(block), -1), stats, saturation).items():
+            values[st].append(v)
+        if mask is not None:
+            for st, v in blockStats(block[:, mask], stats, saturation).items():
+                values[MASK_PREFIX + st].append(v)
+
+    return {st: np.concatenate(v).astype(np.float64) if len(v) > 0 else np.zeros(0) for st, v in values.items()}
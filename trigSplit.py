@@ -0,0 +1,95 @@
+### trigSplit.py: split the frames of a movie into cyan, UV and dropped frames from their mean intensity alone, without per image tuning
+### The mean time series is sorted once; the split between the two wavelengths is the position in the sorted values that best separates them
+### (largest between-class variance, computed for every position at once from cumulative sums), looked for only where both wavelengths keep
+### a good share of the frames, so a few extreme frames cannot pull it away. Frames further from the median of their wavelength than
+### outlierSd robust standard deviations (from the median absolute deviation) are labelled dropped. O(n log n) for the sort, O(n) otherwise.
+### The confidence of a split (0 to 1) combines how far apart the two wavelengths are compared to their frame to frame noise with how
+### regularly the labels alternate from frame to frame, as the two LEDs do.
+### usage: from trigSplit import splitTrace
+###        labels, confidence, threshold = splitTrace(meanTS)
+import numpy as np
+
+# labels of the frames, as in the OpticalOrder.csv files
+CYAN = 1
+UV = 2
+DROPPED = 3
+
+# scale factor from the median absolute deviation to the standard deviation of a normal distribution
+MAD_TO_SD = 1.4826
+
+### splitThreshold: value separating the two wavelengths in the sorted values, chosen among splits that leave at least minFrac of the
+###     frames on each side; returns (threshold, split index into sortedVals)
+def splitThreshold(sortedVals, minFrac = 0.2):
+    n = len(sortedVals)
+    lo = max(1, int(np.floor(n*minFrac)))
+    hi = min(n - 1, int(np.ceil(n*(1 - minFrac))))
+    if hi < lo:
+        lo, hi = 1, n - 1
+
+    # between-class variance of splitting after k values, for k in [lo, hi], from cumulative sums
+    cumSum = np.cumsum(sortedVals - sortedVals[n//2])
+    k = np.arange(lo, hi + 1)
+    below = cumSum[k - 1]
+    above = cumSum[-1] - below
+    between = (below/k - above/(n - k))**2*k*(n - k)
+    best = k[np.argmax(between)]
+    return (sortedVals[best - 1] + sortedVals[best])/2, best
+
+### robustSpread: median and robust standard deviation (scaled median absolute deviation) of values
+def robustSpread(values):
+    med = np.median(values)
+    return med, MAD_TO_SD*np.median(np.abs(values - med))
+
+### frameNoise: robust standard deviation of the frame to frame changes of values (in frame order), which slow drifts such as bleaching do not inflate
+def frameNoise(values):
+    if len(values) < 3:
+        return 0.0
+    return robustSpread(np.diff(values))[1]/np.sqrt(2)
+
+### splitConfidence: confidence (0 to 1) of a split, from the separation of the two wavelengths and the alternation of the labels
+def splitConfidence(meanTS, labels):
+    cyan = meanTS[labels == CYAN]
+    uv = meanTS[labels == UV]
+    kept = labels[labels != DROPPED]
+    if len(cyan) < 3 or len(uv) < 3:
+        return 0.0
+
+    separation = (np.median(cyan) - np.median(uv))/(frameNoise(cyan) + frameNoise(uv) + 1e-12)
+    # a single normal distribution split in two at its middle gives a separation of about 1.3, so that counts as none
+    sepScore = 1 - np.exp(-max(separation - 1.5, 0)/2)
+
+    alternation = np.mean(kept[1:] != kept[:-1])
+    altScore = np.clip(2*alternation - 1, 0, 1)
+    return float(sepScore*altScore)
+
+### splitLabels: labels of the frames of meanTS for each cut of the outlier cuts in outlierSds, as a (len(outlierSds), frames) array, and the
+###     threshold; the split is found once and only the outlier cut differs between the rows. Frames with a non finite mean are dropped
+def splitLabels(meanTS, outlierSds, minFrac = 0.2):
+    meanTS = np.asarray(meanTS, dtype = float)
+    outlierSds = np.asarray(outlierSds, dtype = float).reshape(-1, 1)
+    finite = np.isfinite(meanTS)
+    if np.sum(finite) < 4:
+        return np.full((len(outlierSds), len(meanTS)), DROPPED, dtype = int), np.nan
+
+    sortedVals = np.sort(meanTS[finite])
+    threshold, split = splitThreshold(sortedVals, minFrac)
+    uvMed, uvSd = robustSpread(sortedVals[:split])
+    cyanMed, cyanSd = robustSpread(sortedVals[split:])
+    # a wavelength whose frames mostly have the very same mean has no spread; keep its outlier cut at a small part of the separation
+    sdFloor = 0.01*abs(cyanMed - uvMed)
+    cyanSd, uvSd = max(cyanSd, sdFloor), max(uvSd, sdFloor)
+
+    cyan = meanTS > threshold
+    labels = np.where(finite, np.where(cyan, CYAN, UV), DROPPED)
+    med, sd = np.where(cyan, cyanMed, uvMed), np.where(cyan, cyanSd, uvSd)
+    outliers = finite & (np.abs(meanTS - med) > outlierSds*sd)
+    return np.where(outliers, DROPPED, labels), threshold
+
+### splitTrace: label each frame of meanTS as CYAN (brighter), UV or DROPPED; returns (labels, confidence, threshold)
+###     frames with a non finite mean are dropped; confidence is 0 when there are too few frames to split
+def splitTrace(meanTS, outlierSd = 8, minFrac = 0.2):
+    meanTS = np.asarray(meanTS, dtype = float)
+    labels, threshold = splitLabels(meanTS, [outlierSd], minFrac)
+    if np.isnan(threshold):
+        return labels[0], 0.0, threshold
+    return labels[0], splitConfidence(meanTS, labels[0]), threshold
@@ -0,0 +1,230 @@
+### trigSweep.py: try every way of fixing the triggers of an image on its cached mean time series and suggest the best one in the control sheet
+### The candidates are the settings the control sheet can express: simpFix, autoFix ('filter') with the default or an sdVal override,
+### splitMethod 'gap' with a range of sdVal and splitMethod 'dbscan' with a range of dbscanEps. The labels of each family are built over
+### its whole parameter grid at once into one (candidates, frames) array, and all candidates are scored together on
+###   - how regularly the cyan and UV labels alternate (the LEDs alternate, so a wrong split breaks the pattern)
+###   - how well separated the mean intensities of the two labels are
+###   - the fraction of frames labelled as dropped
+###   - agreement with the triggers decoded from the smr file, when the image has them
+### The best candidate is written to the suggestedFix and suggestedScore columns of the control sheet; with --apply the settings of
+### suggestions scoring at least the given value are also filled in for images that have no fix chosen yet, so the next run of
+### genTrigsNii.py uses them.
+### usage: python trigSweep.py rawOrganizedData/ preprocOutputDir/ triggerFix.csv [--apply 0.8]
+import os
+import glob
+import argparse
+import warnings
+import natsort
+import numpy as np
+import pandas as pd
+from skimage import filters
+from tsCache import getMeanTS, setCacheDir
+from buildManifest import readManifest
+from controlSheet import ControlSheet
+from dataIndex import imageOutDir, parseImageName
+from qcRender import fitLabels
+from trigSplit import CYAN, UV, DROPPED, frameNoise, splitLabels
+
+# sdVal overrides tried for autoFix and gap, and multiples of the frame to frame noise tried as dbscanEps (besides the default of 100)
+SD_VALUES = (2, 3, 4, 6, 8, 12)
+EPS_NOISE_MULTIPLES = (2, 4, 8, 16, 32)
+
+# defaults used by genTrigsNii.py when a setting is not given in the control sheet
+DEFAULT_HIST_SD = 8
+DEFAULT_HIST_SD2 = 3
+DEFAULT_DBSCAN_EPS = 100
+DBSCAN_MIN_SAMPLES = 100
+
+### simpLabels: simpFix labels, alternating from whichever of the first two frames is brighter
+def simpLabels(meanTS):
+    first = UV if meanTS[0] < meanTS[1] else CYAN
+    labels = np.full(len(meanTS), first)
+    labels[1::2] = UV if first == CYAN else CYAN
+    return labels
+
+### filterLabels: autoFix labels of the 'filter' split method (see genTrigsNii.produceEstimateTriggers) for each pair of histSds and
+###     histSd2s, as a (pairs, frames) array and a boolean array of the pairs where the method does not fail. The threshold is looked for
+###     once per distinct histSd2 (threshold_minimum works on a histogram of the values); the labels and dropped frames of all pairs are
+###     computed together
+def filterLabels(meanTS, histSds, histSd2s):
+    histSds, histSd2s = np.asarray(histSds, dtype = float), np.asarray(histSd2s, dtype = float)
+    mean, std = meanTS.mean(), meanTS.std()
+    threshOf = {}
+    for histSd2 in np.unique(histSd2s):
+        kept = meanTS[(meanTS <= mean + std*histSd2) & (meanTS >= mean - std*histSd2)]
+        try:
+            threshOf[histSd2] = filters.threshold_minimum(kept)
+        except RuntimeError:
+            threshOf[histSd2] = filters.threshold_mean(kept)
+    thresh = np.array([threshOf[h] for h in histSd2s])[:, None]
+
+    above, below = meanTS > thresh, meanTS < thresh
+    valid = ~np.isnan(thresh[:, 0]) & np.any(above, axis = 1) & np.any(below, axis = 1)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        upper, lower = np.where(above, meanTS, np.nan), np.where(below, meanTS, np.nan)
+        upperCut = np.nanmedian(upper, axis = 1) + np.nanstd(upper, axis = 1)*histSds
+        lowerCut = np.nanmedian(lower, axis = 1) - np.nanstd(lower, axis = 1)*histSds
+
+    labels = np.where(above, CYAN, UV)
+    dropped = (meanTS > upperCut[:, None]) | (meanTS < lowerCut[:, None])
+    return np.where(dropped, DROPPED, labels), valid
+
+### dbscanLabels: labels of the 'dbscan' split method for each of epsValues, as a (len(epsValues), frames) array and a boolean array of
+###     the values where it finds exactly two clusters and some noise, as genTrigsNii requires. In one dimension the neighbourhoods of
+###     DBSCAN are intervals of the sorted values, so the neighbours of every frame for every eps are counted with one binary search, and
+###     the clusters follow from the nearest core points on either side
+def dbscanLabels(meanTS, epsValues, minSamples = DBSCAN_MIN_SAMPLES):
+    eps = np.asarray(epsValues, dtype = float)[:, None]
+    order = np.argsort(meanTS)
+    sortedVals = meanTS[order]
+    n = len(sortedVals)
+    counts = np.searchsorted(sortedVals, sortedVals + eps, side = 'right') - np.searchsorted(sortedVals, sortedVals - eps, side = 'left')
+    core = counts >= minSamples
+
+    # nearest core point at or before and at or after each value; consecutive core points closer than eps belong to the same cluster
+    idx = np.arange(n)
+    left = np.maximum.accumulate(np.where(core, idx, -1), axis = 1)
+    right = np.minimum.accumulate(np.where(core, idx, n)[:, ::-1], axis = 1)[:, ::-1]
+    prevCore = np.concatenate([np.full((len(eps), 1), -1), left[:, :-1]], axis = 1)
+    newCluster = core & (prevCore >= 0) & (sortedVals - sortedVals[np.maximum(prevCore, 0)] > eps)
+    clusterAt = np.cumsum(newCluster, axis = 1)
+
+    # other values join the cluster of the nearest core point within eps (the lower one on a tie)
+    leftDist = np.where(left >= 0, sortedVals - sortedVals[np.maximum(left, 0)], np.inf)
+    rightDist = np.where(right < n, sortedVals[np.minimum(right, n - 1)] - sortedVals, np.inf)
+    nearest = np.where(leftDist <= rightDist, left, right).clip(0, n - 1)
+    cluster = np.where(np.minimum(leftDist, rightDist) <= eps, np.take_along_axis(clusterAt, nearest, axis = 1), -1)
+    valid = np.any(core, axis = 1) & (clusterAt[:, -1] == 1) & np.any(cluster == -1, axis = 1)
+
+    labels = np.empty(cluster.shape, dtype = int)
+    labels[:, order] = np.select([cluster == 1, cluster == 0], [CYAN, UV], DROPPED)
+    return labels, valid
+
+### candidateSplits: labels of every candidate and the control sheet settings that select it, as (names, settings, labels array)
+###     each family of candidates is computed over its whole parameter grid at once; candidates where the method fails are left out
+def candidateSplits(meanTS):
+    histSds = np.array((DEFAULT_HIST_SD,) + SD_VALUES, dtype = float)
+    histSd2s = np.array((DEFAULT_HIST_SD2,) + SD_VALUES, dtype = float)
+    noise = frameNoise(meanTS[::2]) + frameNoise(meanTS[1::2])
+    epsValues = sorted(set([DEFAULT_DBSCAN_EPS] + [float('%.3g' % (m*noise)) for m in EPS_NOISE_MULTIPLES if m*noise > 0]))
+
+    filterRows, filterValid = filterLabels(meanTS, histSds, histSd2s)
+    gapRows = splitLabels(meanTS, SD_VALUES)[0]
+    dbscanRows, dbscanValid = dbscanLabels(meanTS, epsValues)
+
+    names = (['simpFix', 'autoFix'] + ['autoFix sdVal=%g' % sd for sd in SD_VALUES] + ['gap sdVal=%g' % sd for sd in SD_VALUES]
+             + ['dbscan dbscanEps=%g' % eps for eps in epsValues])
+    settings = ([{'simpFix': 1}, {'autoFix': 1}] + [{'autoFix': 1, 'sdFlag': 1, 'sdVal': sd} for sd in SD_VALUES]
+                + [{'splitMethod': 'gap', 'sdFlag': 1, 'sdVal': sd} for sd in SD_VALUES]
+                + [{'splitMethod': 'dbscan', 'dbscanEps': eps} for eps in epsValues])
+    rows = np.concatenate([simpLabels(meanTS)[None, :], filterRows, gapRows, dbscanRows])
+    valid = np.concatenate([[True], filterValid, np.ones(len(SD_VALUES), dtype = bool), dbscanValid])
+
+    keep = np.flatnonzero(valid)
+    return [names[i] for i in keep], [settings[i] for i in keep], rows[keep]
+
+### scoreSplits: score (0 to 1) of each row of labels, together with its alternation, separation, dropped fraction and smr agreement
+###     smrLabels may be None; every measure is computed for all candidates at once
+def scoreSplits(meanTS, labels, smrLabels = None):
+    kept = labels != DROPPED
+    cyan, uv = labels == CYAN, labels == UV
+
+    pairs = kept[:, 1:] & kept[:, :-1]
+    alternation = np.sum((labels[:, 1:] != labels[:, :-1]) & pairs, axis = 1)/np.maximum(np.sum(pairs, axis = 1), 1)
+    altScore = np.clip(2*alternation - 1, 0, 1)
+
+    nCyan, nUv = np.maximum(cyan.sum(axis = 1), 1), np.maximum(uv.sum(axis = 1), 1)
+    cyanMean, uvMean = (cyan*meanTS).sum(axis = 1)/nCyan, (uv*meanTS).sum(axis = 1)/nUv
+    cyanVar = (cyan*(meanTS - cyanMean[:, None])**2).sum(axis = 1)/nCyan
+    uvVar = (uv*(meanTS - uvMean[:, None])**2).sum(axis = 1)/nUv
+    separation = (cyanMean - uvMean)/np.sqrt((cyanVar + uvVar)/2 + 1e-12)
+    sepScore = 1 - np.exp(-np.maximum(separation - 1.5, 0)/2)
+
+    droppedFrac = 1 - kept.mean(axis = 1)
+    score = altScore*sepScore*(1 - droppedFrac)
+
+    agreement = np.full(len(labels), np.nan)
+    if smrLabels is not None:
+        agreement = np.mean(labels == smrLabels[None, :], axis = 1)
+        score = score*(0.5 + 0.5*agreement)
+
+    return pd.DataFrame({'score': score, 'alternation': alternation, 'separation': separation, 'droppedFrac': droppedFrac,
+                         'smrAgreement': agreement})
+
+### smrTrigLabels: the triggers decoded from the smr file for an image, None if its trigger file was made some other way or is missing
+def smrTrigLabels(trigPath, nFrames):
+    if not os.path.isfile(trigPath):
+        return None
+    manifest = readManifest(trigPath)
+    if manifest is None or manifest.get('step') != 'trigs':
+        return None
+    trigs = pd.read_csv(trigPath)['opticalOrder'].values
+    if len(trigs) == 0:
+        return None
+    return fitLabels(trigs, nFrames)
+
+### sweepImage: scores of all candidate splits of one tif, best first
+def sweepImage(tifPath, opDir):
+    meanTS = np.asarray(getMeanTS(tifPath), dtype = float)
+    image = os.path.basename(tifPath).split('.')[0]
+    labels = parseImageName(image)
+    smrLabels = None
+    if labels is not None:
+        smrLabels = smrTrigLabels(os.path.join(imageOutDir(opDir, image, labels), 'OpticalOrder.csv'), len(meanTS))
+
+    names, settings, candidates = candidateSplits(meanTS)
+    scores = scoreSplits(meanTS, candidates, smrLabels)
+    scores.insert(0, 'candidate', names)
+    scores['settings'] = settings
+    return scores.sort_values('score', ascending = False, kind = 'stable').reset_index(drop = True)
+
+### hasFixChosen: True if the control sheet already says how to fix the triggers of an image
+def hasFixChosen(sheet, image):
+    return (sheet.get(image, 'autoFix') == 1 or sheet.get(image, 'simpFix') == 1 or sheet.get(image, 'manualOverwrite') == 1
+            or sheet.get(image, 'splitMethod') is not None)
+
+### sweepImages: sweep the tifs matching orgDir/matchTemplate/*.tif (only those flagged CrossedTrigs unless allImages) and write the
+###     suggestions into the control sheet; with applyScore, also fill in the settings of suggestions scoring at least applyScore for
+###     images without a fix chosen yet. Returns {image: scores}
+def sweepImages(orgDir, opDir, sheetPath, matchTemplate = '*/*/*/*/', allImages = False, applyScore = None):
+    sheet = ControlSheet.load(sheetPath)
+    results = {}
+    for tifPath in natsort.natsorted(glob.glob(os.path.join(orgDir, matchTemplate, '*.tif'))):
+        image = os.path.basename(tifPath).split('.')[0]
+        if not allImages and sheet.get(image, 'CrossedTrigs') != 1:
+            continue
+
+        scores = sweepImage(tifPath, opDir)
+        results[image] = scores
+        best = scores.iloc[0]
+        print(image, ': best', best['candidate'], 'score', round(best['score'], 3))
+        for i in range(1, min(len(scores), 4)):
+            print('    then', scores.iloc[i]['candidate'], 'score', round(scores.iloc[i]['score'], 3))
+        sheet.update(image, suggestedFix = best['candidate'], suggestedScore = round(float(best['score']), 3))
+
+        if applyScore is not None and best['score'] >= applyScore and not hasFixChosen(sheet, image):
+            print('  applying', best['candidate'], 'to', image)
+            sheet.update(image, writeImgs = 1, **best['settings'])
+
+    if len(results) > 0:
+        sheet.save()
+    return results
+
+
+if __name__ == '__main__':
+
+    parser=argparse.ArgumentParser(description='Score every way of fixing the triggers of the images on their mean time series and suggest the best in the control sheet')
+    parser.add_argument('orgDir',type=str,help='Path to the organized raw data (.tif and .smr files)')
+    parser.add_argument('opDir',type=str,help='Path to the output directory of genTrigsNii.py')
+    parser.add_argument('trigReplaceDf',type=str,help='Path to csv file which controls the semi automatic generation of trigger files')
+    parser.add_argument('--matchTemplate',type=str,help='a string to feed to glob to match certain sessions/cell types for example: SLC/ses-*/animal*/ca2/ will do all SLC data',default='*/*/*/*/')
+    parser.add_argument('--all',action='store_true',help='sweep all images, not only those flagged in the CrossedTrigs column')
+    parser.add_argument('--apply',type=float,help='fill in the suggested settings of images without a fix yet when the suggestion scores at least this (0 to 1)',default=None)
+    parser.add_argument('--cacheDir',type=str,help='directory for the cache of per-frame mean time series, default ~/.cache/ca2dataScripts',default=None)
+
+    args=parser.parse_args()
+
+    setCacheDir(args.cacheDir)
+    results = sweepImages(args.orgDir, args.opDir, args.trigReplaceDf, args.matchTemplate, args.all, args.apply)
+    print('Swept', len(results), 'images')
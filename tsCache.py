@@ -0,0 +1,230 @@
+### tsCache.py: on disk cache of per-frame time series derived from the raw .tif movies
+### Entries are keyed on the content of the tif (file size, modification time and a hash of the first bytes of the file, which hold the
+### TIF header and first IFD) rather than on its path, so a replaced tif never reuses a stale entry and a dot in a directory name cannot
+### misplace the cache. Entries are written atomically and the cache directory is kept under a size limit by evicting the least recently
+### used entries.
+### The cache directory defaults to ~/.cache/ca2dataScripts and can be set with the CA2_CACHE_DIR environment variable or setCacheDir;
+### the size limit (in MB, default 2048) with CA2_CACHE_MAX_MB or setCacheDir.
+### Statistics over a mask (e.g. the humanMadeMasks RPI mask of the session) are cached under a key of the mask content as well, and
+### getFrameSummary computes the full frame and mask statistics of SUMMARY_STATS in one read of the tif, for QC and trigger splitting.
+### With setSummaryOptions(cacheSummary = True), getMeanTS computes the whole summary when it has to read a tif (over the humanMadeMasks RPI
+### mask of the session as well if a mask directory is given), so the other statistics are cached along with the mean; otherwise it
+### computes the mean only, which is many times cheaper than the percentiles.
+### getPreviewMeanTS is the mean of a sparse grid of pixels of each frame, a quick stand in for the mean time series (see setPreviewStep).
+import os
+import hashlib
+import tempfile
+import logging
+import numpy as np
+from tifIO import MASK_PREFIX, frameStats, iterTifFrames
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'ca2dataScripts')
+DEFAULT_CACHE_MAX_MB = 2048
+
+# statistics computed by getFrameSummary: mean, median, 1st and 99th percentile and number of saturated pixels of each frame
+SUMMARY_STATS = ('mean', 'median', 'p1', 'p99', 'saturated')
+
+# spacing in rows and columns of the pixels read by getPreviewMeanTS when setPreviewStep was given no step
+DEFAULT_PREVIEW_STEP = 8
+
+# number of bytes at the start of the tif that are hashed into the cache key
+HEADER_HASH_BYTES = 65536
+
+### setCacheDir: change the cache directory and/or its size limit; stored in the environment so that worker processes inherit it
+def setCacheDir(cacheDir = None, maxMB = None):
+    if cacheDir is not None:
+        os.environ['CA2_CACHE_DIR'] = os.path.abspath(cacheDir)
+    if maxMB is not None:
+        os.environ['CA2_CACHE_MAX_MB'] = str(maxMB)
+
+### setPreviewStep: turn the preview mean time series on with the spacing of the pixels it reads (0 turns it off); stored in the environment
+###     so that worker processes inherit it
+def setPreviewStep(step = DEFAULT_PREVIEW_STEP):
+    os.environ['CA2_PREVIEW_STEP'] = str(int(step))
+
+### setSummaryOptions: turn on computing the frame summary whenever getMeanTS reads a tif, and/or set the directory of the humanMadeMasks
+###     (see runPreproc.py) whose session masks it summarizes as well (a mask directory turns the summary on); stored in the environment so
+###     that worker processes inherit it
+def setSummaryOptions(cacheSummary = None, maskDir = None):
+    if cacheSummary is not None:
+        os.environ['CA2_CACHE_SUMMARY'] = '1' if cacheSummary else '0'
+    if maskDir is not None:
+        os.environ['CA2_MASK_DIR'] = os.path.abspath(maskDir)
+        os.environ['CA2_CACHE_SUMMARY'] = '1'
+
+### cachingSummary: True if getMeanTS computes the frame summary when it reads a tif
+def cachingSummary():
+    return os.environ.get('CA2_CACHE_SUMMARY', '0') == '1'
+
+### sessionMaskPath: path of the humanMadeMasks RPI mask of the session of a tif, named as runPreproc.py names it
+def sessionMaskPath(tifPath, maskDir):
+    cellType, animalNum, sesh = os.path.basename(tifPath).split('.')[0].split('_')[:3]
+    return os.path.join(maskDir, cellType, cellType+'_'+animalNum+'_'+sesh.replace('-','-0')+'_RotOptical_maskRPI.nii.gz')
+
+### sessionMask: the mask of the session of a tif in the orientation of its frames, None if no mask directory is set, the session has no
+###     mask or the mask does not fit the frames
+def sessionMask(tifPath):
+    maskDir = os.environ.get('CA2_MASK_DIR')
+    if maskDir is None:
+        return None
+    try:
+        maskPath = sessionMaskPath(tifPath, maskDir)
+    except ValueError:
+        return None
+    if not os.path.isfile(maskPath):
+        return None
+    try:
+        return readMask(tifPath, maskPath)
+    except (OSError, ValueError) as e:
+        print('Mask', maskPath, 'cannot be used for', tifPath, ':', e)
+        return None
+
+### getPreviewStep: spacing of the pixels read by the preview mean time series, 0 if previews are off
+def getPreviewStep():
+    return max(int(os.environ.get('CA2_PREVIEW_STEP', 0)), 0)
+
+### getCacheDir: current cache directory, created if needed
+def getCacheDir():
+    cacheDir = os.environ.get('CA2_CACHE_DIR', DEFAULT_CACHE_DIR)
+    if not os.path.isdir(cacheDir):
+        os.makedirs(cacheDir, exist_ok = True)
+    return cacheDir
+
+### tifContentKey: cache key of a tif file built from its size, modification time and header hash
+def tifContentKey(tifPath):
+    st = os.stat(tifPath)
+    with open(tifPath, 'rb') as f:
+        headHash = hashlib.sha1(f.read(HEADER_HASH_BYTES)).hexdigest()
+    return hashlib.sha1(('%d_%d_%s' % (st.st_size, st.st_mtime_ns, headHash)).encode()).hexdigest()
+
+### cacheEntryPath: path of the entry holding the time series called kind (e.g. 'meanTS') for the given content key
+def cacheEntryPath(key, kind):
+    return os.path.join(getCacheDir(), key + '_' + kind + '.npy')
+
+### loadCached: return the cached array of the given kind for tifPath, or None if it is not in the cache
+def loadCached(tifPath, kind, key = None):
+    if key is None:
+        key = tifContentKey(tifPath)
+    entryPath = cacheEntryPath(key, kind)
+
+    try:
+        arr = np.load(entryPath)
+    except (OSError, ValueError, EOFError):
+        return None
+
+    # mark the entry as recently used for eviction
+    try:
+        os.utime(entryPath)
+    except OSError:
+        pass
+    return arr
+
+### storeCached: atomically write an array into the cache and evict old entries if the cache is over its size limit
+def storeCached(tifPath, kind, arr, key = None):
+    if key is None:
+        key = tifContentKey(tifPath)
+    entryPath = cacheEntryPath(key, kind)
+
+    fd, tmpPath = tempfile.mkstemp(dir = os.path.dirname(entryPath), prefix = '.tmp_', suffix = '.npy')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, arr)
+        os.replace(tmpPath, entryPath)
+    except BaseException:
+        if os.path.exists(tmpPath):
+            os.remove(tmpPath)
+        raise
+
+    evictCache()
+    return entryPath
+
+### evictCache: remove the least recently used entries until the cache is below maxBytes
+def evictCache(maxBytes = None):
+    if maxBytes is None:
+        maxBytes = int(float(os.environ.get('CA2_CACHE_MAX_MB', DEFAULT_CACHE_MAX_MB))*1024**2)
+    cacheDir = getCacheDir()
+
+    entries = []
+    for f in os.scandir(cacheDir):
+        if f.is_file() and f.name.endswith('.npy') and not f.name.startswith('.tmp_'):
+            st = f.stat()
+            entries.append((st.st_mtime, st.st_size, f.path))
+
+    total = sum(e[1] for e in entries)
+    for mtime, size, path in sorted(entries):
+        if total <= maxBytes:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError as e:
+            logging.exception(e)
+
+### maskKey: short hash of the content of a boolean mask, used to name the cache entries of the statistics computed over it
+def maskKey(mask):
+    mask = np.asarray(mask, dtype = bool)
+    return hashlib.sha1(str(mask.shape).encode() + np.packbits(mask).tobytes()).hexdigest()[:16]
+
+### readMask: the mask NIfTI at maskPath as a boolean array in the orientation of the frames of the tif (see niiIO.frameMask)
+def readMask(tifPath, maskPath):
+    from niiIO import frameMask
+    return frameMask(maskPath, next(iterTifFrames(tifPath)).shape)
+
+### statKind: name of the cache entry of a statistic, computed with the given pixel step and over the mask with the given maskKey (if any)
+def statKind(stat, step = 1, roiKey = None):
+    return ('step%d_' % step if step > 1 else '') + ('' if roiKey is None else 'roi' + roiKey + '_') + stat + 'TS'
+
+### getFrameStats: per-frame statistics (any of tifIO.FRAME_STATS and percentiles such as 'p5') of the tif movie as a dict of time series
+###     cached statistics are loaded, the missing ones are computed together in one streaming pass over the frames
+###     with a mask (a boolean array of the frame shape, or the path of a mask NIfTI) the statistics over its pixels are also returned,
+###     as tifIO.MASK_PREFIX + stat (e.g. 'roi.mean'), and computed in the same pass
+###     with step > 1 the statistics are estimated from every step-th row and column of the frames only, and cached separately
+###     set store = False to compute the time series without adding them to the cache
+def getFrameStats(tifPath, stats = ('mean',), store = True, mask = None, step = 1):
+    key = tifContentKey(tifPath)
+    if isinstance(mask, str):
+        mask = readMask(tifPath, mask)
+    names = list(stats)
+    kinds = {st: statKind(st, step) for st in stats}
+    if mask is not None:
+        roiKey = maskKey(mask)
+        names = names + [MASK_PREFIX + st for st in stats]
+        kinds.update({MASK_PREFIX + st: statKind(st, step, roiKey) for st in stats})
+
+    result = {}
+    for name in names:
+        arr = loadCached(tifPath, kinds[name], key = key)
+        if arr is not None:
+            result[name] = arr
+
+    missing = [st for st in stats if st not in result or (mask is not None and MASK_PREFIX + st not in result)]
+    if len(missing) > 0:
+        computed = frameStats(tifPath, stats = missing, mask = mask, step = step)
+        for name, arr in computed.items():
+            result[name] = arr
+            if store:
+                storeCached(tifPath, kinds[name], arr, key = key)
+
+    return result
+
+### getFrameSummary: the SUMMARY_STATS of every frame of the tif movie, over the whole frame and, if given, over a mask (see getFrameStats)
+def getFrameSummary(tifPath, mask = None, store = True):
+    return getFrameStats(tifPath, stats = SUMMARY_STATS, store = store, mask = mask)
+
+### getMeanTS: per-frame mean intensity of the tif movie, read from the cache when available
+###     when the summary is turned on (see setSummaryOptions) a tif that has to be read is read once for the whole frame summary, over the
+###     session mask as well when there is one (see sessionMask)
+def getMeanTS(tifPath, store = True):
+    if not cachingSummary():
+        return getFrameStats(tifPath, stats = ('mean',), store = store)['mean']
+    meanTS = loadCached(tifPath, statKind('mean'))
+    if meanTS is not None:
+        return meanTS
+    return getFrameSummary(tifPath, mask = sessionMask(tifPath), store = store)['mean']
+
+### getPreviewMeanTS: per-frame mean of every step-th row and column of the tif movie (step defaults to getPreviewStep, or
+###     DEFAULT_PREVIEW_STEP if previews are off), read from the cache when available
+def getPreviewMeanTS(tifPath, step = None, store = True):
+    if step is None:
+        step = getPreviewStep() or DEFAULT_PREVIEW_STEP
+    return getFrameStats(tifPath, stats = ('mean',), store = store, step = step)['mean']